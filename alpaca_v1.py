@@ -6,22 +6,104 @@ import os
 import unittest
 import time
 import urllib
-from typing import TypedDict, List, Awaitable
+from typing import TypedDict, List, Dict, Tuple, Awaitable
 import functools
 import pandas as pd
 import numpy as np
 import pytz
-from datetime import datetime
+from datetime import datetime, timedelta
+import asyncio
 import api
+from rate_limiter import TokenBucket, RateLimited
+from candle_store import CandleStore
 
 tz = pytz.timezone('America/New_York')
 
+# Max bars the bars endpoint returns per request
+PAGE = 1000
+# Bars of each endpoint timeframe in one regular session
+BARS_PER_DAY = {'minute': 390, '15Min': 26, 'day': 1}
+# Alpaca has no data before this
+HISTORY_START = 1199145600
+
+
+def trading_days(start: int, end: int) -> List[int]:
+    """
+    returns UNIX timestamp of midnight New York of every weekday between start and end
+    """
+    day = datetime.fromtimestamp(start, tz).date()
+    last = datetime.fromtimestamp(end, tz).date()
+    days = []
+    while day <= last:
+        if day.weekday() < 5:
+            days.append(int(tz.localize(datetime(day.year, day.month, day.day)).timestamp()))
+        day += timedelta(days=1)
+    return days
+
+
+def trading_days_back(end: int, days: int) -> int:
+    """
+    returns UNIX timestamp of midnight New York, {days} weekdays before end counting the day of end
+    """
+    day = datetime.fromtimestamp(end, tz).date()
+    while True:
+        if day.weekday() < 5:
+            days -= 1
+            if days <= 0:
+                break
+        day -= timedelta(days=1)
+    return int(tz.localize(datetime(day.year, day.month, day.day)).timestamp())
+
+
+def merge_pages(pages: List[List[api.Candle]], start: int, end: int) -> Dict[str, np.ndarray]:
+    """
+    pages - pages of bars in any order, which can overlap
+    start, end - only bars between them are kept
+
+    returns the bars as sorted arrays with duplicates removed
+    """
+    total = sum(len(p) for p in pages)
+    bars = {k: np.empty(total, dtype=np.int64 if k == 't' else np.float64) for k in ('t', 'o', 'h', 'l', 'c', 'v')}
+
+    i = 0
+    for page in pages:
+        n = len(page)
+        for k in bars:
+            bars[k][i:i + n] = [c[k] for c in page]
+        i += n
+
+    t, index = np.unique(bars['t'], return_index=True)
+    keep = index[(t >= start) & (t <= end)]
+    return {k: a[keep] for k, a in bars.items()}
+
 class Alpaca_V1(api.API):
+    # The v1 bars endpoint takes up to 200 comma separated symbols
+    batch_size = 200
+    # Alpaca data API quota
+    requests_per_minute = 200
+
     def __init__(self):
         self.session = aiohttp.ClientSession()
         api_key = os.environ["APCA_API_KEY_ID"]
         secret_key = os.environ["APCA_API_SECRET_KEY"]
         self.headers = {"APCA-API-KEY-ID": api_key, "APCA-API-SECRET-KEY": secret_key}
+        self.limiter = TokenBucket(self.requests_per_minute, name="alpaca")
+        self.store = CandleStore(os.getenv("CANDLE_STORE", "candles.db"))
+
+    async def _get(self, url: str) -> dict:
+        """
+        url - data API url to request
+
+        returns json body, the request waits on the rate limiter and is retried if Alpaca answers 429
+        """
+        async def request():
+            async with self.session.get(url, headers=self.headers) as resp:
+                if resp.status == 429:
+                    retry_after = resp.headers.get("Retry-After")
+                    raise RateLimited(float(retry_after) if retry_after else None)
+                return await resp.json()
+
+        return await self.limiter.run(request)
 
 
     async def get_price(self, symbol: str, t=time.time()) -> api.Price:
@@ -37,6 +119,116 @@ class Alpaca_V1(api.API):
 
         return api.Price(t=bars['t'].iloc[-1], p=bars['c'].iloc[-1])
 
+    async def get_prices(self, symbols: List[str], t=None) -> Dict[str, api.Price]:
+        """
+        symbols - Symbols to fetch prices for, at most {batch_size} of them
+        t - Time to get prices at, default is to get current price. In UNIX format
+
+        returns { symbol: Price } from the latest 1 minute bar of every symbol, symbols without bars are left out
+        """
+        if t is None:
+            t = time.time()
+
+        query = {
+            "symbols": ",".join(symbols),
+            "limit": 1,
+            "end": datetime.fromtimestamp(t, tz).isoformat()
+        }
+        qs = urllib.parse.urlencode(query)
+        url = f'https://data.alpaca.markets/v1/bars/minute?{qs}'
+        data = await self._get(url)
+
+        prices = {}
+        for symbol in symbols:
+            bars = data.get(symbol, [])
+            if len(bars) == 0:
+                continue
+            prices[symbol] = api.Price(t=bars[-1]['t'], p=bars[-1]['c'])
+
+        return prices
+
+    def _windows(self, tf: str, start: int, end: int) -> List[Tuple[int, int]]:
+        """
+        tf - timeframe of the bars endpoint, minute, 15Min, day
+        start - UNIX timestamp of the first bar to get
+        end - UNIX timestamp of the last bar to get
+
+        returns [start, end] split into sub windows of whole trading days, each expected to fit in one page
+        """
+        days_per_window = max(1, int(PAGE * 0.9) // BARS_PER_DAY[tf])
+        days = trading_days(start, end)
+
+        windows = []
+        for i in range(0, len(days), days_per_window):
+            window_start = max(start, days[i])
+            j = i + days_per_window
+            window_end = min(end, days[j] - 1) if j < len(days) else end
+            windows.append((window_start, window_end))
+
+        return windows
+
+    async def _fetch_window(self, symbol: str, tf: str, start: int, end: int) -> List[List[api.Candle]]:
+        """
+        returns pages of bars between start and end, usually one, more only if the window had more bars than expected
+        """
+        pages = []
+        while end >= start:
+            query = {
+                "symbols": symbol,
+                "limit": PAGE,
+                "start": datetime.fromtimestamp(start, tz).isoformat(),
+                "end": datetime.fromtimestamp(end, tz).isoformat()
+            }
+            qs = urllib.parse.urlencode(query)
+            url = f'https://data.alpaca.markets/v1/bars/{tf}?{qs}'
+            data = await self._get(url)
+            page = data.get(symbol, [])
+            pages.append(page)
+
+            if len(page) < PAGE:
+                break
+            end = page[0]['t'] - 1
+
+        return pages
+
+    async def _fetch_range(self, symbol: str, tf: str, start: int, end: int) -> Dict[str, np.ndarray]:
+        """
+        returns every bar between start and end, windows are fetched concurrently and merged
+        """
+        windows = self._windows(tf, start, end)
+        results = await asyncio.gather(*[self._fetch_window(symbol, tf, s, e) for s, e in windows])
+        return merge_pages([page for pages in results for page in pages], start, end)
+
+    async def _fetch_back(self, symbol: str, tf: str, end: int, stop: int, required=None) -> Dict[str, np.ndarray]:
+        """
+        symbol - Symbol of stock to get bars for
+        tf - timeframe of the bars endpoint, minute, 15Min, day
+        end - UNIX timestamp of the last bar to get
+        stop - UNIX timestamp of the first bar to get
+        required - number of bars to get, default is to get everything from stop to end
+
+        returns the bars as arrays, oldest first
+        """
+        if required is None:
+            return await self._fetch_range(symbol, tf, stop, end)
+
+        start = end
+        bars = merge_pages([], 0, 0)
+        while len(bars['t']) < required and start > max(stop, HISTORY_START):
+            # Enough trading days for the missing bars, with room for holidays and halts
+            missing = required - len(bars['t'])
+            days = int(np.ceil(missing / BARS_PER_DAY[tf] * 1.1)) + 2
+            window_end = start - 1 if start < end else end
+            start = max(stop, HISTORY_START, trading_days_back(window_end, days))
+
+            older = await self._fetch_range(symbol, tf, start, window_end)
+            if len(older['t']) == 0:
+                # No more history, the window always spans enough trading days to have bars
+                break
+            bars = {k: np.concatenate((older[k], bars[k])) for k in bars}
+
+        return {k: a[-required:] for k, a in bars.items()}
+
     async def get_bars(self, symbol: str, timeframe: str, multiplier: int, limit: int, t=time.time()) -> pd.DataFrame:
         """
         symbol - Symbol of stock to get bars for
@@ -67,26 +259,27 @@ class Alpaca_V1(api.API):
             num = 20
         
         required = limit * num * multiplier
-        candles = []
-        dt = datetime.fromtimestamp(t)
-        end = tz.localize(dt).isoformat()
+        end = int(t)
+        coverage = await self.store.run(self.store.coverage, symbol, tf)
 
-        while len(candles) < required:
-            query = {
-                "symbols": symbol,
-                "limit": 1000,
-                "start": '2008-04-27T15:59:00-04:00',
-                "end": end
-            }
-            qs = urllib.parse.urlencode(query)
-            url = f'https://data.alpaca.markets/v1/bars/{tf}?{qs}'
-            resp = await self.session.get(url, headers=self.headers)
-            data = await resp.json()
-            candles = data[symbol] + candles
-            dt = datetime.fromtimestamp(data[symbol][0]['t'])
-            end = tz.localize(dt).isoformat()
-        
-        df = pd.DataFrame(candles[-required:], columns=["t", "o", "h", "l", "c", "v"])
+        if coverage is not None and end < coverage[0]:
+            # Older than anything stored, the store only keeps one contiguous range per series
+            candles = await self._fetch_back(symbol, tf, end, stop=0, required=required)
+        else:
+            if coverage is not None and end > coverage[1]:
+                # Only the tail since the last stored bar, which is fetched again since it may have been in progress
+                tail = await self._fetch_back(symbol, tf, end, stop=coverage[1])
+                await self.store.run(self.store.put_arrays, symbol, tf, tail)
+
+            have = await self.store.run(self.store.count, symbol, tf, end)
+            if have < required:
+                head_end = coverage[0] - 1 if coverage is not None else end
+                head = await self._fetch_back(symbol, tf, head_end, stop=0, required=required - have)
+                await self.store.run(self.store.put_arrays, symbol, tf, head)
+
+            candles = await self.store.run(self.store.get, symbol, tf, end, required)
+
+        df = pd.DataFrame(candles, columns=["t", "o", "h", "l", "c", "v"])
         df["Datetime"] = pd.to_datetime(df["t"], unit="s")
 
         df = df.set_index("Datetime")
@@ -143,5 +336,72 @@ class TestAPICalls(unittest.IsolatedAsyncioTestCase):
     async def asyncTearDown(self):
         await self.API.session.close()
 
+class TestCandleStore(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.API = Alpaca_V1.__new__(Alpaca_V1)
+        self.API.store = CandleStore(':memory:')
+        # Minute bars of one day, starting 2021-04-20 13:30 UTC
+        start = 1618925400
+        self.bars = [{"t": start + i * 60, "o": 1.0, "h": 2.0, "l": 0.5, "c": 1.0 + i, "v": 100} for i in range(390)]
+        self.fetched = 0
+
+        async def _get(url: str) -> dict:
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            start = datetime.fromisoformat(query["start"][0]).timestamp()
+            end = datetime.fromisoformat(query["end"][0]).timestamp()
+            page = [b for b in self.bars if start <= b['t'] <= end][-int(query["limit"][0]):]
+            self.fetched += len(page)
+            return {query["symbols"][0]: page}
+
+        self.API._get = _get
+
+    async def test_only_fetches_tail(self):
+        bars = await self.API.get_bars("AAPL", "minute", 1, limit=100, t=self.bars[199]['t'])
+        self.assertEqual(list(bars['c']), [1.0 + i for i in range(100, 200)])
+        first = self.fetched
+
+        self.fetched = 0
+        bars = await self.API.get_bars("AAPL", "minute", 1, limit=100, t=self.bars[209]['t'])
+        self.assertEqual(list(bars['c']), [1.0 + i for i in range(110, 210)])
+        # The last stored bar and the 10 new ones
+        self.assertEqual(self.fetched, 11)
+        self.assertGreaterEqual(first, 100)
+
+    async def test_fetches_head_gap(self):
+        await self.API.get_bars("AAPL", "minute", 1, limit=10, t=self.bars[199]['t'])
+        bars = await self.API.get_bars("AAPL", "minute", 1, limit=50, t=self.bars[199]['t'])
+        self.assertEqual(list(bars['c']), [1.0 + i for i in range(150, 200)])
+        self.assertEqual(self.API.store.coverage("AAPL", "minute")[1], self.bars[199]['t'])
+
+    async def test_parallel_windows(self):
+        # 15 weekdays of regular session minute bars, ending Friday 2021-04-30
+        days = trading_days(1618200000, 1619812800)
+        self.bars = [{"t": d + 34200 + i * 60, "o": 1.0, "h": 2.0, "l": 0.5, "c": float(len(days) * j + i), "v": 100}
+                     for j, d in enumerate(days) for i in range(390)]
+        get = self.API._get
+        in_flight = []
+        most = []
+
+        async def _get(url: str) -> dict:
+            in_flight.append(url)
+            most.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(url)
+            return await get(url)
+
+        self.API._get = _get
+        bars = await self.API._fetch_back("AAPL", "minute", self.bars[-1]['t'], stop=0, required=3000)
+
+        self.assertEqual(list(bars['t']), [b['t'] for b in self.bars[-3000:]])
+        self.assertGreater(max(most), 4)
+        # Exact windows, so every request returns less than a page
+        self.assertLess(self.fetched, len(self.bars))
+
+    async def test_empty_history(self):
+        self.bars = []
+        bars = await self.API.get_bars("AAPL", "minute", 1, limit=10, t=1618925400)
+        self.assertEqual(len(bars), 0)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
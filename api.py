@@ -4,8 +4,9 @@ API Spec
 import aiohttp
 import os
 import time
+import unittest
 import urllib
-from typing import TypedDict, List, Awaitable
+from typing import TypedDict, List, Dict, Tuple, Awaitable
 import functools
 import pandas as pd
 import numpy as np
@@ -48,23 +49,143 @@ def convert_timeframe(timeframe: str, multiplier=1):
         return str(multiplier) + "M"
 
 
-def aggregate_candles(candles: pd.DataFrame, timeframe: str, multiplier=1, toDict=False) -> pd.DataFrame:
+def chunk(symbols: List[str], size: int) -> List[List[str]]:
+    """
+    symbols - list of symbols to split up
+    size - max amount of symbols per chunk
+
+    returns symbols split into lists of at most {size} symbols, used to batch quote requests
+    """
+    return [symbols[i:i + size] for i in range(0, len(symbols), size)]
+
+
+SECONDS = {"minute": 60, "hour": 3600, "day": 86400}
+SESSION_OPEN = 9 * 3600 + 30 * 60
+SESSION_CLOSE = 16 * 3600
+
+
+def utc_offsets(t: np.ndarray) -> np.ndarray:
+    """
+    t - UNIX timestamps
+
+    returns seconds to add to every timestamp to get New York local time
+    """
+    days, inverse = np.unique(t // 86400, return_inverse=True)
+    offsets = np.array([
+        tz.utcoffset(datetime.utcfromtimestamp(int(d) * 86400 + 43200)).total_seconds() for d in days
+    ], dtype=np.int64)
+    return offsets[inverse]
+
+
+def _buckets(t: np.ndarray, offset: np.ndarray, timeframe: str, multiplier: int, session: bool):
+    """
+    returns (bucket id, label, end) for every bar, ids never decrease as t increases
+    """
+    local = t + offset
+
+    if timeframe in ("week", "month"):
+        # Labeled by the last day of the period, like pandas W and M
+        day = (local if session else t) // 86400
+        if timeframe == "week":
+            ids = ((day + 3) // 7) // multiplier
+            label = ((ids * multiplier + multiplier - 1) * 7 + 3) * 86400
+        else:
+            months = day.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+            ids = months // multiplier
+            label = ((ids * multiplier + multiplier).astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) - 1) * 86400
+        if session:
+            label = label - offset
+        return ids, label, label + 86400
+
+    width = SECONDS[timeframe] * multiplier
+
+    if not session:
+        origin = (t[0] // 86400) * 86400
+        ids = (t - origin) // width
+        label = origin + ids * width
+        return ids, label, label + width
+
+    day = local // 86400
+    open_time = day * 86400 + SESSION_OPEN
+    close_time = day * 86400 + SESSION_CLOSE
+
+    if timeframe == "day":
+        # Trading days, so 2 day candles are 2 sessions no matter the weekends in between
+        days, ids = np.unique(day, return_inverse=True)
+        ids = ids // multiplier
+        label = open_time - offset
+        return ids, label, close_time - offset
+
+    k = (local - open_time) // width
+    ids = day * 100000 + k
+    label = open_time + k * width
+    end = label + width
+    # The last bucket of the session ends at the close, such as the 13:30 4H candle
+    in_session = (label >= open_time) & (label < close_time)
+    end = np.where(in_session, np.minimum(end, close_time), end)
+    return ids, label - offset, end - offset
+
+
+def resample(t: np.ndarray, o: np.ndarray, h: np.ndarray, l: np.ndarray, c: np.ndarray, v: np.ndarray,
+             rules: List[Tuple[str, int]], session=False, partial=True, now=None) -> Dict[Tuple[str, int], Dict[str, np.ndarray]]:
+    """
+    t, o, h, l, c, v - arrays of the base bars, sorted by t
+    rules - every (timeframe, multiplier) to aggregate into, such as [("hour", 1), ("hour", 4), ("day", 1)]
+    session - align hour and day candles to the 9:30 New York open instead of midnight UTC
+    partial - include the last candle even if it has not closed yet
+    now - UNIX timestamp used to tell if a candle closed, default is the current timestamp
+
+    returns { (timeframe, multiplier): { t, o, h, l, c, v, label } }, label is the UNIX timestamp the candle is indexed by
+    """
+    t = np.asarray(t, dtype=np.int64)
+    o, h, l, c, v = (np.asarray(x, dtype=np.float64) for x in (o, h, l, c, v))
+    offset = utc_offsets(t) if session and len(t) else np.zeros(len(t), dtype=np.int64)
+    if now is None:
+        now = time.time()
+
+    result = {}
+    for timeframe, multiplier in rules:
+        if len(t) == 0:
+            result[(timeframe, multiplier)] = {k: np.array([]) for k in ("t", "o", "h", "l", "c", "v", "label")}
+            continue
+
+        ids, label, end = _buckets(t, offset, timeframe, multiplier, session)
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        lasts = np.concatenate((starts[1:] - 1, [len(t) - 1]))
+
+        bars = {
+            "t": t[starts],
+            "o": o[starts],
+            "h": np.maximum.reduceat(h, starts),
+            "l": np.minimum.reduceat(l, starts),
+            "c": c[lasts],
+            "v": np.add.reduceat(v, starts),
+            "label": label[starts],
+        }
+
+        if not partial and end[starts[-1]] > now:
+            bars = {k: a[:-1] for k, a in bars.items()}
+
+        result[(timeframe, multiplier)] = bars
+
+    return result
+
+
+def aggregate_candles(candles: pd.DataFrame, timeframe: str, multiplier=1, toDict=False, session=False) -> pd.DataFrame:
     # candles - candles from getCandles as dataframe
     # timeframe - minute, hour, day
     # multiplier - how many timeframes, ex. 4 Days
+    # session - align hour and day candles to the market open
     # returns candles aggregated, with OHLCVT format
-    rule = convert_timeframe(timeframe, multiplier)
-    aggregated = candles.resample(rule).agg(
-        {
-            "t": "first",
-            "o": "first",
-            "h": "max",
-            "l": "min",
-            "c": "last",
-            "v": "sum",
-        }
-    )
-    aggregated = aggregated[aggregated["t"].notna()]
+    bars = resample(
+        candles["t"].to_numpy(), candles["o"].to_numpy(), candles["h"].to_numpy(),
+        candles["l"].to_numpy(), candles["c"].to_numpy(), candles["v"].to_numpy(),
+        [(timeframe, multiplier)],
+        session=session
+    )[(timeframe, multiplier)]
+
+    index = pd.DatetimeIndex(pd.to_datetime(bars.pop("label"), unit="s"), name="Datetime")
+    aggregated = pd.DataFrame(bars, index=index, columns=["t", "o", "h", "l", "c", "v"])
 
     if toDict:
         return aggregated.to_dict("records")
@@ -72,6 +193,11 @@ def aggregate_candles(candles: pd.DataFrame, timeframe: str, multiplier=1, toDic
 
 
 class API:
+    # Max amount of symbols the provider accepts in one quote request
+    batch_size = 1
+    # Quota of the provider
+    requests_per_minute = 60
+
     def __init__(self):
         self.session = aiohttp.ClientSession()
 
@@ -84,12 +210,104 @@ class API:
         """
         return
 
-    async def get_bars(self, symbol: str, timeframe: str, multiplier: int, limit: int) -> pd.DataFrame:
+    async def get_bars(self, symbol: str, timeframe: str, multiplier: int, limit: int, t=None) -> pd.DataFrame:
         """
         symbol - Symbol of stock to get bars for
         timeframe - type of candle to get, minute, hour, day, week, month
         multiplier - how many timeframes per candle
         limit - number of candles to get
+        t - UNIX timestamp of when to end, default is the current timestamp
         Gets last {limit} bars, for example, getBars('AAPL', 'minute', 4, 3000) gets the last 3000 available 4 minute bars
         """
         return
+
+    async def get_prices(self, symbols: List[str], t=None) -> Dict[str, Price]:
+        """
+        symbols - Symbols to fetch prices for, at most {batch_size} of them
+        t - Time to get prices at, default is to get current price. In UNIX format
+
+        returns { symbol: Price } for every symbol the provider had a quote for
+        Default implementation requests one symbol at a time, providers with a multi-symbol endpoint should override it
+        """
+        if t is None:
+            t = time.time()
+
+        prices = {}
+        for symbol in symbols:
+            prices[symbol] = await self.get_price(symbol, t=t)
+        return prices
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def test_chunk(self):
+        symbols = [str(i) for i in range(450)]
+        chunks = chunk(symbols, 200)
+        self.assertEqual([len(c) for c in chunks], [200, 200, 50])
+        self.assertEqual(sum(chunks, []), symbols)
+
+    async def test_get_prices_default(self):
+        class Fake(API):
+            def __init__(self):
+                pass
+
+            async def get_price(self, symbol: str, t=time.time()) -> Price:
+                return Price(t=int(t), p=float(len(symbol)))
+
+        prices = await Fake().get_prices(["AAPL", "BX"], t=100)
+        self.assertEqual(prices, {"AAPL": Price(t=100, p=4.0), "BX": Price(t=100, p=2.0)})
+
+
+class TestResample(unittest.TestCase):
+    def candles(self, start: int, n: int, step: int, weekdays_only=False) -> pd.DataFrame:
+        rng = np.random.default_rng(0)
+        t = start + np.arange(n) * step
+        if weekdays_only:
+            t = t[((t // 86400 + 3) % 7) < 5]
+        n = len(t)
+        c = 100 + np.cumsum(rng.normal(0, 1, n))
+        df = pd.DataFrame({"t": t, "o": c + rng.normal(0, 0.1, n), "h": c + 1, "l": c - 1, "c": c, "v": rng.integers(1, 1000, n)})
+        # Missing bars, such as halts
+        df = df.drop(index=df.index[5:9])
+        df["Datetime"] = pd.to_datetime(df["t"], unit="s")
+        return df.set_index("Datetime")
+
+    def pandas(self, candles: pd.DataFrame, rule: str) -> pd.DataFrame:
+        aggregated = candles.resample(rule).agg({"t": "first", "o": "first", "h": "max", "l": "min", "c": "last", "v": "sum"})
+        return aggregated[aggregated["t"].notna()]
+
+    def assertSame(self, candles: pd.DataFrame, timeframe: str, multiplier: int, rule: str):
+        expected = self.pandas(candles, rule)
+        actual = aggregate_candles(candles, timeframe, multiplier)
+        self.assertTrue((actual.index == expected.index).all(), f"{multiplier}{timeframe}")
+        for col in ["t", "o", "h", "l", "c", "v"]:
+            np.testing.assert_allclose(actual[col].to_numpy(dtype=float), expected[col].to_numpy(dtype=float))
+
+    def test_same_as_pandas(self):
+        # 2021-04-20 13:30 UTC
+        minutes = self.candles(1618925400, 3000, 60)
+        self.assertSame(minutes, "minute", 5, "5T")
+        self.assertSame(minutes, "hour", 1, "1H")
+        self.assertSame(minutes, "hour", 4, "4H")
+        days = self.candles(1609459200, 400, 86400, weekdays_only=True)
+        self.assertSame(days, "day", 1, "1D")
+        self.assertSame(days, "week", 1, "1W")
+        self.assertSame(days, "month", 1, "1M")
+
+    def test_session_and_partial(self):
+        # 2021-04-20 09:30 to 16:00 New York, 15 minute bars
+        t = 1618925400 + np.arange(26) * 900
+        ones = np.ones(len(t))
+        bars = resample(t, ones, ones, ones, ones, ones, [("hour", 4), ("day", 1), ("hour", 1)], session=True, now=t[-1] + 60)
+
+        four = bars[("hour", 4)]
+        self.assertEqual(list(four["label"]), [1618925400, 1618925400 + 4 * 3600])
+        self.assertEqual(list(four["v"]), [16, 10])
+        self.assertEqual(list(bars[("day", 1)]["v"]), [26])
+        self.assertEqual(len(bars[("hour", 1)]["t"]), 7)
+
+        closed = resample(t[:20], ones[:20], ones[:20], ones[:20], ones[:20], ones[:20], [("hour", 4)], session=True, partial=False, now=t[19] + 60)
+        self.assertEqual(list(closed[("hour", 4)]["v"]), [16])
+
+
+if __name__ == "__main__":
+    unittest.main()
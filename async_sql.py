@@ -0,0 +1,227 @@
+"""
+Async version of the DB repository, SQLite work runs on its own threads instead of the event loop
+"""
+import asyncio
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, TypeVar
+from sql import SQL
+from ema import EMA
+from price import PriceTicket
+from rules import Rule
+from metrics import metrics
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+QUERY = metrics.histogram("db_query_seconds", "Time SQLite took to run a read or write, not counting the wait for a thread")
+
+T = TypeVar('T')
+
+PRAGMAS = [
+    # Readers see the last commit and never wait on the writer
+    "PRAGMA journal_mode = WAL",
+    # In WAL mode NORMAL only syncs on checkpoints, a power loss can lose the last commits but never corrupts.
+    # Fine for readers, the writer syncs every commit, see WRITER_PRAGMAS
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16384",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+]
+
+# Timeouts and claims are written once per cycle, they have to survive a power loss or the alerts are sent again
+WRITER_PRAGMAS = PRAGMAS + ["PRAGMA synchronous = FULL"]
+
+
+def _resolve(fut: asyncio.Future, result: Any, error: Exception) -> None:
+    if fut.cancelled():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+
+class AsyncSQL:
+    def __init__(self, path: str, readers=4):
+        """
+        path - sqlite file of the tickets
+        readers - read connections, each on its own thread
+        """
+        self.path = path
+        self.local = threading.local()
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name="sql-writer", daemon=True)
+        self.ready = threading.Event()
+        self.writer.start()
+        # Tables are created by the writer, readers have to wait for them
+        self.ready.wait()
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="sql-reader")
+
+    def _connect(self, pragmas=PRAGMAS) -> SQL:
+        db = SQL(self.path)
+        for pragma in pragmas:
+            db.conn.execute(pragma)
+        return db
+
+    def _write_loop(self) -> None:
+        db = self._connect(WRITER_PRAGMAS)
+        self.ready.set()
+
+        while True:
+            item = self.writes.get()
+            if item is None:
+                break
+
+            fn, fut, loop = item
+            result, error = None, None
+            try:
+                with QUERY.time(op="write"):
+                    result = fn(db)
+            except Exception as e:
+                error = e
+            loop.call_soon_threadsafe(_resolve, fut, result, error)
+
+        db.conn.close()
+
+    def _reader(self) -> SQL:
+        if not hasattr(self.local, "db"):
+            self.local.db = self._connect()
+        return self.local.db
+
+    async def write(self, fn: Callable[[SQL], T]) -> T:
+        """
+        fn - function to run with the writer's SQL repository
+
+        returns result of fn, writes run one at a time in the order they were sent
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.writes.put((fn, fut, loop))
+        return await fut
+
+    async def read(self, fn: Callable[[SQL], T]) -> T:
+        """
+        fn - function to run with a reader's SQL repository
+
+        returns result of fn
+        """
+        def run() -> T:
+            with QUERY.time(op="read"):
+                return fn(self._reader())
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.readers, run)
+
+    async def add_price(self, symbol: str, price: float, channelID: int, author: int, margin=1.0) -> str:
+        return await self.write(lambda db: db.add_price(symbol, price, channelID, author, margin=margin))
+
+    async def add_ema(self, symbol: str, timeframe: str, periods: int, channelID: int, author: int, multiplier=1, margin=0.001) -> str:
+        return await self.write(lambda db: db.add_ema(symbol, timeframe, periods, channelID, author, multiplier=multiplier, margin=margin))
+
+    async def add_rule(self, symbol: str, expression: str, channelID: int, author: int) -> str:
+        return await self.write(lambda db: db.add_rule(symbol, expression, channelID, author))
+
+    async def delete(self, _id: str) -> bool:
+        return await self.write(lambda db: db.delete(_id))
+
+    async def update_timeout(self, _id: str, timeout: int) -> None:
+        return await self.write(lambda db: db.update_timeout(_id, timeout))
+
+    async def write_batch(self, timeouts: Dict[str, int], deletes: List[str]) -> None:
+        return await self.write(lambda db: db.write_batch(timeouts, deletes))
+
+    async def claim_batch(self, claims: Dict[str, Tuple[int, int]]) -> List[str]:
+        return await self.write(lambda db: db.claim_batch(claims))
+
+    async def heartbeat(self, worker_id: str, host: str, pid: int) -> None:
+        return await self.write(lambda db: db.heartbeat(worker_id, host, pid))
+
+    async def get_workers(self, ttl: int) -> List[str]:
+        return await self.read(lambda db: db.get_workers(ttl))
+
+    async def remove_worker(self, worker_id: str) -> None:
+        return await self.write(lambda db: db.remove_worker(worker_id))
+
+    async def get_all_ema(self, authorID=0, symbol="*", active=False) -> List[EMA]:
+        return await self.read(lambda db: db.get_all_ema(authorID, symbol=symbol, active=active))
+
+    async def get_all_price(self, authorID=0, symbol='*', active=False) -> List[PriceTicket]:
+        return await self.read(lambda db: db.get_all_price(authorID, symbol=symbol, active=active))
+
+    async def get_all_rule(self, authorID=0, symbol="*", active=False) -> List[Rule]:
+        return await self.read(lambda db: db.get_all_rule(authorID, symbol=symbol, active=active))
+
+    async def get_price_symbols(self) -> List[str]:
+        return await self.read(lambda db: db.get_price_symbols())
+
+    async def get_ema_symbols(self) -> List[str]:
+        return await self.read(lambda db: db.get_ema_symbols())
+
+    async def get_prices(self, symbol: str) -> List[PriceTicket]:
+        return await self.read(lambda db: db.get_prices(symbol))
+
+    async def get_active_prices(self) -> Dict[str, List[PriceTicket]]:
+        return await self.read(lambda db: db.get_active_prices())
+
+    def close(self) -> None:
+        self.writes.put(None)
+        self.writer.join()
+        self.readers.shutdown()
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = AsyncSQL(os.path.join(self.dir, "alerts.db"))
+
+    async def test_round_trip(self):
+        _id = await self.db.add_price('AAPL', 134, channelID=123, author=456, margin=0.01)
+        await self.db.update_timeout(_id, int(time.time()) + 1000)
+        tickets = await self.db.get_all_price(456)
+        self.assertEqual(tickets[0]['_id'], _id)
+        self.assertEqual(len(await self.db.get_all_price(456, active=True)), 0)
+
+        await self.db.delete(_id)
+        self.assertEqual(len(await self.db.get_all_price(456)), 0)
+
+    async def test_writes_synced(self):
+        # 2 is FULL, every commit is synced before write returns
+        self.assertEqual(await self.db.write(lambda db: db.conn.execute("PRAGMA synchronous").fetchone()[0]), 2)
+        self.assertEqual(await self.db.read(lambda db: db.conn.execute("PRAGMA synchronous").fetchone()[0]), 1)
+
+    async def test_reads_do_not_wait_on_writes(self):
+        await self.db.add_price('AAPL', 134, channelID=123, author=456)
+
+        def slow_write(db: SQL) -> None:
+            # Holds the write lock, like a large batch of timeouts
+            db.conn.execute("BEGIN IMMEDIATE")
+            db.conn.execute("UPDATE price SET timeout = 1")
+            time.sleep(0.5)
+            db.conn.commit()
+
+        write = asyncio.create_task(self.db.write(slow_write))
+        await asyncio.sleep(0.05)
+
+        start = time.perf_counter()
+        tickets = await self.db.get_all_price(456)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(len(tickets), 1)
+        self.assertLess(elapsed, 0.2)
+        self.assertFalse(write.done())
+        await write
+
+    async def asyncTearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,325 @@
+"""
+Benchmarks the monitor pipeline against SimulatedAPI, from loading tickets to delivering alerts
+
+Run with: python benchmark.py --tickets 100000 --symbols 2000 --cycles 5 --json baseline.json
+Compare a change against it with: python benchmark.py --tickets 100000 --symbols 2000 --cycles 5 --baseline baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import unittest
+from typing import Dict, List
+import numpy as np
+import compute
+from async_sql import AsyncSQL
+from candle_store import CandleStore
+from dispatch import AlertDispatcher
+from ema import EMA
+from ema_state import EMAEngine, EMAStateStore
+from evaluator import EVALUATED, Evaluator
+from price import PriceTicket
+from registry import TicketRegistry
+from replay import Replay
+from scheduler import Scheduler
+from sim_api import SimulatedAPI
+from sql import SQL
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+TIMEFRAMES = [('hour', 1), ('hour', 4), ('day', 1)]
+PERIODS = [8, 21, 50, 200]
+MARGINS = [0.5, 1.0, 1.0, 2.5]
+
+
+def fill(path: str, tickets: int, symbols: int, ema_share=0.1, channels=50, seed=0) -> None:
+    """
+    path - sqlite file to add the tickets to
+    tickets - how many tickets to add
+    symbols - how many symbols they are spread over
+    ema_share - fraction of tickets that are EMA tickets, the rest are price tickets
+    channels - how many channels alerts go to
+
+    Prices are within 10% of the symbol's simulated starting price, so some of them trigger
+    """
+    rng = random.Random(seed)
+    sim = SimulatedAPI(seed=seed)
+    names = [f"S{i:04d}" for i in range(symbols)]
+    now = int(time.time())
+
+    prices, emas = [], []
+    for i in range(tickets):
+        symbol = names[i % symbols]
+        channelID = rng.randrange(channels)
+        author = rng.randrange(10000)
+        if rng.random() < ema_share:
+            timeframe, multiplier = rng.choice(TIMEFRAMES)
+            emas.append((f"ema_{i:08x}", symbol, timeframe, multiplier, rng.choice(PERIODS), 0.001, now, 0, channelID, author))
+        else:
+            price = round(sim.start_price(symbol) * rng.uniform(0.9, 1.1), 2)
+            prices.append((f"price_{i:08x}", symbol, price, rng.choice(MARGINS), now, 0, channelID, author))
+
+    db = SQL(path)
+    with db.conn:
+        db.conn.executemany("INSERT INTO price VALUES (?, ?, ?, ?, ?, ?, ?, ?)", prices)
+        db.conn.executemany("INSERT INTO ema VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", emas)
+    db.conn.close()
+    logger.info(f"Added {len(prices)} price and {len(emas)} EMA tickets over {symbols} symbols")
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    if len(values) == 0:
+        return {"mean": 0.0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+    a = np.array(values)
+    return {"mean": float(a.mean()), "p50": float(np.percentile(a, 50)), "p99": float(np.percentile(a, 99)), "max": float(a.max())}
+
+
+class Benchmark:
+    def __init__(self, path: str, api: SimulatedAPI, concurrency=8, scheduled=False, deliver_latency=0.0, backend="inline"):
+        """
+        path - sqlite file filled with tickets
+        api - simulated provider
+        concurrency - requests in flight at once, same as the bot's Evaluator
+        scheduled - poll only due symbols like the bot does, otherwise every symbol is polled every cycle
+        deliver_latency - seconds the fake Discord takes to send a message
+        backend - compute backend EMAs are seeded on, inline or pool
+        """
+        self.path = path
+        self.api = api
+        self.concurrency = concurrency
+        self.scheduled = scheduled
+        self.deliver_latency = deliver_latency
+        self.backend = backend
+        self.cycle_start = 0.0
+        self.alert_latencies: List[float] = []
+
+    async def setup(self) -> float:
+        """
+        returns seconds it took to load the tickets
+        """
+        self.db = AsyncSQL(self.path)
+        self.registry = TicketRegistry(self.db)
+        self.evaluator = Evaluator(self.api, concurrency=self.concurrency)
+        self.engine = EMAEngine(EMAStateStore(':memory:'))
+        self.dispatcher = AlertDispatcher(self.deliver, requests_per_minute=60000, burst=1000)
+        self.scheduler = Scheduler()
+        self.compute = compute.backend(self.backend)
+
+        start = time.perf_counter()
+        await self.registry.load()
+        for symbol in self.registry.price_symbols():
+            self.scheduler.add(symbol)
+        return time.perf_counter() - start
+
+    async def deliver(self, channelID: int, message: str) -> None:
+        if self.deliver_latency > 0:
+            await asyncio.sleep(self.deliver_latency)
+
+    async def send(self, message: str, channelID: int, authorID: int, _id: str, calculated_timeout: int) -> None:
+        """
+        Same as the bot's send, with a fake channel
+        """
+        self.alert_latencies.append(time.perf_counter() - self.cycle_start)
+        self.dispatcher.put(channelID, message)
+        await self.registry.defer_timeout(_id, int(time.time()) + calculated_timeout)
+
+    async def cycle(self) -> Dict[str, float]:
+        """
+        returns seconds the cycle and its flush took, and how many tickets and alerts it had
+        """
+        evaluated = EVALUATED.total()
+        alerts = len(self.alert_latencies)
+        requests = self.api.requests
+        self.cycle_start = time.perf_counter()
+
+        if self.scheduled:
+            symbols = self.scheduler.due(int(self.api.requests_per_minute / 60 * 5 * self.api.batch_size))
+        else:
+            symbols = self.registry.price_symbols()
+        await self.evaluator.monitor_prices(symbols, self.registry.get, self.send,
+                                            lambda s, q: self.scheduler.observe(s, q, self.registry.get(s)))
+        await self.evaluator.monitor_emas(self.registry.active_emas(), self.send, self.engine, self.compute)
+
+        flush = time.perf_counter()
+        await self.registry.flush()
+        end = time.perf_counter()
+
+        return {
+            "seconds": end - self.cycle_start,
+            "flush": end - flush,
+            "symbols": len(symbols),
+            "tickets": EVALUATED.total() - evaluated,
+            "alerts": len(self.alert_latencies) - alerts,
+            "requests": self.api.requests - requests,
+        }
+
+    async def run(self, cycles: int) -> Dict[str, object]:
+        """
+        returns report of every cycle and a summary
+        """
+        load = await self.setup()
+        results = []
+        for i in range(cycles):
+            result = await self.cycle()
+            logger.info(f"Cycle {i + 1}: {result['seconds']:.3f}s, {result['symbols']} symbols, {result['tickets']:g} tickets, {result['alerts']} alerts")
+            results.append(result)
+
+        start = time.perf_counter()
+        await self.dispatcher.drain()
+        drain = time.perf_counter() - start
+        self.dispatcher.close()
+        self.compute.close()
+        self.db.close()
+
+        seconds = [r["seconds"] for r in results]
+        delivery = self.dispatcher.stats()
+        return {
+            "load_seconds": load,
+            "cycle_seconds": summarize(seconds),
+            "flush_seconds": summarize([r["flush"] for r in results]),
+            "tickets_per_second": sum(r["tickets"] for r in results) / max(sum(seconds), 1e-9),
+            "requests_per_cycle": float(np.mean([r["requests"] for r in results])) if results else 0.0,
+            "alerts": len(self.alert_latencies),
+            "alert_latency_seconds": summarize(self.alert_latencies),
+            "delivery_seconds": {"mean": delivery["mean"], "p99": delivery["p99"], "max": delivery["max"]},
+            "drain_seconds": drain,
+            # Linux reports kilobytes
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "cycles": results,
+        }
+
+
+def replay(symbols: int, days: int, tickets=40, seed=0) -> Dict[str, float]:
+    """
+    symbols - how many symbols to replay
+    days - trading days of minute bars per symbol
+    tickets - price tickets per symbol, every symbol also has 8 hour and day EMA tickets
+
+    returns seconds the replay took, per symbol and in total, and bars replayed per second
+    """
+    store = CandleStore(':memory:')
+    prices, emas = [], []
+    for j in range(symbols):
+        symbol = f"S{j:04d}"
+        rng = np.random.default_rng(seed + j)
+        n = 390 * days
+        c = 100 * np.exp(np.cumsum(rng.normal(0, 0.001, n)))
+        o = np.concatenate(([100.0], c[:-1]))
+        spread = np.abs(rng.normal(0, 0.05, n))
+        store.put_arrays(symbol, "minute", {"t": 1704205800 + np.arange(n, dtype=np.int64) * 60, "o": o,
+                                            "h": np.maximum(o, c) + spread, "l": np.minimum(o, c) - spread,
+                                            "c": c, "v": np.full(n, 100.0)})
+        prices += [PriceTicket(_id=f"price_{symbol}_{i}", symbol=symbol, price=90.0 + i * 20 / tickets, margin=0.5,
+                               channelID=1, authorID=2, timeout=0) for i in range(tickets)]
+        emas += [EMA(symbol, tf, p, channelID=1, author=2, _id=f"ema_{symbol}_{tf}_{p}")
+                 for tf in ('hour', 'day') for p in PERIODS]
+
+    start = time.perf_counter()
+    timeline = Replay(store).run(prices, emas, 0, 2 ** 31)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "seconds_per_symbol": seconds / max(1, symbols),
+        "bars_per_second": symbols * 390 * days / max(seconds, 1e-9),
+        "alerts": len(timeline),
+    }
+
+
+def compare(report: Dict[str, object], baseline: Dict[str, object]) -> List[str]:
+    """
+    returns one line per headline number, with the change from baseline
+    """
+    rows = [
+        ("load_seconds", lambda r: r["load_seconds"]),
+        ("cycle p50 seconds", lambda r: r["cycle_seconds"]["p50"]),
+        ("cycle p99 seconds", lambda r: r["cycle_seconds"]["p99"]),
+        ("tickets per second", lambda r: r["tickets_per_second"]),
+        ("alert latency p99 seconds", lambda r: r["alert_latency_seconds"]["p99"]),
+        ("peak RSS MB", lambda r: r["peak_rss_mb"]),
+    ]
+    lines = []
+    for name, get in rows:
+        new, old = get(report), get(baseline)
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        lines.append(f"{name:<28}{old:>12.4f}{new:>12.4f}{change:>10}")
+    return lines
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark the monitor pipeline against a simulated provider")
+    parser.add_argument("--tickets", type=int, default=100000)
+    parser.add_argument("--symbols", type=int, default=2000)
+    parser.add_argument("--ema-share", type=float, default=0.1, help="Fraction of tickets that are EMA tickets")
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per provider request")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Standard deviation of the latency")
+    parser.add_argument("--batch-size", type=int, default=200, help="Symbols per quote request")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--scheduled", action="store_true", help="Poll only due symbols, like the bot")
+    parser.add_argument("--compute", default="inline", choices=["inline", "pool"], help="Backend EMAs are seeded on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--baseline", help="Report of an earlier run to compare against")
+    parser.add_argument("--replay-days", type=int, default=0, help="Also time replay.py over this many days of minute bars")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "alerts.db")
+        fill(path, args.tickets, args.symbols, ema_share=args.ema_share, seed=args.seed)
+        api = SimulatedAPI(latency=args.latency, jitter=args.jitter, batch_size=args.batch_size, seed=args.seed)
+        report = await Benchmark(path, api, concurrency=args.concurrency, scheduled=args.scheduled,
+                                 backend=args.compute).run(args.cycles)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.replay_days > 0:
+        # Replay runs per symbol, a few symbols are enough, --replay-days 252 is a year of about 100k bars each
+        report["replay"] = replay(min(args.symbols, 5), args.replay_days, seed=args.seed)
+    report["args"] = vars(args)
+    summary = {k: v for k, v in report.items() if k not in ("cycles", "args")}
+    print(json.dumps(summary, indent=2))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"{'':<28}{'baseline':>12}{'this run':>12}{'change':>10}")
+        print("\n".join(compare(report, baseline)))
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def test_small_run(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "alerts.db")
+            fill(path, tickets=500, symbols=20, ema_share=0.2)
+            report = await Benchmark(path, SimulatedAPI(latency=0, jitter=0)).run(cycles=2)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(len(report["cycles"]), 2)
+        self.assertEqual(report["cycles"][0]["symbols"], 20)
+        self.assertGreater(report["cycles"][0]["tickets"], 0)
+        self.assertGreater(report["alerts"], 0)
+        # Alerted tickets cool down, so they do not alert again the next cycle
+        self.assertLess(report["cycles"][1]["alerts"], report["cycles"][0]["alerts"])
+        self.assertEqual(compare(report, report)[0].split()[-1], "+0.0%")
+
+    def test_replay(self):
+        report = replay(symbols=2, days=5)
+        self.assertGreater(report["alerts"], 0)
+        self.assertGreater(report["bars_per_second"], 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
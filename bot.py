@@ -8,15 +8,32 @@ from discord.ext import menus
 import time
 from typing import List
 from sql import SQL
+from async_sql import AsyncSQL
 from db import Ticket
 import traceback
 from custom_logger import get_logger
 from alpaca_v1 import Alpaca_V1
 from tdameritrade_api import TdAmeritradeAPI
 import datetime
-import holidays
-import pytz
+from market_calendar import MarketCalendar
 from price import Price
+from registry import TicketRegistry
+from rules import Rule, RuleEngine
+from dispatch import AlertDispatcher
+from scheduler import Scheduler
+from metrics import metrics
+from evaluator import EVALUATED
+import rate_limiter
+from rate_limiter import RateLimited
+import async_sql
+import dispatch
+from stream import StreamingAPI
+import api
+from evaluator import Evaluator
+from loop_monitor import LoopLag
+from ema_state import EMAEngine, EMAStateStore
+import compute
+import cache
 from dotenv import load_dotenv
 
 os.environ['TZ'] = 'utc'
@@ -24,6 +41,14 @@ time.tzset()
 
 logger = get_logger(__name__)
 
+CYCLE = metrics.histogram("monitor_cycle_seconds", "Time one monitor cycle took")
+ALERTS = metrics.counter("alerts_total", "Alerts fired")
+FAN_OUT = metrics.histogram("alerts_per_cycle", "Alerts fired in one monitor cycle", buckets=(0, 1, 5, 10, 50, 100, 500, 1000))
+MISSING = metrics.counter("alert_channels_missing_total", "Alerts whose channel no longer exists, their ticket is deleted")
+TICKETS_PER_SECOND = metrics.gauge("tickets_evaluated_per_second", "Tickets evaluated in the last cycle over its duration")
+LOOP_LAG = metrics.gauge("event_loop_lag_seconds", "How long the event loop was blocked during the last cycle")
+QUEUE_DEPTH = metrics.gauge("alert_queue_depth", "Alerts waiting to be delivered")
+
 
 class TicketsMenu(menus.ListPageSource):
     def __init__(self, tickets):
@@ -41,36 +66,149 @@ class TicketsMenu(menus.ListPageSource):
         return message
 
 
+calendar = MarketCalendar()
+
+
 def after_hours():
     """
     Returns true if in after hours, false if in trading hours
     """
-    tz = pytz.timezone("US/Eastern")
-    now = datetime.datetime.now(tz)
+    return not calendar.is_open()
+
+
+class Commands(commands.Cog):
+    """Basic commands for the bot"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.db = AsyncSQL('alerts.db')
+        # Quotes and bars requested by the price, EMA and rule monitors in the same cycle are shared
+        self.api = cache.cached(TdAmeritradeAPI())
+        self.evaluator = Evaluator(self.api)
+        # Loaded once in on_ready, kept up to date by the commands after that
+        self.registry = TicketRegistry(self.db)
+        self.loaded = asyncio.Event()
+        self.ema_engine = EMAEngine(EMAStateStore(os.getenv("CANDLE_STORE", "candles.db")))
+        self.rule_engine = RuleEngine(self.evaluator)
+        # COMPUTE_BACKEND=pool seeds EMAs on a process pool instead of the event loop
+        self.compute = compute.backend()
+
+        # Set STREAM_URL to get prices from a websocket stream instead of polling, such as
+        # wss://stream.data.alpaca.markets/v2/iex or a local replay_server.py
+        self.stream = None
+        self.stream_task = None
+        # With MONITOR_WORKERS set, worker.py processes monitor the tickets and the bot only handles commands.
+        # Their alerts are claimed in alerts.db, the bot must not alert on its own
+        self.workers = bool(os.getenv("MONITOR_WORKERS"))
+        stream_url = os.getenv("STREAM_URL")
+        if stream_url and self.workers:
+            logger.warning("STREAM_URL is ignored with MONITOR_WORKERS set, the workers poll every symbol")
+        elif stream_url:
+            self.stream = StreamingAPI(fallback=self.api, url=stream_url)
+            self.stream.on_tick(self.on_tick)
+
+        self.registry.subscribe(self.on_ticket)
+        self.dispatcher = AlertDispatcher(self.deliver, self.undeliverable)
+        self.scheduler = Scheduler(min_interval=5)
+        self.loop_lag = LoopLag()
+        self.cycle_alerts = 0
+        self.metrics_task = None
+        if not self.workers:
+            self.monitor.start()
+
+    async def on_ticket(self, event: str, ticket) -> None:
+        """
+        Keeps the streamed and polled symbols in line with the tickets
+        """
+        if event == "update":
+            return
 
-    open_time = datetime.time(hour=9, minute=30)
-    close_time = datetime.time(hour=16)
+        if isinstance(ticket, Rule) and event == "delete":
+            self.rule_engine.forget(ticket._id)
 
-    if now.strftime('%Y-%m-%d') in holidays.US():
-        return True
+        if isinstance(ticket, dict):
+            symbol = ticket['symbol']
+            if len(self.registry.get(symbol)) > 0:
+                # A new level may be right next to the price, poll it now
+                self.scheduler.add(symbol)
+            else:
+                self.scheduler.remove(symbol)
+        await self.update_stream()
 
-    if now.time() < open_time or now.time() > close_time:
-        return True
+    def poll_budget(self) -> int:
+        """
+        returns how many symbols can be polled in one cycle without going over the API quota
+        """
+        requests = self.api.requests_per_minute / 60 * self.monitor.seconds
+        return max(1, int(requests * self.api.batch_size))
+
+    async def update_stream(self) -> None:
+        if self.stream is not None:
+            await self.stream.set_symbols(self.registry.symbols())
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if not self.loaded.is_set():
+            await self.registry.load()
+            for symbol in self.registry.price_symbols():
+                self.scheduler.add(symbol)
+            self.loaded.set()
+
+        self.loop_lag.start()
+        # Set METRICS_PORT to serve Prometheus metrics on http://127.0.0.1:{METRICS_PORT}/metrics
+        if os.getenv("METRICS_PORT") and self.metrics_task is None:
+            self.metrics_task = asyncio.create_task(metrics.serve(port=int(os.getenv("METRICS_PORT"))))
+        if self.stream is not None and self.stream_task is None:
+            await self.update_stream()
+            self.stream_task = asyncio.create_task(self.stream.run())
+
+    async def on_tick(self, symbol: str, price: api.Price) -> None:
+        """
+        Checks the price tickets of symbol against a streamed trade
+        """
+        if after_hours():
+            return
 
-    if now.date().weekday() > 4:
-        return True
+        await Price(symbol, levels=self.registry.get(symbol)).check(price, self.send)
 
-    return False
+    async def send(self, message: str, channelID: int, authorID: int, _id: str, calculated_timeout: int) -> None:
+        channel = self.bot.get_channel(channelID)
 
+        if channel == None:
+            logger.error(f"Could not find channel for {channelID} for {authorID}")
+            MISSING.inc()
+            await self.registry.defer_delete(_id)
+            return
 
-class Commands(commands.Cog):
-    """Basic commands for the bot"""
+        ALERTS.inc(kind=_id.split("_")[0])
+        self.cycle_alerts += 1
 
-    def __init__(self, bot):
-        self.bot = bot
-        self.db = SQL('alerts.db')
-        self.api = TdAmeritradeAPI()
-        self.monitor.start()
+        # Cools down right away, delivery happens in the background
+        self.dispatcher.put(channelID, message, _id)
+        timeout = int(time.time()) + calculated_timeout
+        await self.registry.defer_timeout(_id, timeout)
+
+    async def undeliverable(self, ids: List[str]) -> None:
+        """
+        ids - tickets whose alert could not be delivered
+
+        Ends their cooldown, so they alert again instead of staying silent until the timeout
+        """
+        for _id in ids:
+            await self.registry.defer_timeout(_id, 0)
+
+    async def deliver(self, channelID: int, message: str) -> None:
+        channel = self.bot.get_channel(channelID)
+        if channel is None:
+            logger.error(f"Channel {channelID} went away before alert was delivered")
+            return
+
+        try:
+            await channel.send(message)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                raise RateLimited()
+            raise
 
     @commands.command(name="get")
     async def get(self, ctx, symbol="*", category="*"):
@@ -82,12 +220,15 @@ class Commands(commands.Cog):
 
         tickets = []
         if category == '*':
-            tickets += self.db.get_all_ema(ctx.author.id, symbol=symbol)
-            tickets += self.db.get_all_price(ctx.author.id, symbol=symbol)
+            tickets += await self.db.get_all_ema(ctx.author.id, symbol=symbol)
+            tickets += await self.db.get_all_price(ctx.author.id, symbol=symbol)
+            tickets += await self.db.get_all_rule(ctx.author.id, symbol=symbol)
         elif category == 'ema':
-            tickets += self.db.get_all_ema(ctx.author.id, symbol=symbol)
+            tickets += await self.db.get_all_ema(ctx.author.id, symbol=symbol)
         elif category == 'price':
-            tickets += self.db.get_all_price(ctx.author.id, symbol=symbol)
+            tickets += await self.db.get_all_price(ctx.author.id, symbol=symbol)
+        elif category == 'rule':
+            tickets += await self.db.get_all_rule(ctx.author.id, symbol=symbol)
 
         if len(tickets) < 1:
             await ctx.send(f"You have not entered any tickets <@{ctx.author.id}>")
@@ -114,9 +255,9 @@ class Commands(commands.Cog):
     @commands.group(invoke_without_command=True)
     async def add(self, ctx: commands.Context):
         """
-        Categories: price, ema
+        Categories: price, ema, rule
         """
-        await ctx.send("Please specify a category: price, ema")
+        await ctx.send("Please specify a category: price, ema, rule")
 
     @add.command(name="price")
     async def price(self, ctx: commands.Context, symbol: str, price: float, margin=1.0):
@@ -127,7 +268,7 @@ class Commands(commands.Cog):
 
         Adds price ticket to database
         """
-        _id = self.db.add_price(
+        _id = await self.registry.add_price(
             symbol=symbol,
             price=price,
             channelID=ctx.channel.id,
@@ -151,7 +292,7 @@ class Commands(commands.Cog):
 
         Adds ema ticket to database
         """
-        _id = self.db.add_ema(
+        _id = await self.registry.add_ema(
             symbol=symbol,
             timeframe=timeframe,
             periods=int(periods),
@@ -166,60 +307,100 @@ class Commands(commands.Cog):
     async def add_ema_error(self, ctx: commands.Context, error):
         await ctx.send(error)
 
+    @add.command(name="rule")
+    async def rule(self, ctx: commands.Context, symbol: str, *, expression: str):
+        """
+        symbol - stock symbol, price and indicators without a symbol refer to it
+        expression - conditions joined with and/or, such as: price crosses 150 and 1H RSI < 30 and price within 0.2% of 50EMA
+
+        Adds rule ticket to database, it alerts once every condition is met
+        """
+        _id = await self.registry.add_rule(
+            symbol=symbol,
+            expression=expression,
+            channelID=ctx.channel.id,
+            author=ctx.author.id,
+        )
+        await ctx.send(f"Added rule ticket (ID: {_id})")
+
+    @rule.error
+    async def add_rule_error(self, ctx: commands.Context, error):
+        await ctx.send(error)
+
     @commands.command(name="delete")
     async def delete(self, ctx: commands.Context, _id: str):
-        self.db.delete(_id)
+        await self.registry.delete(_id)
         await ctx.send(f"Deleted id: {_id}")
 
     @delete.error
     async def delete_error(self, ctx: commands.Context, error):
         await ctx.send(error)
 
+    @commands.command(name="stats")
+    async def stats(self, ctx: commands.Context):
+        """
+        Shows how the monitor is keeping up
+        """
+        lines = [
+            f"Cycles: {CYCLE.count()}, p50 {CYCLE.quantile(0.5):g}s, p99 {CYCLE.quantile(0.99):g}s",
+            f"Tickets evaluated: {EVALUATED.total():g}, {TICKETS_PER_SECOND.get():.0f}/s last cycle",
+            f"Alerts: {ALERTS.total():g}, {QUEUE_DEPTH.get():g} queued, delivery p99 {dispatch.LATENCY.quantile(0.99):g}s",
+            f"Provider requests: {rate_limiter.REQUESTS.total():g}, errors {rate_limiter.ERRORS.total():g}, p99 {rate_limiter.LATENCY.quantile(0.99):g}s",
+            f"Provider cache: {cache.CACHE.get(method='quote', result='hit') + cache.CACHE.get(method='bars', result='hit'):g} hits, "
+            f"{cache.CACHE.get(method='quote', result='shared') + cache.CACHE.get(method='bars', result='shared'):g} shared, "
+            f"{cache.CACHE.get(method='quote', result='miss') + cache.CACHE.get(method='bars', result='miss'):g} misses",
+            f"DB queries: {async_sql.QUERY.count()}, p99 {async_sql.QUERY.quantile(0.99):g}s",
+            f"Loop lag p99: {LOOP_LAG.get(quantile='0.99'):.3f}s, max {LOOP_LAG.get(quantile='1'):.3f}s",
+            f"Symbols scheduled: {len(self.scheduler)}, polls deferred: {self.scheduler.shed}",
+        ]
+        await ctx.send("\n".join(lines))
+
     @tasks.loop(seconds=5)
     async def monitor(self):
         await self.bot.wait_until_ready()
-        ah = after_hours()
-        logger.debug(f"After hours: {ah}")
-
-        if ah:
+        await self.loaded.wait()
+
+        now = time.time()
+        if not calendar.is_open(now):
+            # Sleeps through nights, weekends and holidays instead of waking up every 5 seconds
+            wait = calendar.next_open(now) - now
+            logger.info(f"Market closed, sleeping {datetime.timedelta(seconds=int(wait))} until the next session")
+            # Timeouts deferred since the last cycle, such as by streamed trades near the close, are written first
+            await self.registry.flush()
+            await asyncio.sleep(wait)
             return
 
-        # tickets = []
-        # tickets += self.db.get_all_ema(active=True)
-        # tickets += self.db.get_all_price(active=True)
-
-        # logger.info(f"Monitoring {len(tickets)} tickets")
         start = time.perf_counter()
-
-        async def send(message: str, channelID: int, authorID: int, _id: str, calculated_timeout: int) -> None:
-            channel = self.bot.get_channel(channelID)
-
-            if channel == None:
-                logger.error(f"Could not find channel for {channelID} for {authorID}")
-                self.db.delete(_id)
-
-            try:
-                await channel.send(message)
-
-                timeout = int(time.time()) + calculated_timeout
-                self.db.update_timeout(_id, timeout)
-            except Exception:
-                logger.error(f"ChannelID: {channelID}", exc_info=True)
-
-        symbols = self.db.get_price_symbols()
-        for symbol in symbols:
-            tickets = self.db.get_prices(symbol)
-            m = Price(symbol, prices=tickets)
-
-            try:
-                await m.monitor(self.api, send)
-            except Exception:
-                logger.error(f"Failed to monitor price for {symbol}", exc_info=True)
-            await asyncio.sleep(2)
+        evaluated = EVALUATED.total()
+        self.cycle_alerts = 0
+
+        try:
+            # Streamed trades are checked as they arrive in on_tick, otherwise only symbols that are due are polled
+            if self.stream is None:
+                symbols = self.scheduler.due(self.poll_budget())
+                await self.evaluator.monitor_prices(symbols, self.registry.get, self.send,
+                                                    lambda s, q: self.scheduler.observe(s, q, self.registry.get(s)))
+
+            await self.evaluator.monitor_emas(self.registry.active_emas(), self.send, self.ema_engine, self.compute)
+            await self.rule_engine.monitor(self.registry.active_rules(), self.send)
+        finally:
+            # Every alert of the cycle is written in one transaction
+            await self.registry.flush()
 
         end = time.perf_counter()
         dt = datetime.timedelta(seconds=(end-start))
-        logger.info(f"Took {str(dt)} to monitor tickets")
+        lag = self.loop_lag.stats()
+        alerts = self.dispatcher.stats()
+
+        CYCLE.observe(end - start)
+        FAN_OUT.observe(self.cycle_alerts)
+        TICKETS_PER_SECOND.set((EVALUATED.total() - evaluated) / max(end - start, 1e-9))
+        LOOP_LAG.set(lag['p99'], quantile="0.99")
+        LOOP_LAG.set(lag['max'], quantile="1")
+        QUEUE_DEPTH.set(alerts['depth'])
+        logger.info(f"Took {str(dt)} to monitor tickets. Loop lag p99 {lag['p99']:.3f}s, max {lag['max']:.3f}s. "
+                    f"{alerts['depth']} alerts queued, delivery p99 {alerts['p99']:.3f}s")
+        self.loop_lag.reset()
 
 
 def start():
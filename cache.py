@@ -0,0 +1,353 @@
+"""
+Caching layer around any API
+
+Concurrent requests for the same quote or series share one request in flight. Quotes are served from the cache
+for QUOTE_TTL seconds. Bars are kept until evicted, only the candle in progress is requested again once it is
+older than BAR_TTL seconds, so the EMA, rule and price monitors of one cycle cost one request per symbol
+"""
+import asyncio
+import os
+import time
+import unittest
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional
+import numpy as np
+import pandas as pd
+import api
+from metrics import metrics
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+# Requests for a time further back than this many seconds are for history and go to the provider. Monitors pick
+# t once per cycle, so it can be a while behind by the time the last request of a long cycle goes out
+LIVE = 60
+
+CACHE = metrics.counter("provider_cache_total", "Provider calls served from the cache (hit), "
+                                                "by a request already in flight (shared) or by a new request (miss)")
+EVICTED = metrics.counter("provider_cache_evicted_total", "Cached quotes and series dropped to stay under the size limit")
+
+
+class Bars(NamedTuple):
+    candles: pd.DataFrame
+    # System time the candle in progress was requested at
+    refreshed: float
+
+
+class LRU:
+    """
+    Dict that drops the least recently used key once it holds more than maxsize
+    """
+    def __init__(self, maxsize: int, name: str):
+        """
+        maxsize - most keys to hold
+        name - label of the eviction metric
+        """
+        self.maxsize = maxsize
+        self.name = name
+        self.items: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key: Hashable):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value) -> None:
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+            EVICTED.inc(kind=self.name)
+
+
+def tail(candles: pd.DataFrame, limit: int) -> pd.DataFrame:
+    """
+    returns a copy of the last {limit} candles, indexed like the provider returned them. Callers add columns to it
+    """
+    candles = candles.iloc[-limit:].copy() if limit > 0 else candles.iloc[:0].copy()
+    if isinstance(candles.index, pd.RangeIndex):
+        candles.reset_index(drop=True, inplace=True)
+    return candles
+
+
+def merge(candles: pd.DataFrame, latest: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """
+    candles - cached candles, oldest first
+    latest - last few candles from the provider
+
+    returns candles with latest replacing the candles it overlaps and appended after them, as many as before.
+    None if latest starts after the last cached candle, the candles in between were missed
+    """
+    if len(latest) == 0:
+        return candles
+    first = latest['t'].iloc[0]
+    if len(candles) == 0 or first > candles['t'].iloc[-1]:
+        return None
+
+    merged = pd.concat([candles[candles['t'] < first], latest], ignore_index=isinstance(candles.index, pd.RangeIndex))
+    return merged.iloc[-len(candles):]
+
+
+class CachedAPI(api.API):
+    def __init__(self, api: api.API, quote_ttl=1.0, bar_ttl=2.0, maxsize=10000, max_series=1000):
+        """
+        api - provider to cache
+        quote_ttl - seconds a quote is served from the cache
+        bar_ttl - seconds the candle in progress of a series is served from the cache
+        maxsize - most quotes to cache
+        max_series - most series of bars to cache
+        """
+        self.api = api
+        self.batch_size = api.batch_size
+        self.requests_per_minute = api.requests_per_minute
+        self.quote_ttl = quote_ttl
+        self.bar_ttl = bar_ttl
+        # symbol -> (quote, system time it was requested at)
+        self.quotes = LRU(maxsize, "quote")
+        # (symbol, timeframe, multiplier) -> Bars
+        self.bars = LRU(max_series, "bars")
+        self.in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    def share(self, key: Hashable, future: asyncio.Future) -> None:
+        """
+        key - request that future answers, later requests for it wait on future instead of requesting again
+        """
+        def landed(f: asyncio.Future) -> None:
+            if self.in_flight.get(key) is f:
+                del self.in_flight[key]
+            # Every waiter may have been cancelled, the error is raised to the ones that were not
+            if not f.cancelled():
+                f.exception()
+
+        self.in_flight[key] = future
+        future.add_done_callback(landed)
+
+    def start(self, key: Hashable, request: Callable[[], Awaitable]) -> asyncio.Future:
+        future = asyncio.ensure_future(request())
+        self.share(key, future)
+        return future
+
+    @staticmethod
+    def live(t, now: float) -> bool:
+        """
+        returns whether t asks for current data, older requests bypass the cache
+        """
+        return t is None or t >= now - LIVE
+
+    async def get_price(self, symbol: str, t=None) -> api.Price:
+        if not self.live(t, time.time()):
+            return await self.api.get_price(symbol, t=t)
+        prices = await self.get_prices([symbol], t=t)
+        return prices.get(symbol)
+
+    async def get_prices(self, symbols: List[str], t=None) -> Dict[str, api.Price]:
+        """
+        symbols - Symbols to fetch prices for, at most {batch_size} of them
+        t - Time to get prices at, default is to get current price. In UNIX format
+
+        returns { symbol: Price }, symbols that are neither cached nor in flight are requested in one batch
+        """
+        now = time.time()
+        if not self.live(t, now):
+            return await self.api.get_prices(symbols, t=t)
+
+        prices: Dict[str, api.Price] = {}
+        waiting: Dict[str, asyncio.Future] = {}
+        missing = []
+        for symbol in symbols:
+            cached = self.quotes.get(symbol)
+            if cached is not None and now - cached[1] < self.quote_ttl:
+                prices[symbol] = cached[0]
+                CACHE.inc(method="quote", result="hit")
+            elif ("quote", symbol) in self.in_flight:
+                waiting[symbol] = self.in_flight[("quote", symbol)]
+                CACHE.inc(method="quote", result="shared")
+            else:
+                missing.append(symbol)
+                CACHE.inc(method="quote", result="miss")
+
+        if missing:
+            future = asyncio.ensure_future(self._fetch_prices(missing, t, now))
+            for symbol in missing:
+                self.share(("quote", symbol), future)
+                waiting[symbol] = future
+
+        for symbol, future in waiting.items():
+            fetched = await asyncio.shield(future)
+            if symbol in fetched:
+                prices[symbol] = fetched[symbol]
+        return prices
+
+    async def _fetch_prices(self, symbols: List[str], t, requested: float) -> Dict[str, api.Price]:
+        prices = await self.api.get_prices(symbols, t=t)
+        for symbol, price in prices.items():
+            self.quotes.put(symbol, (price, requested))
+        return prices
+
+    async def get_bars(self, symbol: str, timeframe: str, multiplier: int, limit: int, t=None) -> pd.DataFrame:
+        """
+        Same as API.get_bars. A cached series with at least {limit} candles is served from the cache, with its candle
+        in progress requested again once it is older than {bar_ttl}. Other series are requested in full
+        """
+        now = time.time()
+        if not self.live(t, now):
+            return await self.api.get_bars(symbol, timeframe, multiplier, limit, t=t)
+
+        key = (symbol, timeframe, multiplier)
+        cached: Optional[Bars] = self.bars.get(key)
+        if cached is not None and len(cached.candles) >= limit and now - cached.refreshed < self.bar_ttl:
+            CACHE.inc(method="bars", result="hit")
+            return tail(cached.candles, limit)
+
+        future = self.in_flight.get(("bars",) + key)
+        if future is not None:
+            CACHE.inc(method="bars", result="shared")
+            candles = await asyncio.shield(future)
+            if len(candles) >= limit:
+                return tail(candles, limit)
+            cached = self.bars.get(key)
+
+        CACHE.inc(method="bars", result="miss")
+        future = self.start(("bars",) + key, lambda: self._fetch_bars(key, limit, cached))
+        return tail(await asyncio.shield(future), limit)
+
+    async def _fetch_bars(self, key: tuple, limit: int, cached: Optional[Bars]) -> pd.DataFrame:
+        symbol, timeframe, multiplier = key
+        requested = time.time()
+        if cached is not None and len(cached.candles) >= limit:
+            # The closed candle and the one in progress, in case a new candle started since
+            latest = await self.api.get_bars(symbol, timeframe, multiplier, limit=2, t=requested)
+            candles = merge(cached.candles, latest)
+            if candles is not None:
+                self.bars.put(key, Bars(candles, requested))
+                return candles
+
+        size = max(limit, len(cached.candles) if cached is not None else 0)
+        candles = await self.api.get_bars(symbol, timeframe, multiplier, limit=size, t=requested)
+        self.bars.put(key, Bars(candles, requested))
+        return candles
+
+
+def cached(provider: api.API) -> CachedAPI:
+    """
+    provider - API to cache
+
+    returns provider cached with QUOTE_TTL and BAR_TTL seconds, 1 and 2 if they are not set
+    """
+    return CachedAPI(provider, quote_ttl=float(os.getenv("QUOTE_TTL", 1.0)), bar_ttl=float(os.getenv("BAR_TTL", 2.0)))
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    class Counting(api.API):
+        batch_size = 50
+
+        def __init__(self, latency=0.02, fail=0):
+            self.latency = latency
+            self.fail = fail
+            self.calls: List[tuple] = []
+
+        async def get_prices(self, symbols: List[str], t=None) -> Dict[str, api.Price]:
+            self.calls.append(("quote", tuple(symbols)))
+            await asyncio.sleep(self.latency)
+            if self.fail > 0:
+                self.fail -= 1
+                raise Exception("Provider is down")
+            return {s: api.Price(t=int(t or 0), p=100.0 + len(self.calls)) for s in symbols}
+
+    async def test_concurrent_requests_share_one(self):
+        provider = self.Counting()
+        cache = CachedAPI(provider)
+        now = time.time()
+        results = await asyncio.gather(cache.get_prices(["AAPL", "TSLA"], t=now), cache.get_prices(["TSLA", "MSFT"], t=now),
+                                       cache.get_price("AAPL", t=now))
+
+        self.assertEqual(provider.calls, [("quote", ("AAPL", "TSLA")), ("quote", ("MSFT",))])
+        self.assertEqual(results[0]["TSLA"], results[1]["TSLA"])
+        self.assertEqual(results[2], results[0]["AAPL"])
+        self.assertEqual(cache.in_flight, {})
+
+    async def test_ttl(self):
+        provider = self.Counting(latency=0)
+        cache = CachedAPI(provider, quote_ttl=0.05)
+        first = await cache.get_price("AAPL", t=time.time())
+        self.assertEqual(await cache.get_price("AAPL", t=time.time()), first)
+        self.assertEqual(len(provider.calls), 1)
+
+        await asyncio.sleep(0.06)
+        self.assertNotEqual(await cache.get_price("AAPL", t=time.time()), first)
+        self.assertEqual(len(provider.calls), 2)
+
+        # Historical quotes always go to the provider
+        await cache.get_prices(["AAPL"], t=1000)
+        self.assertEqual(len(provider.calls), 3)
+
+    async def test_errors_shared_not_cached(self):
+        provider = self.Counting(fail=1)
+        cache = CachedAPI(provider)
+        results = await asyncio.gather(cache.get_price("AAPL"), cache.get_price("AAPL"), return_exceptions=True)
+        self.assertTrue(all(isinstance(r, Exception) for r in results))
+        self.assertEqual(len(provider.calls), 1)
+
+        self.assertEqual((await cache.get_price("AAPL"))['p'], 102.0)
+        self.assertEqual(len(provider.calls), 2)
+
+    async def test_waiter_cancelled(self):
+        provider = self.Counting()
+        cache = CachedAPI(provider)
+        first = asyncio.create_task(cache.get_price("AAPL"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get_price("AAPL"))
+        await asyncio.sleep(0)
+        first.cancel()
+        self.assertEqual((await second)['p'], 101.0)
+        self.assertEqual(len(provider.calls), 1)
+
+    async def test_lru(self):
+        cache = CachedAPI(self.Counting(latency=0), maxsize=2)
+        await cache.get_prices(["A", "B"])
+        await cache.get_price("A")
+        await cache.get_price("C")
+        self.assertEqual(list(cache.quotes.items), ["A", "C"])
+        self.assertGreaterEqual(EVICTED.get(kind="quote"), 1)
+
+    def test_merge(self):
+        candles = pd.DataFrame({"t": [0, 60, 120], "c": [1.0, 2.0, 3.0]})
+        merged = merge(candles, pd.DataFrame({"t": [120, 180], "c": [3.5, 4.0]}))
+        self.assertEqual(merged['t'].tolist(), [60, 120, 180])
+        self.assertEqual(merged['c'].tolist(), [2.0, 3.5, 4.0])
+        self.assertEqual(merge(candles, pd.DataFrame({"t": [180, 240], "c": [4.0, 5.0]})), None)
+
+    async def test_bars(self):
+        from sim_api import SimulatedAPI
+        sim = SimulatedAPI(latency=0.01, jitter=0)
+        cache = CachedAPI(sim, bar_ttl=60)
+
+        candles = await asyncio.gather(*[cache.get_bars("AAPL", "minute", 1, limit=100, t=time.time()) for _ in range(3)])
+        self.assertEqual(sim.requests, 1)
+        smaller = await cache.get_bars("AAPL", "minute", 1, limit=10)
+        self.assertEqual(sim.requests, 1)
+        self.assertTrue(smaller.equals(tail(candles[0], 10)))
+        self.assertEqual(smaller.index.tolist(), list(range(10)))
+
+        # Callers add EMA columns to the candles they get
+        smaller["8EMA"] = 0.0
+        self.assertNotIn("8EMA", (await cache.get_bars("AAPL", "minute", 1, limit=10)).columns)
+
+        # Once stale, only the candle in progress is requested
+        cache.bar_ttl = 0
+        refreshed = await cache.get_bars("AAPL", "minute", 1, limit=50, t=time.time())
+        self.assertEqual(sim.requests, 2)
+        expected = await sim.get_bars("AAPL", "minute", 1, limit=50, t=time.time())
+        self.assertTrue(np.allclose(refreshed[["t", "o", "h", "l", "c"]], expected[["t", "o", "h", "l", "c"]]))
+
+        # More candles than cached are requested in full
+        await cache.get_bars("AAPL", "minute", 1, limit=200)
+        self.assertEqual(len(cache.bars.get(("AAPL", "minute", 1)).candles), 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,285 @@
+"""
+On disk OHLCV store, so historical bars are only downloaded once
+"""
+import asyncio
+import functools
+import sqlite3
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+import numpy as np
+import api
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar('T')
+
+
+class CandleStore:
+    def __init__(self, path: str, max_bytes=512 * 1024 * 1024):
+        """
+        path - sqlite file to keep candles in
+        max_bytes - size of the file to stay under, least recently read series are evicted first
+        """
+        self.max_bytes = max_bytes
+        # Async callers go through run, which always uses the same thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="candle-store")
+        # (symbol, timeframe) -> when it was last read, written with the next put or eviction instead of on every read
+        self.accessed: Dict[Tuple[str, str], int] = {}
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS
+                bars (
+                    symbol TEXT,
+                    timeframe TEXT,
+                    t INTEGER,
+                    o FLOAT,
+                    h FLOAT,
+                    l FLOAT,
+                    c FLOAT,
+                    v INTEGER,
+                    PRIMARY KEY (symbol, timeframe, t)
+                ) WITHOUT ROWID
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS
+                series (
+                    symbol TEXT,
+                    timeframe TEXT,
+                    first INTEGER,
+                    last INTEGER,
+                    accessed INTEGER,
+                    PRIMARY KEY (symbol, timeframe)
+                )
+            """
+        )
+        self.conn.commit()
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        fn - method of the store to call
+
+        returns result of fn, run on the store's thread so sqlite does not block the event loop
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+    def coverage(self, symbol: str, timeframe: str) -> Optional[Tuple[int, int]]:
+        """
+        symbol - stock symbol
+        timeframe - base timeframe the bars were downloaded in, such as minute or 15Min
+
+        returns (first, last) timestamp stored for the series, None if nothing is stored
+        """
+        row = self.conn.execute(
+            "SELECT first, last FROM series WHERE symbol = ? AND timeframe = ?",
+            (symbol, timeframe)
+        ).fetchone()
+        return row
+
+    def put(self, symbol: str, timeframe: str, candles: List[api.Candle]) -> None:
+        """
+        candles - bars to store, replaces stored bars with the same timestamp
+
+        Bars must be contiguous with what is already stored, the store keeps a single range per series
+        """
+        self.put_arrays(symbol, timeframe, {k: np.array([c[k] for c in candles]) for k in ('t', 'o', 'h', 'l', 'c', 'v')})
+
+    def put_arrays(self, symbol: str, timeframe: str, bars: Dict[str, np.ndarray]) -> None:
+        """
+        bars - { t, o, h, l, c, v } arrays of the bars to store
+        """
+        if len(bars['t']) == 0:
+            return
+
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            zip([symbol] * len(bars['t']), [timeframe] * len(bars['t']),
+                bars['t'].tolist(), bars['o'].tolist(), bars['h'].tolist(), bars['l'].tolist(), bars['c'].tolist(), bars['v'].tolist())
+        )
+
+        first = int(bars['t'].min())
+        last = int(bars['t'].max())
+        self.conn.execute(
+            """
+            INSERT INTO series VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (symbol, timeframe) DO UPDATE SET
+                first = MIN(first, excluded.first),
+                last = MAX(last, excluded.last)
+            """,
+            (symbol, timeframe, first, last, int(time.time()))
+        )
+        self.write_accessed()
+        self.conn.commit()
+        self.evict()
+
+    def count(self, symbol: str, timeframe: str, end: int) -> int:
+        """
+        returns how many bars are stored up to and including end
+        """
+        row = self.conn.execute(
+            "SELECT COUNT(*) FROM bars WHERE symbol = ? AND timeframe = ? AND t <= ?",
+            (symbol, timeframe, end)
+        ).fetchone()
+        return row[0]
+
+    def get(self, symbol: str, timeframe: str, end: int, limit: int) -> List[api.Candle]:
+        """
+        end - UNIX timestamp of the last bar to include
+        limit - number of bars to get
+
+        returns the last {limit} stored bars up to end, oldest first
+        """
+        rows = self.conn.execute(
+            """
+            SELECT t, o, h, l, c, v FROM bars
+            WHERE symbol = ? AND timeframe = ? AND t <= ?
+            ORDER BY t DESC
+            LIMIT ?
+            """,
+            (symbol, timeframe, end, limit)
+        ).fetchall()
+        self.accessed[(symbol, timeframe)] = int(time.time())
+
+        return [api.Candle(t=r[0], o=r[1], h=r[2], l=r[3], c=r[4], v=r[5]) for r in reversed(rows)]
+
+    def get_range(self, symbol: str, timeframe: str, start: int, end: int) -> Dict[str, np.ndarray]:
+        """
+        start, end - UNIX timestamps, bars between them are included
+
+        returns { t, o, h, l, c, v } arrays of the stored bars, oldest first
+        """
+        rows = self.conn.execute(
+            "SELECT t, o, h, l, c, v FROM bars WHERE symbol = ? AND timeframe = ? AND t >= ? AND t <= ? ORDER BY t",
+            (symbol, timeframe, start, end)
+        ).fetchall()
+        if len(rows) == 0:
+            return {k: np.array([], dtype=np.int64 if k == 't' else np.float64) for k in ('t', 'o', 'h', 'l', 'c', 'v')}
+
+        a = np.array(rows, dtype=np.float64)
+        bars = {k: a[:, i] for i, k in enumerate(('t', 'o', 'h', 'l', 'c', 'v'))}
+        bars['t'] = bars['t'].astype(np.int64)
+        return bars
+
+    def write_accessed(self) -> None:
+        """
+        Writes when every series was last read, in the caller's transaction
+        """
+        if not self.accessed:
+            return
+        self.conn.executemany(
+            "UPDATE series SET accessed = ? WHERE symbol = ? AND timeframe = ?",
+            [(t, symbol, timeframe) for (symbol, timeframe), t in self.accessed.items()]
+        )
+        self.accessed = {}
+
+    def invalidate(self, symbol: str) -> None:
+        """
+        symbol - stock symbol that had a corporate action, such as a split
+
+        Deletes every stored bar of symbol so it is downloaded again, adjusted
+        """
+        self.conn.execute("DELETE FROM bars WHERE symbol = ?", (symbol,))
+        self.conn.execute("DELETE FROM series WHERE symbol = ?", (symbol,))
+        self.conn.commit()
+        self.conn.execute("PRAGMA incremental_vacuum")
+        logger.info(f"Invalidated stored bars of {symbol}")
+
+    def size(self) -> int:
+        """
+        returns bytes used by the store, not counting free pages
+        """
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+
+    def evict(self) -> None:
+        """
+        Deletes least recently read series until the store is under max_bytes
+        """
+        if self.size() > self.max_bytes:
+            self.write_accessed()
+            self.conn.commit()
+
+        while self.size() > self.max_bytes:
+            row = self.conn.execute("SELECT symbol, timeframe FROM series ORDER BY accessed LIMIT 1").fetchone()
+            if row is None:
+                return
+            self.conn.execute("DELETE FROM bars WHERE symbol = ? AND timeframe = ?", row)
+            self.conn.execute("DELETE FROM series WHERE symbol = ? AND timeframe = ?", row)
+            self.conn.commit()
+            logger.info(f"Evicted stored bars of {row[0]} {row[1]}")
+
+        self.conn.execute("PRAGMA incremental_vacuum")
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.store = CandleStore(':memory:')
+
+    def candles(self, start: int, n: int, step=60) -> List[api.Candle]:
+        return [api.Candle(t=start + i * step, o=1.0, h=2.0, l=0.5, c=1.5, v=100) for i in range(n)]
+
+    def test_put_get(self):
+        self.store.put("AAPL", "minute", self.candles(0, 100))
+        self.store.put("AAPL", "minute", self.candles(6000, 50))
+        self.assertEqual(self.store.coverage("AAPL", "minute"), (0, 6000 + 49 * 60))
+        bars = self.store.get("AAPL", "minute", end=6000, limit=10)
+        self.assertEqual([b['t'] for b in bars], [60 * i for i in range(91, 101)])
+        self.assertEqual(self.store.count("AAPL", "minute", end=6000), 101)
+
+    def test_get_range(self):
+        self.store.put("AAPL", "minute", self.candles(0, 100))
+        bars = self.store.get_range("AAPL", "minute", 600, 1200)
+        self.assertEqual(bars['t'].tolist(), list(range(600, 1260, 60)))
+        self.assertEqual(len(self.store.get_range("TSLA", "minute", 0, 1200)['t']), 0)
+
+    def test_invalidate(self):
+        self.store.put("AAPL", "minute", self.candles(0, 10))
+        self.store.put("TSLA", "minute", self.candles(0, 10))
+        self.store.invalidate("AAPL")
+        self.assertIsNone(self.store.coverage("AAPL", "minute"))
+        self.assertEqual(len(self.store.get("TSLA", "minute", end=600, limit=100)), 10)
+
+    def test_evict(self):
+        self.store.put("AAPL", "minute", self.candles(0, 5000))
+        self.store.conn.execute("UPDATE series SET accessed = 0 WHERE symbol = 'AAPL'")
+        self.store.max_bytes = int(self.store.size() * 1.5)
+        self.store.put("TSLA", "minute", self.candles(0, 5000))
+        self.assertIsNone(self.store.coverage("AAPL", "minute"))
+        self.assertIsNotNone(self.store.coverage("TSLA", "minute"))
+        self.assertLessEqual(self.store.size(), self.store.max_bytes)
+
+    def test_reads_evict_last(self):
+        self.store.put("AAPL", "minute", self.candles(0, 5000))
+        self.store.put("TSLA", "minute", self.candles(0, 5000))
+        self.store.conn.execute("UPDATE series SET accessed = 0")
+        changes = self.store.conn.total_changes
+        # Read after TSLA was stored, so TSLA goes first
+        self.store.get("AAPL", "minute", end=0, limit=1)
+        self.assertEqual(self.store.conn.total_changes, changes)
+
+        self.store.max_bytes = int(self.store.size() * 0.75)
+        self.store.put("MSFT", "minute", self.candles(0, 10))
+        self.assertIsNotNone(self.store.coverage("AAPL", "minute"))
+        self.assertIsNone(self.store.coverage("TSLA", "minute"))
+
+
+class TestAsync(unittest.IsolatedAsyncioTestCase):
+    async def test_run_off_loop(self):
+        store = CandleStore(':memory:')
+        await store.run(store.put, "AAPL", "minute", [api.Candle(t=i * 60, o=1.0, h=2.0, l=0.5, c=1.5, v=100) for i in range(10)])
+        bars = await store.run(store.get, "AAPL", "minute", 600, 5)
+        self.assertEqual([b['t'] for b in bars], [300, 360, 420, 480, 540])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,6 +10,11 @@ import pytz
 import asyncio
 import asyncclick as click
 import bot
+import os
+from candle_store import CandleStore
+from ema_state import EMAStateStore
+from loop_monitor import LoopLag
+from tdameritrade_api import TdAmeritradeAPI
 from dotenv import load_dotenv
 
 
@@ -70,10 +75,41 @@ def tstoest(t: int):
     print(tz.localize(dt).isoformat())
 
 
+@click.command()
+@click.argument('symbol')
+def invalidate(symbol: str):
+    """
+    Deletes stored bars of a symbol after a corporate action, such as a split
+    """
+    path = os.getenv("CANDLE_STORE", "candles.db")
+    CandleStore(path).invalidate(symbol)
+    EMAStateStore(path).invalidate(symbol)
+
+
+@click.command()
+@click.option('--workers', default=4, help="Threads for TD calls, 0 runs them on the event loop like before")
+@click.option('--calls', default=20, help="How many quote requests to send")
+@click.argument('symbols', nargs=-1)
+async def looplag(workers: int, calls: int, symbols):
+    """
+    Measures how long TD quote requests block the event loop
+    """
+    load_dotenv()
+    api = TdAmeritradeAPI(workers=workers)
+    lag = LoopLag(interval=0.01)
+    lag.start()
+    await asyncio.gather(*[api.get_prices(list(symbols) or ['AAPL']) for _ in range(calls)])
+    await asyncio.sleep(0.05)
+    lag.stop()
+    print(lag.stats())
+
+
 cli.add_command(save)
 cli.add_command(utctoest)
 cli.add_command(tstoest)
 cli.add_command(start_bot)
+cli.add_command(invalidate)
+cli.add_command(looplag)
 
 if __name__ == '__main__':
     cli()
\ No newline at end of file
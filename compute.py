@@ -0,0 +1,363 @@
+"""
+Compute backends for indicator math and candle aggregation over many series at once
+
+InlineBackend runs on the calling thread. PoolBackend ships the series to worker processes through one
+multiprocessing.shared_memory block, so nothing but names and offsets is pickled, and the results come back
+as numpy views into a second shared block instead of copies. Pick one with COMPUTE_BACKEND=inline or pool
+"""
+import asyncio
+import multiprocessing
+import os
+import unittest
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+import api
+import rsi
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+# Columns of the input block, every series is shipped with all of them
+COLUMNS = ("t", "o", "h", "l", "c", "v")
+# Columns of an aggregated candle
+CANDLE = COLUMNS + ("label",)
+
+Series = Dict[str, np.ndarray]
+Rule = Tuple[str, int]
+
+
+def spec_items(spec: rsi.Spec) -> List[Tuple[str, int]]:
+    return [(kind, p) for kind, periods in spec.items() for p in periods]
+
+
+def output_size(op: str, n: int, args) -> int:
+    """
+    returns floats of output the op needs for a series of n bars
+    """
+    if op == "indicators":
+        return len(spec_items(args)) * n
+    rules, _, _ = args
+    return len(rules) * len(CANDLE) * n
+
+
+def _indicators(bars: Series, spec: rsi.Spec, region: np.ndarray):
+    n = len(bars['c'])
+    if n == 0:
+        return 0
+    rows = region.reshape(-1, n)
+    result = rsi.compute(bars, spec)
+    for row, (kind, p) in enumerate(spec_items(spec)):
+        rows[row] = result[kind][p]
+    return n
+
+
+def _resample(bars: Series, args, region: np.ndarray) -> List[int]:
+    rules, session, now = args
+    n = len(bars['t'])
+    candles = api.resample(bars['t'], bars['o'], bars['h'], bars['l'], bars['c'], bars['v'], rules, session=session, now=now)
+    out = region.reshape(len(rules), len(CANDLE), n)
+    counts = []
+    for r, rule in enumerate(rules):
+        k = len(candles[rule]['t'])
+        for j, column in enumerate(CANDLE):
+            out[r, j, :k] = candles[rule][column]
+        counts.append(k)
+    return counts
+
+
+OPS = {"indicators": _indicators, "resample": _resample}
+
+
+def layout(op: str, series: List[Series], args: list) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    returns where every series starts in the input columns and in the output
+    """
+    lengths = [len(s['t']) if 't' in s else len(s['c']) for s in series]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    out_offsets = np.concatenate(([0], np.cumsum([output_size(op, n, a) for n, a in zip(lengths, args)]))).astype(np.int64)
+    return offsets, out_offsets
+
+
+def _views(op: str, out: np.ndarray, offsets: np.ndarray, out_offsets: np.ndarray, args: list, counts: list) -> list:
+    """
+    returns the result of every series as views into out
+    """
+    views = []
+    for i in range(len(offsets) - 1):
+        n = int(offsets[i + 1] - offsets[i])
+        region = out[out_offsets[i]:out_offsets[i + 1]]
+        if op == "indicators":
+            rows = region.reshape(-1, n) if n else np.empty((len(spec_items(args[i])), 0))
+            result = {}
+            for row, (kind, p) in enumerate(spec_items(args[i])):
+                result.setdefault(kind, {})[p] = rows[row]
+        else:
+            rules = args[i][0]
+            candles = region.reshape(len(rules), len(CANDLE), n)
+            result = {rule: {column: candles[r, j, :counts[i][r]] for j, column in enumerate(CANDLE)}
+                      for r, rule in enumerate(rules)}
+        views.append(result)
+    return views
+
+
+def _work(op: str, src, dst, offsets: List[int], out_offsets: List[int], args: list, lo: int, hi: int) -> list:
+    block = np.ndarray((len(COLUMNS), offsets[-1]), dtype=np.float64, buffer=src)
+    out = np.ndarray((out_offsets[-1],), dtype=np.float64, buffer=dst)
+    counts = []
+    for i in range(lo, hi):
+        bars = {k: block[j, offsets[i]:offsets[i + 1]] for j, k in enumerate(COLUMNS)}
+        counts.append(OPS[op](bars, args[i - lo], out[out_offsets[i]:out_offsets[i + 1]]))
+    return counts
+
+
+def _task(op: str, in_name: str, out_name: str, offsets: List[int], out_offsets: List[int], args: list, lo: int, hi: int) -> list:
+    """
+    Runs in a worker process, computes series lo to hi straight from the input block into the output block
+    """
+    src = SharedMemory(name=in_name)
+    dst = SharedMemory(name=out_name)
+    try:
+        # Every view of the buffers is gone once _work returns, so they can be closed
+        return _work(op, src.buf, dst.buf, offsets, out_offsets, args, lo, hi)
+    finally:
+        src.close()
+        dst.close()
+
+
+class Arrays:
+    """
+    Results of one batch, { indicator: { periods: array } } or { (timeframe, multiplier): { column: array } }
+    per series, in the order the series were passed in. Pooled results are views into shared memory, copy
+    whatever has to outlive close
+    """
+    def __init__(self, series: list, shm: Optional[SharedMemory] = None):
+        self.series = series
+        self.shm = shm
+
+    def __getitem__(self, i: int):
+        return self.series[i]
+
+    def __len__(self):
+        return len(self.series)
+
+    def __iter__(self):
+        return iter(self.series)
+
+    def __enter__(self) -> 'Arrays':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # Views have to go before the buffer they point into
+        self.series = []
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+    def __del__(self):
+        self.close()
+
+
+class Backend(ABC):
+    @abstractmethod
+    async def run(self, op: str, series: List[Series], args: list) -> Arrays:
+        """
+        op - name of the function in OPS to run
+        series - arrays or DataFrames to run it on
+        args - argument of op for every series
+
+        returns results of op for every series
+        """
+
+    async def indicators(self, series: List[Series], specs: List[rsi.Spec]) -> Arrays:
+        """
+        series - { t, o, h, l, c, v } arrays or DataFrames, oldest first. Columns an indicator does not use can be left out
+        specs - indicators and periods to compute for every series
+
+        returns { indicator: { periods: array over every bar } } per series, same as rsi.compute
+        """
+        return await self.run("indicators", series, specs)
+
+    async def resample(self, series: List[Series], rules: List[Rule], session=False, now=None) -> Arrays:
+        """
+        series - { t, o, h, l, c, v } arrays or DataFrames of base bars, sorted by t
+        rules - every (timeframe, multiplier) to aggregate each series into
+
+        returns { (timeframe, multiplier): { t, o, h, l, c, v, label } } per series, same as api.resample but
+        every column is float64
+        """
+        return await self.run("resample", series, [(rules, session, now)] * len(series))
+
+    def close(self) -> None:
+        return
+
+
+class InlineBackend(Backend):
+    """
+    Computes on the calling thread, for few series or when spare cores are not there
+    """
+    async def run(self, op: str, series: List[Series], args: list) -> Arrays:
+        offsets, out_offsets = layout(op, series, args)
+        out = np.empty(int(out_offsets[-1]))
+        counts = []
+        for i, s in enumerate(series):
+            bars = {k: np.asarray(s[k], dtype=np.float64) if k in s else np.full(int(offsets[i + 1] - offsets[i]), np.nan)
+                    for k in COLUMNS}
+            counts.append(OPS[op](bars, args[i], out[out_offsets[i]:out_offsets[i + 1]]))
+        return Arrays(_views(op, out, offsets, out_offsets, args, counts))
+
+
+class PoolBackend(Backend):
+    def __init__(self, processes=None, batch=64):
+        """
+        processes - worker processes, defaults to one per core
+        batch - series per task, each task is one round trip to a worker
+        """
+        self.batch = batch
+        # Spawned, not forked, the bot has SQLite and event loop threads a fork would copy mid-flight
+        self.pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def pack(self, series: List[Series], offsets: np.ndarray) -> SharedMemory:
+        """
+        returns shared block with every series' columns back to back
+        """
+        shm = SharedMemory(create=True, size=max(8, len(COLUMNS) * int(offsets[-1]) * 8))
+        block = np.ndarray((len(COLUMNS), int(offsets[-1])), dtype=np.float64, buffer=shm.buf)
+        for i, s in enumerate(series):
+            for j, k in enumerate(COLUMNS):
+                block[j, offsets[i]:offsets[i + 1]] = np.asarray(s[k], dtype=np.float64) if k in s else np.nan
+        del block
+        return shm
+
+    async def run(self, op: str, series: List[Series], args: list) -> Arrays:
+        if len(series) == 0:
+            return Arrays([])
+
+        offsets, out_offsets = layout(op, series, args)
+        src = self.pack(series, offsets)
+        dst = SharedMemory(create=True, size=max(8, int(out_offsets[-1]) * 8))
+        try:
+            loop = asyncio.get_running_loop()
+            tasks = [loop.run_in_executor(self.pool, _task, op, src.name, dst.name, offsets.tolist(), out_offsets.tolist(),
+                                          args[lo:lo + self.batch], lo, min(lo + self.batch, len(series)))
+                     for lo in range(0, len(series), self.batch)]
+            counts = [c for part in await asyncio.gather(*tasks) for c in part]
+        except BaseException:
+            dst.close()
+            dst.unlink()
+            raise
+        finally:
+            src.close()
+            src.unlink()
+
+        # The mapping stays until Arrays.close, the name is not needed anymore
+        dst.unlink()
+        out = np.ndarray((int(out_offsets[-1]),), dtype=np.float64, buffer=dst.buf)
+        return Arrays(_views(op, out, offsets, out_offsets, args, counts), dst)
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+
+def backend(kind=None) -> Backend:
+    """
+    kind - inline or pool, defaults to COMPUTE_BACKEND, then inline
+
+    returns compute backend, pooled with COMPUTE_PROCESSES processes, one per core if it is not set
+    """
+    kind = kind or os.getenv("COMPUTE_BACKEND", "inline")
+    if kind == "pool":
+        processes = int(os.getenv("COMPUTE_PROCESSES", 0)) or None
+        logger.info(f"Computing indicators on a pool of {processes or os.cpu_count()} processes")
+        return PoolBackend(processes=processes)
+    if kind != "inline":
+        raise ValueError(f"Unknown compute backend {kind}, use inline or pool")
+    return InlineBackend()
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = PoolBackend(processes=2, batch=16)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def series(self, count: int, seed=0) -> List[pd.DataFrame]:
+        rng = np.random.default_rng(seed)
+        result = []
+        for i in range(count):
+            n = int(rng.integers(0, 600))
+            c = 100 * np.exp(np.cumsum(rng.normal(0, 0.002, n)))
+            o = np.concatenate(([100.0], c[:-1]))[:n]
+            result.append(pd.DataFrame({
+                "t": 1704205800 + np.arange(n, dtype=np.int64) * 60,
+                "o": o, "h": np.maximum(o, c) + 0.05, "l": np.minimum(o, c) - 0.05, "c": c,
+                "v": rng.integers(100, 1000, n).astype(np.float64),
+            }))
+        return result
+
+    def segments(self) -> set:
+        return {f for f in os.listdir("/dev/shm")} if os.path.isdir("/dev/shm") else set()
+
+    async def test_indicators_same_as_inline(self):
+        series = self.series(100)
+        specs = [{"ema": [8, 21], "rsi": [14]} if i % 2 else {"atr": [14], "vwap": [0], "sma": [50]} for i in range(100)]
+        before = self.segments()
+
+        with await self.pool.indicators(series, specs) as pooled, await InlineBackend().indicators(series, specs) as inline:
+            self.assertEqual(len(pooled), 100)
+            for i in range(100):
+                expected = rsi.compute(series[i], specs[i])
+                for kind, periods in specs[i].items():
+                    for p in periods:
+                        np.testing.assert_allclose(pooled[i][kind][p], expected[kind][p], equal_nan=True)
+                        np.testing.assert_array_equal(pooled[i][kind][p], inline[i][kind][p])
+
+            # Views into the shared block, not copies
+            view = pooled[1]["ema"][8]
+            self.assertFalse(view.flags.owndata)
+            self.assertIsNotNone(pooled.shm)
+            del view
+        # Both blocks are unlinked, nothing is left behind
+        self.assertEqual(self.segments() - before, set())
+
+    async def test_resample_same_as_api(self):
+        series = self.series(40, seed=1)
+        rules = [("minute", 5), ("hour", 1)]
+        now = 1704205800 + 600 * 60
+        with await self.pool.resample(series, rules, session=True, now=now) as pooled:
+            for s, result in zip(series, pooled):
+                expected = api.resample(s['t'], s['o'], s['h'], s['l'], s['c'], s['v'], rules, session=True, now=now)
+                for rule in rules:
+                    for column in CANDLE:
+                        np.testing.assert_array_equal(result[rule][column], expected[rule][column])
+
+    async def test_seed_many_on_pool(self):
+        from ema_state import EMAEngine, EMAStateStore
+        series = [s for s in self.series(30, seed=2) if len(s) > 60]
+        inline, pooled = EMAEngine(EMAStateStore(':memory:')), EMAEngine(EMAStateStore(':memory:'))
+        await pooled.seed_many([(f"S{i}", "minute", 1, s, [8, 50]) for i, s in enumerate(series)], self.pool)
+
+        for i, s in enumerate(series):
+            self.assertEqual(pooled.history_needed(f"S{i}", "minute", 1, [8, 50], now=int(s["t"].iloc[-1])), 3)
+            expected = inline.compute(f"S{i}", "minute", 1, s, [8, 50])
+            self.assertEqual(pooled.compute(f"S{i}", "minute", 1, s, [8, 50]), expected)
+
+    async def test_empty(self):
+        with await self.pool.indicators([], []) as pooled:
+            self.assertEqual(len(pooled), 0)
+        self.assertIsInstance(backend("inline"), InlineBackend)
+        with self.assertRaises(ValueError):
+            backend("gpu")
+
+
+if __name__ == "__main__":
+    unittest.main()
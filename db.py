@@ -1,7 +1,8 @@
 from ema import EMA
 from price import Price, PriceTicket
 from abc import ABC
-from typing import Callable, Awaitable, List
+from typing import Callable, Awaitable, Dict, List, Tuple
+from rules import Rule
 from ticket import Ticket
 
 
@@ -37,6 +38,18 @@ class DB(ABC):
         """
         return
 
+    def add_rule(self, symbol: str, expression: str, channelID: int, author: int) -> str:
+        """
+        symbol - stock symbol
+        expression - conditions, such as "price crosses 150 and 1H RSI < 30"
+        channelID - discord channel ID to send alert to
+        author - discordID of who created the command
+
+        returns ticketID
+        Adds rule ticket to database
+        """
+        return
+
     # @abstractmethod
     def delete(self, id: str) ->bool:
         """
@@ -68,21 +81,69 @@ class DB(ABC):
         """
         return
 
+    def get_all_rule(self) -> List[Rule]:
+        """
+        returns all rule tickets
+        """
+        return
+
     def update_timeout(self, _id: str, timeout: int) -> None:
         """
         updates timeout of specific ticket
         """
         return
 
+    def write_batch(self, timeouts: Dict[str, int], deletes: List[str]) -> None:
+        """
+        updates timeouts and deletes tickets in one transaction
+        """
+        return
+
+    def claim_batch(self, claims: Dict[str, Tuple[int, int]]) -> List[str]:
+        """
+        updates timeouts only of tickets whose timeout is still the expected one, returns their ids
+        """
+        return []
+
+    def heartbeat(self, worker_id: str, host: str, pid: int) -> None:
+        """
+        marks a monitor worker as alive
+        """
+        return
+
+    def get_workers(self, ttl: int) -> List[str]:
+        """
+        returns ids of workers with a heartbeat in the last ttl seconds
+        """
+        return []
+
+    def remove_worker(self, worker_id: str) -> None:
+        """
+        removes a worker that is shutting down
+        """
+        return
+
     def get_price_symbols(self) -> List[str]:
         """
         Returns all symbols in price category
         """
         return ['']
 
+    def get_ema_symbols(self) -> List[str]:
+        """
+        Returns all symbols in ema category
+        """
+        return ['']
+
     def get_prices(self, symbol: str) -> List[PriceTicket]:
         """
         symbol - str of ticket to get price monitors for
         Returns all prices that are currently being monitored for that symbol
         """
-        return []
\ No newline at end of file
+        return []
+
+    def get_active_prices(self) -> Dict[str, List[PriceTicket]]:
+        """
+        Returns every price ticket that is not timed out, grouped by symbol
+        """
+        return {}
@@ -0,0 +1,261 @@
+"""
+Outbound alert queue, so a slow or rate limited channel never holds up evaluation
+"""
+import asyncio
+import time
+import unittest
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+import numpy as np
+from rate_limiter import RateLimited, TokenBucket
+from metrics import metrics
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+DELIVERED = metrics.counter("alerts_delivered_total", "Alerts delivered to a channel")
+MESSAGES = metrics.counter("alert_messages_total", "Messages sent, several alerts can share one")
+FAILED = metrics.counter("alerts_failed_total", "Alerts given up on after every delivery attempt failed")
+LATENCY = metrics.histogram("alert_delivery_seconds", "Time from an alert firing to its message being sent")
+
+# Longest message Discord accepts
+MAX_LENGTH = 2000
+
+
+class ChannelQueue:
+    """
+    Pending alerts of one channel with its own rate limit bucket, Discord limits every channel separately
+    """
+    def __init__(self, requests_per_minute: int, burst: int):
+        # (message, when it was put, ticket _id, failed attempts)
+        self.pending: Deque[Tuple[str, float, Optional[str], int]] = deque()
+        self.bucket = TokenBucket(requests_per_minute, burst=burst, name="discord")
+        self.task = None
+
+
+class AlertDispatcher:
+    def __init__(self, deliver: Callable[[int, str], Awaitable[None]], on_failed: Callable[[List[str]], Awaitable[None]] = None,
+                 requests_per_minute=60, burst=5, max_length=MAX_LENGTH, samples=2000, retries=3, retry_delay=1.0):
+        """
+        deliver - async function that sends a message to a channel, raises RateLimited on 429
+        on_failed - async function called with the ticket ids of alerts given up on, so their timeouts can be reset
+        requests_per_minute - messages per channel, Discord allows 5 every 5 seconds
+        burst - messages per channel that can be sent back to back
+        max_length - longest message, alerts are merged up to it
+        samples - how many recent delivery latencies to keep
+        retries - attempts of an alert before it is given up on, 429s are retried without counting
+        retry_delay - seconds to wait after a failed attempt, multiplied by the attempts so far
+        """
+        self.deliver = deliver
+        self.on_failed = on_failed
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.max_length = max_length
+        self.channels: Dict[int, ChannelQueue] = {}
+        self.latencies = deque(maxlen=samples)
+        self.delivered = 0
+        self.messages = 0
+        self.failed = 0
+
+    def put(self, channelID: int, message: str, _id: str = None) -> None:
+        """
+        channelID - channel to send the alert to
+        message - alert text
+        _id - ticket that alerted, given to on_failed if the alert can't be delivered
+
+        Queues the alert and returns right away, delivery happens in the channel's own task
+        """
+        queue = self.channels.get(channelID)
+        if queue is None:
+            queue = self.channels[channelID] = ChannelQueue(self.requests_per_minute, self.burst)
+
+        queue.pending.append((message, time.monotonic(), _id, 0))
+        if queue.task is None or queue.task.done():
+            queue.task = asyncio.create_task(self.run(channelID, queue))
+
+    def coalesce(self, pending: Deque[Tuple[str, float, Optional[str], int]]) -> List[Tuple[str, float, Optional[str], int]]:
+        """
+        returns the alerts at the front of pending that fit in one message, at least one
+        """
+        batch = [pending.popleft()]
+        length = len(batch[0][0])
+        while pending and length + 1 + len(pending[0][0]) <= self.max_length:
+            batch.append(pending.popleft())
+            length += 1 + len(batch[-1][0])
+        return batch
+
+    async def run(self, channelID: int, queue: ChannelQueue) -> None:
+        while queue.pending:
+            # Waiting for the bucket first lets alerts that fire meanwhile join the same message
+            await queue.bucket.acquire()
+            batch = self.coalesce(queue.pending)
+            message = "\n".join(m for m, _, _, _ in batch)
+
+            try:
+                await self.deliver(channelID, message)
+                queue.bucket.success()
+            except RateLimited as e:
+                queue.bucket.backoff(e.retry_after)
+                queue.pending.extendleft(reversed(batch))
+                continue
+            except Exception:
+                logger.error(f"Failed to deliver {len(batch)} alerts to {channelID}", exc_info=True)
+                await self.retry(channelID, queue, batch)
+                continue
+
+            now = time.monotonic()
+            self.latencies.extend(now - t for _, t, _, _ in batch)
+            for _, t, _, _ in batch:
+                LATENCY.observe(now - t)
+            DELIVERED.inc(len(batch))
+            MESSAGES.inc()
+            self.delivered += len(batch)
+            self.messages += 1
+
+    async def retry(self, channelID: int, queue: ChannelQueue, batch: List[Tuple[str, float, Optional[str], int]]) -> None:
+        """
+        Puts the alerts of a failed message back at the front of the queue, the ones out of attempts are given
+        to on_failed instead
+        """
+        retried = [(m, t, _id, attempts + 1) for m, t, _id, attempts in batch if attempts + 1 < self.retries]
+        given_up = [_id for _, _, _id, attempts in batch if attempts + 1 >= self.retries]
+        queue.pending.extendleft(reversed(retried))
+
+        if len(given_up) > 0:
+            self.failed += len(given_up)
+            FAILED.inc(len(given_up))
+            logger.error(f"Gave up on {len(given_up)} alerts to {channelID} after {self.retries} attempts")
+            ids = [_id for _id in given_up if _id is not None]
+            if self.on_failed is not None and len(ids) > 0:
+                try:
+                    await self.on_failed(ids)
+                except Exception:
+                    logger.error(f"Failed to reset timeouts of {ids}", exc_info=True)
+
+        if len(retried) > 0:
+            await asyncio.sleep(self.retry_delay * retried[0][3])
+
+    def depth(self) -> int:
+        """
+        returns alerts waiting to be delivered, over every channel
+        """
+        return sum(len(q.pending) for q in self.channels.values())
+
+    def stats(self) -> Dict[str, float]:
+        """
+        returns queue depth, delivered alerts and messages, and mean, p99 and max delivery latency in seconds
+        """
+        stats = {
+            "depth": self.depth(),
+            "channels": sum(1 for q in self.channels.values() if q.pending),
+            "delivered": self.delivered,
+            "messages": self.messages,
+            "failed": self.failed,
+            "mean": 0.0,
+            "p99": 0.0,
+            "max": 0.0,
+        }
+        if len(self.latencies) > 0:
+            latencies = np.array(self.latencies)
+            stats["mean"] = float(latencies.mean())
+            stats["p99"] = float(np.percentile(latencies, 99))
+            stats["max"] = float(latencies.max())
+        return stats
+
+    async def drain(self) -> None:
+        """
+        Waits until every queued alert is delivered
+        """
+        tasks = [q.task for q in self.channels.values() if q.task is not None]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self) -> None:
+        for q in self.channels.values():
+            if q.task is not None:
+                q.task.cancel()
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def test_slow_channel_does_not_block(self):
+        sent: Dict[int, List[str]] = {}
+
+        async def deliver(channelID: int, message: str) -> None:
+            if channelID == 1:
+                await asyncio.sleep(0.3)
+            sent.setdefault(channelID, []).append(message)
+
+        dispatcher = AlertDispatcher(deliver)
+        start = time.perf_counter()
+        dispatcher.put(1, "slow")
+        dispatcher.put(2, "fast")
+        self.assertLess(time.perf_counter() - start, 0.01)
+
+        await asyncio.sleep(0.05)
+        self.assertEqual(sent, {2: ["fast"]})
+        await dispatcher.drain()
+        self.assertEqual(sent[1], ["slow"])
+
+    async def test_coalesce(self):
+        sent = []
+
+        async def deliver(channelID: int, message: str) -> None:
+            sent.append(message)
+
+        dispatcher = AlertDispatcher(deliver, max_length=100)
+        for i in range(30):
+            dispatcher.put(1, f"AAPL near {100 + i}")
+        self.assertEqual(dispatcher.depth(), 30)
+        await dispatcher.drain()
+
+        self.assertEqual("\n".join(sent).split("\n"), [f"AAPL near {100 + i}" for i in range(30)])
+        self.assertTrue(all(len(m) <= 100 for m in sent))
+        self.assertLess(len(sent), 10)
+        stats = dispatcher.stats()
+        self.assertEqual((stats["depth"], stats["delivered"], stats["messages"]), (0, 30, len(sent)))
+
+    async def test_rate_limited_retried(self):
+        sent = []
+
+        async def deliver(channelID: int, message: str) -> None:
+            if len(sent) == 0:
+                sent.append(None)
+                raise RateLimited(retry_after=0.05)
+            sent.append(message)
+
+        dispatcher = AlertDispatcher(deliver)
+        dispatcher.put(1, "first")
+        await dispatcher.drain()
+        self.assertEqual(sent, [None, "first"])
+        self.assertGreaterEqual(dispatcher.stats()["max"], 0.05)
+
+    async def test_failed_retried_then_reset(self):
+        attempts = []
+        reset = []
+
+        async def deliver(channelID: int, message: str) -> None:
+            attempts.append((channelID, message))
+            if channelID == 1 or len(attempts) == 1:
+                raise ValueError("server error")
+
+        async def on_failed(ids: List[str]) -> None:
+            reset.extend(ids)
+
+        dispatcher = AlertDispatcher(deliver, on_failed, retries=3, retry_delay=0.01)
+        dispatcher.put(2, "flaky", "price_1")
+        await dispatcher.drain()
+        self.assertEqual(attempts, [(2, "flaky"), (2, "flaky")])
+        self.assertEqual((reset, dispatcher.stats()["delivered"]), ([], 1))
+
+        attempts.clear()
+        dispatcher.put(1, "broken", "price_2")
+        dispatcher.put(1, "also broken", "ema_3")
+        await dispatcher.drain()
+        self.assertEqual(attempts, [(1, "broken\nalso broken")] * 3)
+        self.assertEqual(reset, ["price_2", "ema_3"])
+        self.assertEqual((dispatcher.depth(), dispatcher.stats()["failed"]), (0, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,46 +1,32 @@
 import api
 from alpaca_v1 import Alpaca_V1 as API
-import talib
+from ema_state import EMAEngine, candles_to_seconds, ema_series
 import unittest
 import pandas as pd
-from typing import Callable, Awaitable
+from typing import Callable, Awaitable, Dict, List, Tuple
 from ticket import Ticket
 import time
 from custom_logger import get_logger
 
 logger = get_logger(__name__)
 
-def get(candles: pd.DataFrame, periods: int):
+def get(candles: pd.DataFrame, periods):
     """
     candles - python dataframe of candles to use to calculate EMA
-    periods - How many candles to use for EMA calculation
+    periods - How many candles to use for EMA calculation, or a list of them to compute in one pass
 
-    Adds EMA column to candles dataframe
+    Adds EMA column to candles dataframe for every periods
     """
-    c = candles['c'].iloc[:]
-    ema = talib.EMA(c, periods)
-    candles[f"{periods}EMA"] = ema
+    if isinstance(periods, int):
+        periods = [periods]
 
+    series = ema_series(candles['c'].to_numpy(), periods)
+    for p, ema in series.items():
+        candles[f"{p}EMA"] = ema
 
-def candles_to_seconds(timeframe: str, multiplier: int) -> int:
-    """
-    timeframe - minute, hour, day, week, month
-    multiplier - how many timeframes
-    returns candle in seconds
-    """
-    if timeframe == 'minute':
-        return multiplier * 60
-    if timeframe == 'hour':
-        return multiplier * 3600
-    if timeframe == 'day':
-        return multiplier * 3600 * 24
-    if timeframe == 'week':
-        return multiplier * 3600 * 24 * 7
-    if timeframe == 'month':
-        return multiplier * 3600 * 24 * 30
 
 class EMA(Ticket):
-    def __init__(self, symbol: str, timeframe: str, periods: int, channelID: int, author: int, _id: str, multiplier=1, margin=0.001):
+    def __init__(self, symbol: str, timeframe: str, periods: int, channelID: int, author: int, _id: str, multiplier=1, margin=0.001, cooldown=0):
         """
         symbol - of the stock
         timeframe - which candle to use, minute, hour, day, week, month
@@ -50,6 +36,7 @@ class EMA(Ticket):
         id - str ID
         multiplier - how many timeframes to use, ex put 4 for 4 hour candles
         margin - how far the ema and price of stock can be
+        cooldown - UNIX time the ticket can alert again after it was hit
         """
         super().__init__(channelID, author, _id)
         self.symbol = symbol
@@ -57,32 +44,42 @@ class EMA(Ticket):
         self.multiplier = multiplier
         self.periods = periods
         self.margin = margin
+        self.cooldown = cooldown
 
     def __str__(self):
         return f"{self._id}: {self.symbol} to hit {self.periods}EMA on the {self.multiplier}{self.timeframe} candle"
 
-    async def monitor(self, api: api.API, callback: Callable[[str], Awaitable[None]]) -> Awaitable[None]:
+    async def monitor(self, api: api.API, callback: Callable[[str], Awaitable[None]], engine=None) -> Awaitable[None]:
         """
         callback - async function to call if the ticket should be alerted
+        engine - EMAEngine keeping the EMA state of the series, without it the EMA is computed over the whole window
 
         Sees if the current EMA ticket should be alerted
         """
         current_time = time.time()
+        limit = self.periods
+        if engine is not None:
+            limit = engine.history_needed(self.symbol, self.timeframe, self.multiplier, [self.periods], now=current_time)
+
         candles = await api.get_bars(
             self.symbol,
             self.timeframe,
             self.multiplier,
-            limit=self.periods,
+            limit=limit,
             t=current_time
         )
-        get(candles, self.periods)
+
+        if engine is None:
+            get(candles, self.periods)
+            ema = candles[f"{self.periods}EMA"].values[-1]
+        else:
+            ema = engine.compute(self.symbol, self.timeframe, self.multiplier, candles, [self.periods])[self.periods]
 
         current = candles.tail(1)
         high_price = current['h'].values[0]
         low_price = current['l'].values[0]
-        ema = current[f"{self.periods}EMA"].values[0]
 
-        if (ema < high_price * (1 + self.margin)) and (ema < low_price * (1 - self.margin)):
+        if self.hit(ema, high_price, low_price):
             logger.info(f"{self.symbol} @ EMA {ema}. TS: {current.iloc[-1]['t']}. Sys: {current_time}")
             await callback(str(self))
         else:
@@ -90,12 +87,102 @@ class EMA(Ticket):
 
         return
 
+    def hit(self, ema: float, high_price: float, low_price: float) -> bool:
+        """
+        returns whether the EMA is within the candle's range, widened by margin
+        """
+        return low_price * (1 - self.margin) < ema < high_price * (1 + self.margin)
+
     def timeout(self):
         """
         returns 2 candle bar delay
         """
         return 2 * candles_to_seconds(self.timeframe, self.multiplier)
 
+
+class EMAGroup:
+    """
+    EMA tickets that share the same bars, so the bars are fetched once for all of them
+    """
+    def __init__(self, symbol: str, timeframe: str, multiplier: int, tickets: List[EMA]):
+        """
+        symbol - of the stock
+        timeframe - which candle to use, minute, hour, day, week, month
+        multiplier - how many timeframes to use
+        tickets - every EMA ticket on that series
+        """
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.multiplier = multiplier
+        self.tickets = tickets
+
+    def __str__(self):
+        return f"{self.symbol} {self.multiplier}{self.timeframe}: {len(self.tickets)} tickets"
+
+    @staticmethod
+    def group(tickets: List[EMA]) -> List['EMAGroup']:
+        """
+        returns tickets grouped by (symbol, timeframe, multiplier)
+        """
+        grouped: Dict[Tuple[str, str, int], List[EMA]] = {}
+        for t in tickets:
+            grouped.setdefault((t.symbol, t.timeframe, t.multiplier), []).append(t)
+
+        return [EMAGroup(symbol, timeframe, multiplier, t) for (symbol, timeframe, multiplier), t in grouped.items()]
+
+    async def monitor(self, api: api.API, callback: Callable[[str, int, int, str, int], Awaitable[None]], engine=None) -> None:
+        """
+        api - API to fetch bars
+        callback - function to call if a ticket's EMA is hit
+        engine - EMAEngine keeping the EMA state of the series, without it the EMA is computed over the whole window
+
+        Fetches the bars once and checks every period and margin of the group
+        """
+        current_time = time.time()
+        candles = await self.fetch(api, engine, current_time)
+        await self.check(candles, callback, engine, current_time)
+
+    def periods(self) -> List[int]:
+        return sorted({t.periods for t in self.tickets})
+
+    async def fetch(self, api: api.API, engine=None, current_time=None) -> pd.DataFrame:
+        """
+        returns bars of the group's series, as many as the EMAs need
+        """
+        periods = self.periods()
+        if engine is None:
+            limit = max(periods)
+        else:
+            limit = engine.history_needed(self.symbol, self.timeframe, self.multiplier, periods, now=current_time)
+
+        return await api.get_bars(self.symbol, self.timeframe, self.multiplier, limit=limit, t=current_time or time.time())
+
+    async def check(self, candles: pd.DataFrame, callback: Callable[[str, int, int, str, int], Awaitable[None]], engine=None, current_time=None) -> None:
+        """
+        candles - bars from fetch
+
+        Computes every period of the group and calls callback for every ticket that is hit
+        """
+        if current_time is None:
+            current_time = time.time()
+        periods = self.periods()
+
+        if engine is None:
+            get(candles, periods)
+            emas = {p: candles[f"{p}EMA"].values[-1] for p in periods}
+        else:
+            emas = engine.compute(self.symbol, self.timeframe, self.multiplier, candles, periods)
+
+        current = candles.iloc[-1]
+        logger.debug(f"{self} EMAs {emas}. Price is {current['c']}. TS: {current['t']}. Sys: {current_time}")
+
+        for t in self.tickets:
+            ema = emas[t.periods]
+            if t.hit(ema, current['h'], current['l']):
+                logger.info(f"{self.symbol} @ {t.periods}EMA {ema}. TS: {current['t']}. Sys: {current_time}")
+                await callback(f"{self.symbol} hit {t.periods}EMA ({ema:.2f}) on the {self.multiplier}{self.timeframe} candle. TS: {current['t']}. Sys: {current_time}",
+                               t.channelID, t.author, t._id, t.timeout())
+
 class Test(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
         self.api = API()
@@ -123,5 +210,45 @@ class Test(unittest.IsolatedAsyncioTestCase):
         await self.api.session.close()
 
 
+class TestEMAGroup(unittest.IsolatedAsyncioTestCase):
+    async def test_one_fetch_per_series(self):
+        calls = []
+
+        class Fake(api.API):
+            def __init__(self):
+                pass
+
+            async def get_bars(self, symbol: str, timeframe: str, multiplier: int, limit: int, t=None) -> pd.DataFrame:
+                calls.append((symbol, timeframe, multiplier, limit))
+                c = [100.0] * limit
+                return pd.DataFrame({"t": range(limit), "o": c, "h": [101.0] * limit, "l": [99.0] * limit, "c": c, "v": [1] * limit})
+
+        tickets = [
+            EMA('AAPL', 'hour', 8, channelID=1, author=2, _id='ema_1'),
+            EMA('AAPL', 'hour', 21, channelID=1, author=3, _id='ema_2'),
+            EMA('AAPL', 'hour', 21, channelID=1, author=4, _id='ema_3', multiplier=4),
+            EMA('TSLA', 'day', 50, channelID=1, author=2, _id='ema_4'),
+        ]
+        alerts = []
+
+        async def send(message: str, channelID: int, authorID: int, _id: str, calculated_timeout: int) -> None:
+            alerts.append(_id)
+
+        groups = EMAGroup.group(tickets)
+        self.assertEqual(len(groups), 3)
+        for g in groups:
+            await g.monitor(Fake(), send)
+
+        self.assertEqual(sorted(calls), [('AAPL', 'hour', 1, 21), ('AAPL', 'hour', 4, 21), ('TSLA', 'day', 1, 50)])
+        self.assertEqual(sorted(alerts), ['ema_1', 'ema_2', 'ema_3', 'ema_4'])
+
+    async def test_hit(self):
+        ticket = EMA('AAPL', 'hour', 8, channelID=1, author=2, _id='ema_1', margin=0.01)
+        self.assertTrue(ticket.hit(100, 101, 99))
+        self.assertTrue(ticket.hit(101.5, 101, 99))
+        self.assertFalse(ticket.hit(105, 101, 99))
+        self.assertFalse(ticket.hit(95, 101, 99))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,307 @@
+"""
+Incremental EMA, keeps the last EMA value of every series so a new bar only costs one update
+"""
+import sqlite3
+import time
+import unittest
+from typing import Dict, List, Optional, Tuple, TypedDict
+import numpy as np
+import pandas as pd
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+# How many times periods of history is used to seed a cold start, the seed SMA is forgotten after a few periods
+WARMUP = 4
+
+
+class EMAState(TypedDict):
+    value: float
+    t: int
+
+
+def candles_to_seconds(timeframe: str, multiplier: int) -> int:
+    """
+    timeframe - minute, hour, day, week, month
+    multiplier - how many timeframes
+    returns candle in seconds
+    """
+    if timeframe == 'minute':
+        return multiplier * 60
+    if timeframe == 'hour':
+        return multiplier * 3600
+    if timeframe == 'day':
+        return multiplier * 3600 * 24
+    if timeframe == 'week':
+        return multiplier * 3600 * 24 * 7
+    if timeframe == 'month':
+        return multiplier * 3600 * 24 * 30
+
+
+def alpha(periods: int) -> float:
+    return 2 / (periods + 1)
+
+
+def ema_series(closes: np.ndarray, periods: List[int]) -> Dict[int, np.ndarray]:
+    """
+    closes - close prices, oldest first
+    periods - every EMA length to compute
+
+    returns { periods: EMA array }, NaN until there are enough closes. Seeded with the SMA of the first
+    {periods} closes, same as talib.EMA. Every period is computed in the same pass over closes
+    """
+    closes = np.asarray(closes, dtype=np.float64)
+    p = np.asarray(periods)
+    n = len(closes)
+    out = np.full((len(p), n), np.nan)
+
+    a = 2 / (p + 1)
+    seeded = np.zeros(len(p), dtype=bool)
+    value = np.zeros(len(p))
+    csum = np.concatenate(([0.0], np.cumsum(closes)))
+
+    for i in range(n):
+        start = (~seeded) & (p == i + 1)
+        if start.any():
+            value[start] = csum[i + 1] / p[start]
+            seeded |= start
+        value = np.where(seeded & ~start, a * closes[i] + (1 - a) * value, value)
+        out[:, i] = np.where(seeded, value, np.nan)
+
+    return {periods[j]: out[j] for j in range(len(p))}
+
+
+def update(state: EMAState, close: float, t: int, periods: int) -> EMAState:
+    """
+    state - EMA of the previous closed bar
+    close - close of the newly closed bar
+    t - timestamp of the newly closed bar
+
+    returns EMA including the new bar
+    """
+    a = alpha(periods)
+    return EMAState(value=a * close + (1 - a) * state['value'], t=t)
+
+
+class EMAStateStore:
+    def __init__(self, path: str):
+        """
+        path - sqlite file to keep EMA states in
+        """
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS
+                ema_state (
+                    symbol TEXT,
+                    timeframe TEXT,
+                    multiplier INTEGER,
+                    periods INTEGER,
+                    value FLOAT,
+                    t INTEGER,
+                    PRIMARY KEY (symbol, timeframe, multiplier, periods)
+                )
+            """
+        )
+        self.conn.commit()
+        self.cache: Dict[Tuple[str, str, int, int], EMAState] = {}
+
+    def get(self, symbol: str, timeframe: str, multiplier: int, periods: int) -> Optional[EMAState]:
+        key = (symbol, timeframe, multiplier, periods)
+        if key not in self.cache:
+            row = self.conn.execute(
+                "SELECT value, t FROM ema_state WHERE symbol = ? AND timeframe = ? AND multiplier = ? AND periods = ?",
+                key
+            ).fetchone()
+            if row is None:
+                return None
+            self.cache[key] = EMAState(value=row[0], t=row[1])
+        return self.cache[key]
+
+    def put(self, symbol: str, timeframe: str, multiplier: int, periods: int, state: EMAState) -> None:
+        key = (symbol, timeframe, multiplier, periods)
+        self.cache[key] = state
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ema_state VALUES (?, ?, ?, ?, ?, ?)",
+            key + (state['value'], state['t'])
+        )
+        self.conn.commit()
+
+    def delete(self, symbol: str, timeframe: str, multiplier: int, periods: int) -> None:
+        key = (symbol, timeframe, multiplier, periods)
+        self.cache.pop(key, None)
+        self.conn.execute("DELETE FROM ema_state WHERE symbol = ? AND timeframe = ? AND multiplier = ? AND periods = ?", key)
+        self.conn.commit()
+
+    def invalidate(self, symbol: str) -> None:
+        """
+        symbol - stock symbol that had a corporate action, such as a split
+        """
+        self.cache = {k: v for k, v in self.cache.items() if k[0] != symbol}
+        self.conn.execute("DELETE FROM ema_state WHERE symbol = ?", (symbol,))
+        self.conn.commit()
+
+
+class EMAEngine:
+    """
+    Keeps EMA states up to date from bars. The last bar is treated as in progress, it is included in the
+    returned EMA but only stored once a newer bar closes it
+    """
+    def __init__(self, store: EMAStateStore):
+        self.store = store
+
+    def history_needed(self, symbol: str, timeframe: str, multiplier: int, periods: List[int], now=None) -> int:
+        """
+        now - UNIX time of the bar in progress, defaults to now
+
+        returns how many bars compute needs, enough to reach back to the oldest stored state, a few when every state
+        is up to date. Enough to seed if a state is missing or further back than that
+        """
+        warmup = max(periods) * WARMUP
+        states = [self.store.get(symbol, timeframe, multiplier, p) for p in periods]
+        if any(s is None for s in states):
+            return warmup
+
+        if now is None:
+            now = time.time()
+        # Counted in wall time, so nights and weekends only make the fetch larger than needed
+        behind = int((now - min(s['t'] for s in states)) // candles_to_seconds(timeframe, multiplier))
+        # The oldest state's bar, every bar up to the one in progress and one more in case a bar closes meanwhile
+        return min(max(3, behind + 2), warmup)
+
+    @staticmethod
+    def stale(state: Optional[EMAState], t: np.ndarray) -> bool:
+        """
+        state - stored state of a series
+        t - timestamps of its bars, the last one in progress
+
+        returns whether the state has to be seeded again. It has to be one of the closed bars, otherwise there is a gap
+        """
+        closed = len(t) - 1
+        return state is None or closed < 1 or state['t'] < t[0] or state['t'] > t[closed - 1]
+
+    async def seed_many(self, items: List[Tuple[str, str, int, pd.DataFrame, List[int]]], backend) -> None:
+        """
+        items - (symbol, timeframe, multiplier, candles, periods) of the series about to be computed
+        backend - compute backend, see compute.py, every cold series is seeded on it in one batch
+
+        Stores the EMA of the last closed bar of every cold period, compute then only updates them
+        """
+        cold = []
+        for symbol, timeframe, multiplier, candles, periods in items:
+            t = candles['t'].to_numpy().astype(np.int64)
+            stale = [p for p in periods if self.stale(self.store.get(symbol, timeframe, multiplier, p), t) and len(t) - 1 >= p]
+            if stale:
+                cold.append((symbol, timeframe, multiplier, t, candles['c'].to_numpy(dtype=np.float64), stale))
+        if not cold:
+            return
+
+        logger.info(f"Seeding {sum(len(x[-1]) for x in cold)} EMAs of {len(cold)} series")
+        closes = [{"t": t[:-1], "c": c[:-1]} for _, _, _, t, c, _ in cold]
+        with await backend.indicators(closes, [{"ema": stale} for *_, stale in cold]) as seeded:
+            for (symbol, timeframe, multiplier, t, _, stale), result in zip(cold, seeded):
+                for p in stale:
+                    self.store.put(symbol, timeframe, multiplier, p, EMAState(value=float(result["ema"][p][-1]), t=int(t[-2])))
+
+    def compute(self, symbol: str, timeframe: str, multiplier: int, candles: pd.DataFrame, periods: List[int]) -> Dict[int, float]:
+        """
+        candles - aggregated bars of the series, oldest first, last one in progress
+        periods - every EMA length to compute
+
+        returns { periods: EMA of the in progress bar }, NaN if there is not enough history
+        """
+        t = candles['t'].to_numpy().astype(np.int64)
+        c = candles['c'].to_numpy(dtype=np.float64)
+        closed = len(c) - 1
+
+        result = {}
+        cold = []
+        for p in periods:
+            state = self.store.get(symbol, timeframe, multiplier, p)
+            if self.stale(state, t):
+                cold.append(p)
+                continue
+
+            for i in np.flatnonzero(t[:closed] > state['t']):
+                state = update(state, c[i], int(t[i]), p)
+            self.store.put(symbol, timeframe, multiplier, p, state)
+            result[p] = update(state, c[-1], int(t[-1]), p)['value']
+
+        if cold:
+            logger.info(f"Seeding {cold} EMA of {symbol} {multiplier}{timeframe} from {closed} bars")
+            series = ema_series(c, cold)
+            for p in cold:
+                if closed >= p:
+                    self.store.put(symbol, timeframe, multiplier, p, EMAState(value=float(series[p][closed - 1]), t=int(t[closed - 1])))
+                else:
+                    # Too few bars to seed, such as a state left behind by a gap, the next fetch is sized to seed it
+                    self.store.delete(symbol, timeframe, multiplier, p)
+                result[p] = float(series[p][-1])
+
+        return result
+
+
+class Test(unittest.TestCase):
+    def candles(self, n: int, seed=0) -> pd.DataFrame:
+        rng = np.random.default_rng(seed)
+        c = 100 + np.cumsum(rng.normal(0, 1, n))
+        return pd.DataFrame({"t": np.arange(n) * 3600, "c": c})
+
+    def test_same_as_talib(self):
+        import talib
+        closes = self.candles(500)['c'].to_numpy()
+        series = ema_series(closes, [8, 21, 50, 200])
+        for p, values in series.items():
+            np.testing.assert_allclose(values, talib.EMA(closes, p), equal_nan=True)
+
+    def test_incremental_same_as_full(self):
+        candles = self.candles(400)
+        engine = EMAEngine(EMAStateStore(':memory:'))
+
+        self.assertEqual(engine.history_needed("AAPL", "hour", 1, [8, 50]), 200)
+        engine.compute("AAPL", "hour", 1, candles.iloc[:300], [8, 50])
+        self.assertEqual(engine.history_needed("AAPL", "hour", 1, [8, 50], now=candles["t"].iloc[299] + 1800), 3)
+
+        for end in range(301, 400):
+            # Only the last few bars are passed in once the state is stored
+            result = engine.compute("AAPL", "hour", 1, candles.iloc[end - 3:end], [8, 50])
+
+        full = ema_series(candles['c'].to_numpy(), [8, 50])
+        self.assertAlmostEqual(result[8], full[8][398])
+        self.assertAlmostEqual(result[50], full[50][398])
+
+    def test_skipped_bars(self):
+        candles = self.candles(400)
+        full = ema_series(candles['c'].to_numpy(), [8, 50])
+        engine = EMAEngine(EMAStateStore(':memory:'))
+        engine.compute("AAPL", "hour", 1, candles.iloc[:250], [8, 50])
+
+        # Cycles missed while the bot was down or the ticket cooled down
+        for end, skipped in ((253, 2), (259, 5), (300, 40), (400, 99)):
+            # The in progress bar of the cycle is at t of bar end - 1
+            limit = engine.history_needed("AAPL", "hour", 1, [8, 50], now=candles['t'].iloc[end - 1])
+            self.assertGreaterEqual(limit, skipped + 2)
+            result = engine.compute("AAPL", "hour", 1, candles.iloc[end - limit:end], [8, 50])
+            self.assertAlmostEqual(result[8], full[8][end - 1])
+            self.assertFalse(np.isnan(result[50]))
+
+    def test_unseedable_state_dropped(self):
+        candles = self.candles(400)
+        engine = EMAEngine(EMAStateStore(':memory:'))
+        engine.compute("AAPL", "hour", 1, candles.iloc[:250], [8])
+        result = engine.compute("AAPL", "hour", 1, candles.iloc[300:303], [8])
+        self.assertTrue(np.isnan(result[8]))
+        self.assertEqual(engine.history_needed("AAPL", "hour", 1, [8], now=candles['t'].iloc[303]), 32)
+        result = engine.compute("AAPL", "hour", 1, candles.iloc[272:304], [8])
+        self.assertFalse(np.isnan(result[8]))
+
+    def test_gap_reseeds(self):
+        candles = self.candles(400)
+        engine = EMAEngine(EMAStateStore(':memory:'))
+        engine.compute("AAPL", "hour", 1, candles.iloc[:100], [8])
+        result = engine.compute("AAPL", "hour", 1, candles.iloc[200:300], [8])
+        self.assertAlmostEqual(result[8], ema_series(candles['c'].to_numpy()[200:300], [8])[8][-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
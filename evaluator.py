@@ -0,0 +1,222 @@
+"""
+Evaluates tickets for many symbols at once
+"""
+import asyncio
+import time
+import unittest
+from typing import Awaitable, Callable, Dict, Iterable, List, Tuple, TypeVar
+import pandas as pd
+import api
+from price import Price, PriceBook, PriceLevels, PriceTicket
+from ema import EMA, EMAGroup
+from metrics import metrics
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+EVALUATED = metrics.counter("tickets_evaluated_total", "Tickets checked against a quote or bars")
+UNCHANGED = metrics.counter("quotes_unchanged_total", "Symbols not checked again since their quote is the one they were last checked against")
+
+T = TypeVar('T')
+
+
+class Evaluator:
+    def __init__(self, api: api.API, concurrency=8):
+        """
+        api - provider to fetch quotes from, its own rate limiter paces the requests
+        concurrency - max amount of requests in flight at once
+        """
+        self.api = api
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # symbol -> (time of the quote last checked, its tickets, their version, until when that quote can not trigger them)
+        self.checked: Dict[str, Tuple[int, PriceLevels, int, float]] = {}
+
+    async def fan_out(self, items: Iterable[T], fn: Callable[[T], Awaitable[None]]) -> None:
+        """
+        items - things to run fn on, such as symbols or chunks of symbols
+        fn - async function to call for every item
+
+        Runs fn for every item concurrently, with at most {concurrency} running at once. Errors are logged, not raised
+        """
+        async def run(item: T) -> None:
+            async with self.semaphore:
+                try:
+                    await fn(item)
+                except Exception:
+                    logger.error(f"Failed to evaluate {item}", exc_info=True)
+
+        await asyncio.gather(*[run(item) for item in items])
+
+    async def monitor_prices(self, symbols: List[str], get_levels: Callable[[str], PriceLevels],
+                             callback: Callable[[str, int, int, str, int], Awaitable[None]],
+                             observe: Callable[[str, api.Price], None] = None) -> None:
+        """
+        symbols - every symbol with price tickets
+        get_levels - returns the indexed price tickets of a symbol
+        callback - function to call if price hit
+        observe - optional, called with every fetched quote, such as Scheduler.observe
+
+        Fetches quotes in chunks of the provider's batch size, concurrently, and checks every symbol's tickets.
+        A symbol is skipped if its quote has the same timestamp as the one last checked, unless its tickets changed
+        or one of them came off its timeout since
+        """
+        async def evaluate(batch: List[str]) -> None:
+            current_time = time.time()
+            quotes = await self.api.get_prices(batch, t=current_time)
+
+            for symbol in batch:
+                if symbol not in quotes:
+                    logger.error(f"No price returned for {symbol}")
+                    continue
+
+                quote = quotes[symbol]
+                levels = get_levels(symbol)
+                if observe is not None:
+                    observe(symbol, quote)
+
+                last = self.checked.get(symbol)
+                if last is not None and last[0] == quote['t'] and last[1] is levels and last[2] == levels.version and current_time <= last[3]:
+                    UNCHANGED.inc()
+                    continue
+
+                m = Price(symbol, levels=levels)
+                EVALUATED.inc(len(m.levels), kind="price")
+                try:
+                    await m.check(quote, callback, current_time)
+                except Exception:
+                    logger.error(f"Failed to monitor price for {symbol}", exc_info=True)
+                    continue
+                self.checked[symbol] = (quote['t'], levels, levels.version, levels.quiet_until(quote['p']))
+
+        await self.fan_out(api.chunk(symbols, self.api.batch_size), evaluate)
+
+    async def monitor_emas(self, tickets: List[EMA], callback: Callable[[str, int, int, str, int], Awaitable[None]], engine=None, backend=None) -> None:
+        """
+        tickets - every active EMA ticket
+        callback - function to call if an EMA is hit
+        engine - EMAEngine keeping the EMA state of the series
+        backend - compute backend, see compute.py. With it and an engine, bars of every group are fetched first
+                  and every cold series is seeded in one batch on the backend, instead of one at a time on the event loop
+
+        Groups tickets by (symbol, timeframe, multiplier) and evaluates every group concurrently, one bar fetch per group
+        """
+        groups = EMAGroup.group(tickets)
+        if engine is None or backend is None:
+            async def evaluate(group: EMAGroup) -> None:
+                await group.monitor(self.api, callback, engine)
+                EVALUATED.inc(len(group.tickets), kind="ema")
+
+            await self.fan_out(groups, evaluate)
+            return
+
+        current_time = time.time()
+        fetched: Dict[int, pd.DataFrame] = {}
+
+        async def fetch(i: int) -> None:
+            fetched[i] = await groups[i].fetch(self.api, engine, current_time)
+
+        await self.fan_out(range(len(groups)), fetch)
+        await engine.seed_many([(groups[i].symbol, groups[i].timeframe, groups[i].multiplier, candles, groups[i].periods())
+                                for i, candles in fetched.items()], backend)
+
+        for i, candles in fetched.items():
+            try:
+                await groups[i].check(candles, callback, engine, current_time)
+                EVALUATED.inc(len(groups[i].tickets), kind="ema")
+            except Exception:
+                logger.error(f"Failed to evaluate {groups[i]}", exc_info=True)
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def test_monitor_prices(self):
+        class Fake(api.API):
+            batch_size = 1
+
+            def __init__(self):
+                self.in_flight = 0
+                self.max_in_flight = 0
+
+            async def get_price(self, symbol: str, t=None) -> api.Price:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                await asyncio.sleep(0.01)
+                self.in_flight -= 1
+                return api.Price(t=1, p=100.0)
+
+        fake = Fake()
+        evaluator = Evaluator(fake, concurrency=4)
+        symbols = [f"S{i}" for i in range(20)]
+        alerts = []
+
+        def get_levels(symbol: str) -> PriceLevels:
+            return PriceLevels([PriceTicket(_id=f"price_{symbol}", symbol=symbol, price=100.5, margin=1.0, channelID=1, authorID=2, timeout=0)])
+
+        async def send(message: str, channelID: int, authorID: int, _id: str, calculated_timeout: int) -> None:
+            alerts.append(_id)
+
+        await evaluator.monitor_prices(symbols, get_levels, send)
+
+        self.assertEqual(sorted(alerts), sorted(f"price_{s}" for s in symbols))
+        self.assertEqual(fake.max_in_flight, 4)
+
+    async def test_unchanged_quote_skipped(self):
+        class Still(api.API):
+            batch_size = 10
+
+            def __init__(self):
+                pass
+
+            async def get_prices(self, symbols: List[str], t=None) -> Dict[str, api.Price]:
+                return {s: api.Price(t=1, p=100.0) for s in symbols}
+
+        book = PriceBook([PriceTicket(_id="price_1", symbol="AAPL", price=100.5, margin=1.0, channelID=1, authorID=2, timeout=0)])
+        alerts = []
+
+        async def send(message: str, channelID: int, authorID: int, _id: str, calculated_timeout: int) -> None:
+            alerts.append(_id)
+            book.update_timeout(_id, int(time.time()) + calculated_timeout)
+
+        evaluator = Evaluator(Still())
+        for _ in range(3):
+            await evaluator.monitor_prices(["AAPL"], book.get, send)
+        self.assertEqual(alerts, ["price_1"])
+        self.assertEqual(evaluator.checked["AAPL"][3], book.get("AAPL").tickets["price_1"]['timeout'])
+
+        # A new ticket is checked against the same quote
+        book.add(PriceTicket(_id="price_2", symbol="AAPL", price=99.5, margin=1.0, channelID=1, authorID=2, timeout=0))
+        await evaluator.monitor_prices(["AAPL"], book.get, send)
+        self.assertEqual(alerts, ["price_1", "price_2"])
+
+        # So is one whose timeout ended
+        book.update_timeout("price_1", 0)
+        await evaluator.monitor_prices(["AAPL"], book.get, send)
+        self.assertEqual(alerts, ["price_1", "price_2", "price_1"])
+
+    async def test_monitor_emas_seeded_in_batch(self):
+        from compute import InlineBackend
+        from ema_state import EMAEngine, EMAStateStore
+        from sim_api import SimulatedAPI
+
+        tickets = [EMA(f"S{i}", tf, p, channelID=1, author=2, _id=f"ema_{i}_{tf}_{p}", margin=0.01)
+                   for i in range(10) for tf in ("hour", "day") for p in (8, 50)]
+        t = time.time()
+        results = []
+        for backend in (None, InlineBackend()):
+            alerts = []
+
+            async def send(message: str, channelID: int, authorID: int, _id: str, calculated_timeout: int) -> None:
+                alerts.append((_id, message.split(" on ")[0]))
+
+            engine = EMAEngine(EMAStateStore(':memory:'))
+            evaluator = Evaluator(SimulatedAPI(latency=0, jitter=0))
+            await evaluator.monitor_emas(tickets, send, engine, backend=backend)
+            results.append(sorted(alerts))
+            self.assertEqual(engine.history_needed("S0", "hour", 1, [8, 50]), 3)
+
+        self.assertGreater(len(results[0]), 0)
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
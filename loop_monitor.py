@@ -0,0 +1,81 @@
+"""
+Measures how long the event loop is blocked, such as by synchronous HTTP calls
+"""
+import asyncio
+import time
+import unittest
+from collections import deque
+from typing import Dict
+import numpy as np
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class LoopLag:
+    def __init__(self, interval=0.05, samples=2000):
+        """
+        interval - seconds between checks
+        samples - how many recent measurements to keep
+        """
+        self.interval = interval
+        self.lags = deque(maxlen=samples)
+        self.task = None
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self) -> None:
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            # Anything over the interval is time the loop could not run this coroutine
+            self.lags.append(max(0.0, time.perf_counter() - before - self.interval))
+
+    def stats(self) -> Dict[str, float]:
+        """
+        returns mean, p99 and max lag in seconds over the recent samples
+        """
+        if len(self.lags) == 0:
+            return {"samples": 0, "mean": 0.0, "p99": 0.0, "max": 0.0}
+
+        lags = np.array(self.lags)
+        return {
+            "samples": len(lags),
+            "mean": float(lags.mean()),
+            "p99": float(np.percentile(lags, 99)),
+            "max": float(lags.max()),
+        }
+
+    def reset(self) -> None:
+        self.lags.clear()
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def test_blocking_vs_executor(self):
+        lag = LoopLag(interval=0.01)
+        lag.start()
+        await asyncio.sleep(0.05)
+
+        time.sleep(0.2)
+        await asyncio.sleep(0.05)
+        blocked = lag.stats()
+
+        lag.reset()
+        await asyncio.get_running_loop().run_in_executor(None, time.sleep, 0.2)
+        await asyncio.sleep(0.05)
+        offloaded = lag.stats()
+        lag.stop()
+
+        self.assertGreater(blocked["max"], 0.15)
+        self.assertLess(offloaded["max"], 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,246 @@
+"""
+NYSE regular sessions, precomputed a year at a time so checking whether the market is open is a lookup
+"""
+import time
+import unittest
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Set, Tuple
+import pytz
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+tz = pytz.timezone('America/New_York')
+
+DAY = 86400
+OPEN = (9, 30)
+CLOSE = (16, 0)
+EARLY_CLOSE = (13, 0)
+
+
+def nth_weekday(year: int, month: int, weekday: int, n: int) -> date:
+    """
+    weekday - 0 is Monday
+    n - 1 for the first, -1 for the last
+
+    returns the nth weekday of the month
+    """
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def easter(year: int) -> date:
+    """
+    returns Easter Sunday, anonymous Gregorian algorithm
+    """
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def observed(day: date) -> date:
+    """
+    returns the weekday a holiday is observed on, Saturday moves to Friday and Sunday to Monday
+    """
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+def holidays(year: int) -> Set[date]:
+    """
+    returns the days NYSE is closed in year, other than weekends
+    """
+    days = {
+        nth_weekday(year, 1, 0, 3),      # Martin Luther King Jr. Day
+        nth_weekday(year, 2, 0, 3),      # Washington's Birthday
+        easter(year) - timedelta(days=2),  # Good Friday
+        nth_weekday(year, 5, 0, -1),     # Memorial Day
+        observed(date(year, 7, 4)),      # Independence Day
+        nth_weekday(year, 9, 0, 1),      # Labor Day
+        nth_weekday(year, 11, 3, 4),     # Thanksgiving
+        observed(date(year, 12, 25)),    # Christmas
+    }
+
+    # New Year's Day on a Saturday is not observed on the Friday before, that would close the end of the prior year
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:
+        days.add(observed(new_year))
+
+    if year >= 2022:
+        days.add(observed(date(year, 6, 19)))  # Juneteenth
+
+    return days
+
+
+def early_closes(year: int, closed: Set[date]) -> Set[date]:
+    """
+    closed - holidays of year
+
+    returns the days NYSE closes at 1 PM
+    """
+    days = {
+        date(year, 7, 3),                                        # Day before Independence Day
+        nth_weekday(year, 11, 3, 4) + timedelta(days=1),         # Day after Thanksgiving
+        date(year, 12, 24),                                      # Christmas Eve
+    }
+    return {d for d in days if d.weekday() < 5 and d not in closed}
+
+
+def sessions(year: int) -> List[Tuple[int, int]]:
+    """
+    returns (open, close) UNIX timestamps of every regular session in year
+    """
+    closed = holidays(year)
+    early = early_closes(year, closed)
+
+    result = []
+    day = date(year, 1, 1)
+    while day.year == year:
+        if day.weekday() < 5 and day not in closed:
+            close = EARLY_CLOSE if day in early else CLOSE
+            result.append((
+                int(tz.localize(datetime(day.year, day.month, day.day, *OPEN)).timestamp()),
+                int(tz.localize(datetime(day.year, day.month, day.day, *close)).timestamp()),
+            ))
+        day += timedelta(days=1)
+    return result
+
+
+class MarketCalendar:
+    """
+    Every session of the loaded years, indexed by UTC day. A session always falls within one UTC day,
+    so the session of any timestamp, or the next one, is found with a dict lookup
+    """
+    def __init__(self, years=None):
+        """
+        years - years to precompute, defaults to this year and the next. Other years are computed when first asked for
+        """
+        if years is None:
+            this_year = datetime.now(tz).year
+            years = [this_year, this_year + 1]
+
+        self.years: Set[int] = set()
+        self.sessions: List[Tuple[int, int]] = []
+        # UTC day -> index of the first session on or after that day
+        self.next: Dict[int, int] = {}
+        for year in years:
+            self.load(year)
+
+    def load(self, year: int) -> None:
+        if year in self.years:
+            return
+
+        self.years.add(year)
+        self.sessions = sorted(self.sessions + sessions(year))
+
+        self.next = {}
+        if not self.sessions:
+            return
+        epoch = date(1970, 1, 1)
+        first = (date(min(self.years), 1, 1) - epoch).days - 1
+        last = (date(max(self.years), 12, 31) - epoch).days + 1
+        i = 0
+        for day in range(first, last + 1):
+            while i < len(self.sessions) and self.sessions[i][0] // DAY < day:
+                i += 1
+            self.next[day] = i
+        logger.debug(f"Loaded {len(self.sessions)} NYSE sessions of {sorted(self.years)}")
+
+    def session(self, t: float) -> Tuple[int, int]:
+        """
+        t - UNIX timestamp
+
+        returns (open, close) of the session t is in, or the next one if the market is closed at t
+        """
+        day = int(t // DAY)
+        if day not in self.next or self.next[day] >= len(self.sessions) - 1:
+            self.load(datetime.fromtimestamp(t, tz).year)
+            self.load(datetime.fromtimestamp(t, tz).year + 1)
+
+        i = self.next[day]
+        if self.sessions[i][1] <= t:
+            i += 1
+        return self.sessions[i]
+
+    def is_open(self, t=None) -> bool:
+        """
+        t - UNIX timestamp, defaults to now
+
+        returns whether t is in a regular session
+        """
+        if t is None:
+            t = time.time()
+        open, close = self.session(t)
+        return open <= t < close
+
+    def next_open(self, t=None) -> int:
+        """
+        returns when the next session opens, the current one if the market is open at t
+        """
+        if t is None:
+            t = time.time()
+        return self.session(t)[0]
+
+    def next_close(self, t=None) -> int:
+        """
+        returns when the current session closes, the next one if the market is closed at t
+        """
+        if t is None:
+            t = time.time()
+        return self.session(t)[1]
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.calendar = MarketCalendar([2024, 2025])
+
+    def ts(self, *args) -> int:
+        return int(tz.localize(datetime(*args)).timestamp())
+
+    def test_holidays(self):
+        self.assertEqual(sorted(holidays(2025)), [
+            date(2025, 1, 1), date(2025, 1, 20), date(2025, 2, 17), date(2025, 4, 18), date(2025, 5, 26),
+            date(2025, 6, 19), date(2025, 7, 4), date(2025, 9, 1), date(2025, 11, 27), date(2025, 12, 25),
+        ])
+        # Saturday New Year's Day of 2022 was not observed
+        self.assertNotIn(date(2021, 12, 31), holidays(2021) | holidays(2022))
+        self.assertEqual(sorted(early_closes(2025, holidays(2025))), [date(2025, 7, 3), date(2025, 11, 28), date(2025, 12, 24)])
+        self.assertEqual(len(sessions(2024)), 252)
+
+    def test_is_open(self):
+        self.assertTrue(self.calendar.is_open(self.ts(2025, 3, 4, 9, 30)))
+        self.assertFalse(self.calendar.is_open(self.ts(2025, 3, 4, 9, 29)))
+        self.assertFalse(self.calendar.is_open(self.ts(2025, 3, 4, 16, 0)))
+        self.assertFalse(self.calendar.is_open(self.ts(2025, 3, 8, 12)))
+        self.assertFalse(self.calendar.is_open(self.ts(2025, 4, 18, 12)))
+        # Early close
+        self.assertTrue(self.calendar.is_open(self.ts(2025, 11, 28, 12, 59)))
+        self.assertFalse(self.calendar.is_open(self.ts(2025, 11, 28, 13, 0)))
+
+    def test_next_open_close(self):
+        # Thursday night before Good Friday opens Monday
+        t = self.ts(2025, 4, 17, 20)
+        self.assertEqual(self.calendar.next_open(t), self.ts(2025, 4, 21, 9, 30))
+        self.assertEqual(self.calendar.next_close(t), self.ts(2025, 4, 21, 16))
+        self.assertEqual(self.calendar.next_close(self.ts(2025, 12, 24, 10)), self.ts(2025, 12, 24, 13))
+        # Across the end of the loaded years
+        self.assertEqual(self.calendar.next_open(self.ts(2025, 12, 31, 17)), self.ts(2026, 1, 2, 9, 30))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,271 @@
+"""
+Counters, gauges and histograms of the bot, served in Prometheus text format
+
+Scrape with: curl http://127.0.0.1:9100/metrics
+Metrics are updated from the event loop and from the SQLite and compute threads, every update and read holds
+the metric's lock
+"""
+import bisect
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+from aiohttp import web
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+# Seconds, from a cached quote to a slow provider request
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def labels_key(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0, **labels) -> None:
+        key = labels_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(labels_key(labels), 0.0)
+
+    def total(self) -> float:
+        """
+        returns the sum over every label
+        """
+        with self.lock:
+            return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f"{self.name}{format_labels(k)} {v:g}" for k, v in values]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = labels_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> (count of every bucket plus +Inf, sum)
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = labels_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self.values[key]
+            counts[i] += 1
+            total[0] += value
+
+    def snapshot(self) -> List[Tuple[Labels, List[int], float]]:
+        """
+        returns (labels, bucket counts, sum) of every label, copied so they can be read while observations come in
+        """
+        with self.lock:
+            return [(key, list(counts), total[0]) for key, (counts, total) in self.values.items()]
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """
+        Observes how many seconds the with block took
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        key = labels_key(labels)
+        return sum(sum(counts) for k, counts, _ in self.snapshot() if not labels or k == key)
+
+    def quantile(self, q: float, **labels) -> float:
+        """
+        q - between 0 and 1
+        labels - only observations with these labels, every observation if none are given
+
+        returns upper bound of the bucket the quantile falls in, 0 without observations
+        """
+        merged = [0] * (len(self.buckets) + 1)
+        for key, counts, _ in self.snapshot():
+            if labels and key != labels_key(labels):
+                continue
+            merged = [a + b for a, b in zip(merged, counts)]
+
+        n = sum(merged)
+        if n == 0:
+            return 0.0
+        seen = 0
+        for i, c in enumerate(merged):
+            seen += c
+            if seen >= q * n:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, counts, total in sorted(self.snapshot()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(f"{self.name}_bucket{format_labels(key, (('le', f'{bound:g}'),))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{format_labels(key, (('le', '+Inf'),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total:g}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.metrics = {}
+        self.runner = None
+
+    def _get(self, cls, name: str, help: str, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, help, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets=BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        """
+        returns every metric in Prometheus text format
+        """
+        lines = []
+        for name, m in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {m.help}")
+            lines.append(f"# TYPE {name} {m.type}")
+            lines += m.render()
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def serve(self, host="127.0.0.1", port=9100) -> int:
+        """
+        returns port /metrics is served on, pass 0 to pick a free one
+        """
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return port
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+# Shared by every module of the bot
+metrics = Metrics()
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    def test_render(self):
+        m = Metrics()
+        requests = m.counter("provider_requests_total", "Requests sent")
+        requests.inc(provider="td")
+        requests.inc(2, provider="alpaca")
+        m.gauge("alert_queue_depth", "Alerts waiting").set(3)
+        latency = m.histogram("provider_request_seconds", "Request latency", buckets=(0.1, 1))
+        latency.observe(0.05, provider="td")
+        latency.observe(0.5, provider="td")
+        latency.observe(5, provider="td")
+
+        text = m.render()
+        self.assertIn('provider_requests_total{provider="alpaca"} 2', text)
+        self.assertIn("alert_queue_depth 3", text)
+        self.assertIn('provider_request_seconds_bucket{provider="td",le="0.1"} 1', text)
+        self.assertIn('provider_request_seconds_bucket{provider="td",le="1"} 2', text)
+        self.assertIn('provider_request_seconds_bucket{provider="td",le="+Inf"} 3', text)
+        self.assertIn('provider_request_seconds_count{provider="td"} 3', text)
+        self.assertIn("# TYPE provider_request_seconds histogram", text)
+
+        self.assertEqual(requests.total(), 3)
+        self.assertEqual(latency.quantile(0.5), 1)
+        self.assertEqual(latency.quantile(0.99, provider="td"), float('inf'))
+        self.assertEqual(latency.count(provider="alpaca"), 0)
+
+    def test_threads(self):
+        m = Metrics()
+        counter = m.counter("queries_total", "Queries")
+        latency = m.histogram("query_seconds", "Query latency", buckets=(0.1, 1))
+
+        def work(i: int) -> None:
+            for j in range(5000):
+                counter.inc(op=f"op{j % 3}")
+                latency.observe(0.05 * (j % 3), op=f"op{i}")
+                if j % 500 == 0:
+                    m.render()
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(counter.total(), 40000)
+        self.assertEqual(latency.count(), 40000)
+        self.assertEqual(latency.count(op="op3"), 5000)
+
+    async def test_serve(self):
+        import aiohttp
+        m = Metrics()
+        m.counter("cycles_total", "Cycles").inc()
+        port = await m.serve(port=0)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as r:
+                body = await r.text()
+        await m.stop()
+        self.assertIn("cycles_total 1", body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,13 @@
 from ticket import Ticket
-from typing import Callable, Awaitable, List, TypedDict
+from typing import Callable, Awaitable, Dict, Iterator, List, Optional, Tuple, TypedDict
+import bisect
+import math
+import random
 import unittest
 from time import time
 from alpaca_v1 import Alpaca_V1
 from tdameritrade_api import TdAmeritradeAPI
-from api import API
+from api import API, Price as PriceQuote
 from custom_logger import get_logger
 
 logger = get_logger(__name__)
@@ -20,17 +23,300 @@ class PriceTicket(TypedDict):
     margin: float
 
 
+class Node:
+    """
+    Node of a centered interval tree, holds the bands around its center
+    """
+    __slots__ = ("center", "lows", "by_low", "highs", "by_high", "left", "right")
+
+    def __init__(self, center: float, bands: List[Tuple[float, float, PriceTicket]], left=None, right=None):
+        """
+        center - price every band of the node contains
+        bands - (low, high, ticket) of the bands
+        left, right - nodes of the bands entirely below and above center
+        """
+        self.center = center
+        # Bands by low edge and by high edge descending, with their keys alongside for bisect
+        self.by_low = sorted(bands, key=lambda b: b[0])
+        self.lows = [b[0] for b in self.by_low]
+        self.by_high = sorted(bands, key=lambda b: -b[1])
+        self.highs = [-b[1] for b in self.by_high]
+        self.left = left
+        self.right = right
+
+    def insert(self, band: Tuple[float, float, PriceTicket]) -> None:
+        i = bisect.bisect_right(self.lows, band[0])
+        self.lows.insert(i, band[0])
+        self.by_low.insert(i, band)
+        i = bisect.bisect_right(self.highs, -band[1])
+        self.highs.insert(i, -band[1])
+        self.by_high.insert(i, band)
+
+    def delete(self, band: Tuple[float, float, PriceTicket]) -> None:
+        for keys, bands, key in ((self.lows, self.by_low, band[0]), (self.highs, self.by_high, -band[1])):
+            i = bisect.bisect_left(keys, key)
+            while bands[i][2]['_id'] != band[2]['_id']:
+                i += 1
+            del keys[i]
+            del bands[i]
+
+
+def build(bands: List[Tuple[float, float, PriceTicket]]) -> Optional[Node]:
+    """
+    bands - (low, high, ticket) of every ticket
+
+    returns root of a centered interval tree, split at the median edge so it is O(log n) deep
+    """
+    if not bands:
+        return None
+
+    edges = sorted([b[0] for b in bands] + [b[1] for b in bands])
+    center = edges[len(edges) // 2]
+    below = [b for b in bands if b[1] < center]
+    above = [b for b in bands if b[0] > center]
+    here = [b for b in bands if b[0] <= center <= b[1]]
+    return Node(center, here, build(below), build(above))
+
+
+def band(ticket: PriceTicket) -> Tuple[float, float, PriceTicket]:
+    return (ticket['price'] - ticket['margin'], ticket['price'] + ticket['margin'], ticket)
+
+
+class PriceLevels:
+    """
+    Price tickets of one symbol. Every ticket is a band from price - margin to price + margin, indexed in an
+    interval tree, so a quote is matched in O(log n + k) for k triggered tickets whatever the margins are.
+
+    add and remove update the tree in place, in O(depth + m) for the m bands of the node the band goes in, plus
+    O(n) to shift the sorted edge lists distance uses, a memmove of floats. An add below the tree's leaves can
+    make it lopsided, once a band lands deeper than 2 log2 n + 4 the tree is rebuilt on the next match, which is
+    O(n log n) but keeps matching O(log n + k)
+    """
+    def __init__(self, tickets=None):
+        """
+        tickets - price tickets of the symbol to index
+        """
+        self.tickets: Dict[str, PriceTicket] = {}
+        # Sorted band edges, for distance
+        self.lows: List[float] = []
+        self.highs: List[float] = []
+        self.root: Optional[Node] = None
+        self.dirty = False
+        # Bumped on every change to the tickets, so callers can tell whether a past match still holds
+        self.version = 0
+
+        for t in tickets or []:
+            self.tickets[t['_id']] = t
+            self.lows.append(t['price'] - t['margin'])
+            self.highs.append(t['price'] + t['margin'])
+        self.lows.sort()
+        self.highs.sort()
+        self.dirty = len(self.tickets) > 0
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def add(self, ticket: PriceTicket) -> None:
+        """
+        ticket - price ticket to start watching
+        """
+        self.remove(ticket['_id'])
+        self.tickets[ticket['_id']] = ticket
+        low, high, _ = b = band(ticket)
+        bisect.insort(self.lows, low)
+        bisect.insort(self.highs, high)
+        self.version += 1
+        if self.dirty:
+            return
+
+        if self.root is None:
+            self.root = Node((low + high) / 2, [b])
+            return
+
+        node, depth = self.root, 1
+        while True:
+            if high < node.center:
+                if node.left is None:
+                    node.left = Node((low + high) / 2, [b])
+                    break
+                node = node.left
+            elif low > node.center:
+                if node.right is None:
+                    node.right = Node((low + high) / 2, [b])
+                    break
+                node = node.right
+            else:
+                node.insert(b)
+                break
+            depth += 1
+
+        if depth > 2 * math.log2(len(self.tickets)) + 4:
+            self.dirty = True
+
+    def remove(self, _id: str) -> bool:
+        """
+        _id - id of ticket to stop watching
+
+        returns whether the ticket was in the index
+        """
+        ticket = self.tickets.pop(_id, None)
+        if ticket is None:
+            return False
+
+        low, high, _ = b = band(ticket)
+        del self.lows[bisect.bisect_left(self.lows, low)]
+        del self.highs[bisect.bisect_left(self.highs, high)]
+        self.version += 1
+        if self.dirty:
+            return True
+
+        # Same path the band took when it was added, nodes only ever get children below them
+        node = self.root
+        while high < node.center or low > node.center:
+            node = node.left if high < node.center else node.right
+        node.delete(b)
+        return True
+
+    def around(self, price: float) -> Iterator[PriceTicket]:
+        """
+        price - current price of the symbol
+
+        returns every ticket where price - margin < current price < price + margin
+        """
+        if self.dirty:
+            self.root = build([band(t) for t in self.tickets.values()])
+            self.dirty = False
+
+        node = self.root
+        while node is not None:
+            if price < node.center:
+                # Every band of the node reaches up to the center, only the low edge matters
+                for low, _, t in node.by_low:
+                    if low >= price:
+                        break
+                    yield t
+                node = node.left
+            elif price > node.center:
+                for _, high, t in node.by_high:
+                    if high <= price:
+                        break
+                    yield t
+                node = node.right
+            else:
+                for low, high, t in node.by_low:
+                    if low >= price:
+                        break
+                    if high > price:
+                        yield t
+                return
+
+    def match(self, price: float, now=None) -> List[PriceTicket]:
+        """
+        price - current price of the symbol
+        now - UNIX time, tickets with a timeout after it are skipped. Defaults to now
+
+        returns tickets where price - margin < current price < price + margin
+        """
+        if now is None:
+            now = time()
+        return [t for t in self.around(price) if t.get('timeout', 0) < now]
+
+    def quiet_until(self, price: float) -> float:
+        """
+        price - current price of the symbol
+
+        returns until when a quote at price can not trigger a ticket: the earliest timeout of the tickets around price,
+        inf if there are none. Same or before now if one triggers right away
+        """
+        return min((t.get('timeout', 0) for t in self.around(price)), default=float('inf'))
+
+    def distance(self, price: float) -> float:
+        """
+        price - current price of the symbol
+
+        returns how far price has to move to enter the nearest price - margin, price + margin band, 0 if inside one
+        """
+        # Bands starting at or below price, minus the ones that also end below it
+        if bisect.bisect_right(self.lows, price) > bisect.bisect_left(self.highs, price):
+            return 0.0
+
+        nearest = float('inf')
+        i = bisect.bisect_right(self.lows, price)
+        if i < len(self.lows):
+            nearest = self.lows[i] - price
+        j = bisect.bisect_left(self.highs, price)
+        if j > 0:
+            nearest = min(nearest, price - self.highs[j - 1])
+        return nearest
+
+
+class PriceBook:
+    """
+    PriceLevels of every symbol, with lookup by ticket id
+    """
+    def __init__(self, tickets=None):
+        """
+        tickets - every price ticket to watch
+        """
+        grouped: Dict[str, List[PriceTicket]] = {}
+        for t in tickets or []:
+            grouped.setdefault(t['symbol'], []).append(t)
+
+        self.symbols: Dict[str, PriceLevels] = {s: PriceLevels(t) for s, t in grouped.items()}
+        self.ids: Dict[str, str] = {t['_id']: t['symbol'] for t in tickets or []}
+
+    def get(self, symbol: str) -> PriceLevels:
+        return self.symbols.get(symbol, PriceLevels())
+
+    def get_symbols(self) -> List[str]:
+        """
+        returns every symbol with at least one ticket
+        """
+        return list(self.symbols.keys())
+
+    def add(self, ticket: PriceTicket) -> None:
+        self.symbols.setdefault(ticket['symbol'], PriceLevels()).add(ticket)
+        self.ids[ticket['_id']] = ticket['symbol']
+
+    def remove(self, _id: str) -> bool:
+        symbol = self.ids.pop(_id, None)
+        if symbol is None:
+            return False
+
+        levels = self.symbols[symbol]
+        levels.remove(_id)
+        if len(levels) == 0:
+            del self.symbols[symbol]
+        return True
+
+    def update_timeout(self, _id: str, timeout: int) -> None:
+        """
+        _id - id of ticket that alerted
+        timeout - when to wait until, not duration
+        """
+        symbol = self.ids.get(_id)
+        if symbol is not None:
+            levels = self.symbols[symbol]
+            levels.tickets[_id]['timeout'] = timeout
+            levels.version += 1
+
+
 class Price(Ticket):
     """
     Used for discord bot to monitor price targets
     """
-    def __init__(self, symbol: str, prices: List[PriceTicket]):
+    def __init__(self, symbol: str, prices=None, levels=None):
         """
         symbol - stock symbol
         prices - target prices to watch out for
+        levels - already built PriceLevels of the symbol, used instead of prices
         """
         self.symbol = symbol
-        self.prices = prices
+        self.levels = levels if levels is not None else PriceLevels(prices)
+
+    @property
+    def prices(self) -> List[PriceTicket]:
+        return list(self.levels.tickets.values())
 
     def __str__(self):
         data = []
@@ -46,14 +332,26 @@ class Price(Ticket):
         """
         current_time = time()
         current_price = await api.get_price(self.symbol, t=current_time)
+        await self.check(current_price, callback, current_time)
 
-        for p in self.prices:
-            if (p['price'] + p['margin']) > current_price['p'] > (p['price'] - p['margin']):
-                logger.info(f"{self.symbol} near {p['price']} currently trading at {current_price['p']}. TS: {current_price['t']}. Sys: {current_time}")
-                await callback(f"{self.symbol} near {p['price']} currently trading at {current_price['p']}. TS: {current_price['t']}. Sys: {current_time}",
-                               p['channelID'], p['authorID'], p['_id'], self.timeout())
-            else:
-                logger.info(f"{self.symbol} currently trading at {current_price['p']}, watching for it to go to {p['price']} within {p['margin']}. TS: {current_price['t']}. Sys: {current_time}")
+    async def check(self, current_price: PriceQuote, callback: Callable[[str, int, int, str, int], Awaitable[None]], current_time=None) -> None:
+        """
+        current_price - quote of the symbol, already fetched, such as from API.get_prices
+        callback - function to call if price hit
+        current_time - system time the quote was requested at, defaults to now
+
+        Checks every ticket against an already fetched quote
+        """
+        if current_time is None:
+            current_time = time()
+
+        matched = self.levels.match(current_price['p'], now=current_time)
+        logger.debug(f"{self.symbol} currently trading at {current_price['p']}, {len(matched)} of {len(self.levels)} tickets hit. TS: {current_price['t']}. Sys: {current_time}")
+
+        for p in matched:
+            logger.info(f"{self.symbol} near {p['price']} currently trading at {current_price['p']}. TS: {current_price['t']}. Sys: {current_time}")
+            await callback(f"{self.symbol} near {p['price']} currently trading at {current_price['p']}. TS: {current_price['t']}. Sys: {current_time}",
+                           p['channelID'], p['authorID'], p['_id'], self.timeout())
 
     def timeout(self):
         """
@@ -67,7 +365,7 @@ class Test(unittest.IsolatedAsyncioTestCase):
         self.api = TdAmeritradeAPI()
 
     async def test_monitor(self):
-        p = Price('AAPL', prices=[PriceTicket(symbol='AAPL', channelID=1, authorID=2, price=234, margin=0.1)])
+        p = Price('AAPL', prices=[PriceTicket(_id='price_1', symbol='AAPL', channelID=1, authorID=2, price=234, margin=0.1)])
 
         async def message(m: str) -> None:
             print(m, p.channelID, p.author)
@@ -79,5 +377,96 @@ class Test(unittest.IsolatedAsyncioTestCase):
         pass
 
 
+class TestPriceLevels(unittest.TestCase):
+    def make(self, i: int, price: float, margin: float) -> PriceTicket:
+        return PriceTicket(_id=f"price_{i}", symbol="SPY", price=price, margin=margin, channelID=1, authorID=2, timeout=0)
+
+    def test_match_same_as_scan(self):
+        rng = random.Random(1)
+        tickets = [self.make(i, round(rng.uniform(300, 500), 2), rng.choice([0.5, 1.0, 1.0, 2.5])) for i in range(3000)]
+        levels = PriceLevels(tickets[:2000])
+        for t in tickets[2000:]:
+            levels.add(t)
+        for t in tickets[::7]:
+            levels.remove(t['_id'])
+        remaining = [t for i, t in enumerate(tickets) if i % 7 != 0]
+
+        for _ in range(200):
+            quote = rng.uniform(290, 510)
+            expected = {t['_id'] for t in remaining if (t['price'] + t['margin']) > quote > (t['price'] - t['margin'])}
+            self.assertEqual({t['_id'] for t in levels.match(quote)}, expected)
+
+    def test_updates_in_place(self):
+        rng = random.Random(3)
+        tickets = [self.make(i, round(rng.uniform(300, 500), 2), rng.choice([0.5, 1.0, 2.5])) for i in range(1000)]
+        levels = PriceLevels(tickets)
+        levels.match(400)
+        root = levels.root
+
+        live = {t['_id']: t for t in tickets}
+        for i in range(1000, 1500):
+            t = self.make(i, round(rng.uniform(300, 500), 2), rng.choice([0.5, 1.0, 2.5]))
+            levels.add(t)
+            live[t['_id']] = t
+            removed = rng.choice(list(live))
+            levels.remove(removed)
+            del live[removed]
+
+            quote = rng.uniform(290, 510)
+            expected = {_id for _id, t in live.items() if (t['price'] + t['margin']) > quote > (t['price'] - t['margin'])}
+            self.assertEqual({t['_id'] for t in levels.match(quote)}, expected)
+        # Scattered adds go in the existing nodes, the tree was never rebuilt
+        self.assertIs(levels.root, root)
+
+        # Adds that keep going past the highest band make it lopsided, it is rebuilt before it gets deep
+        for i in range(2000, 2200):
+            levels.add(self.make(i, 600 + i, 0.5))
+            levels.match(600 + i)
+        self.assertIsNot(levels.root, root)
+        self.assertEqual([t['_id'] for t in levels.match(2799.2)], ["price_2199"])
+
+    def test_any_margins(self):
+        rng = random.Random(2)
+        tickets = [self.make(i, round(rng.uniform(300, 500), 2), round(rng.uniform(0.01, 20), 2)) for i in range(2000)]
+        levels = PriceLevels(tickets)
+        for _ in range(200):
+            quote = rng.uniform(290, 510)
+            expected = {t['_id'] for t in tickets if (t['price'] + t['margin']) > quote > (t['price'] - t['margin'])}
+            self.assertEqual({t['_id'] for t in levels.match(quote)}, expected)
+            nearest = min(max(0.0, abs(t['price'] - quote) - t['margin']) for t in tickets)
+            self.assertAlmostEqual(levels.distance(quote), nearest)
+
+    def test_timeout_skipped(self):
+        book = PriceBook([self.make(1, 100, 1.0), self.make(2, 100.5, 1.0)])
+        book.update_timeout("price_1", int(time()) + 1000)
+        self.assertEqual([t['_id'] for t in book.get("SPY").match(100.2)], ["price_2"])
+
+    def test_quiet_until(self):
+        book = PriceBook([self.make(1, 100, 1.0), self.make(2, 100.5, 1.0)])
+        levels = book.get("SPY")
+        self.assertEqual(levels.quiet_until(110), float('inf'))
+        self.assertEqual(levels.quiet_until(100.2), 0)
+
+        version = levels.version
+        book.update_timeout("price_1", 1000)
+        book.update_timeout("price_2", 2000)
+        self.assertGreater(levels.version, version)
+        self.assertEqual(levels.quiet_until(100.2), 1000)
+        self.assertEqual(levels.quiet_until(101.2), 2000)
+
+    def test_distance(self):
+        levels = PriceLevels([self.make(1, 100, 1.0), self.make(2, 120, 5.0)])
+        self.assertAlmostEqual(levels.distance(90), 9)
+        self.assertAlmostEqual(levels.distance(112), 3)
+        self.assertEqual(levels.distance(100.5), 0)
+        self.assertEqual(PriceLevels().distance(100), float('inf'))
+
+    def test_remove_last(self):
+        book = PriceBook([self.make(1, 100, 1.0)])
+        self.assertTrue(book.remove("price_1"))
+        self.assertFalse(book.remove("price_1"))
+        self.assertEqual(book.get_symbols(), [])
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,180 @@
+"""
+Token bucket rate limiter, one per provider
+"""
+import asyncio
+import time
+import unittest
+from typing import Awaitable, Callable, TypeVar
+from metrics import metrics
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+REQUESTS = metrics.counter("provider_requests_total", "Requests sent to a provider")
+ERRORS = metrics.counter("provider_errors_total", "Requests that failed, by provider and error")
+LATENCY = metrics.histogram("provider_request_seconds", "Time a provider took to answer, not counting rate limit waits")
+
+T = TypeVar('T')
+
+
+class RateLimited(Exception):
+    """
+    Raised by a provider request when the provider answered with 429
+    """
+    def __init__(self, retry_after=None):
+        """
+        retry_after - seconds the provider asked us to wait, None if it did not say
+        """
+        super().__init__(f"Rate limited, retry after {retry_after}")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, requests_per_minute: int, burst=None, max_retries=5, name="provider",
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], Awaitable[None]] = asyncio.sleep):
+        """
+        requests_per_minute - quota of the provider
+        burst - how many requests can be sent back to back, defaults to one second worth of quota
+        max_retries - how many times a rate limited request is retried before giving up
+        name - provider label of the request metrics
+        clock, sleep - seconds now and how to wait, replaced in tests
+        """
+        self.name = name
+        self.clock = clock
+        self.sleep = sleep
+        self.rate = requests_per_minute / 60
+        self.capacity = burst if burst is not None else max(1, int(self.rate))
+        self.tokens = self.capacity
+        self.max_retries = max_retries
+        self.updated = clock()
+        self.blocked_until = 0.0
+        self.failures = 0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """
+        Waits until a request can be sent without going over quota
+        """
+        async with self.lock:
+            while True:
+                now = self.clock()
+                if now < self.blocked_until:
+                    await self.sleep(self.blocked_until - now)
+                    continue
+
+                self._refill(now)
+                # Rounding in the refill can leave a token a hair short after waiting exactly for it
+                if self.tokens >= 1 - 1e-9:
+                    self.tokens = max(0.0, self.tokens - 1)
+                    return
+
+                await self.sleep((1 - self.tokens) / self.rate)
+
+    def backoff(self, retry_after=None) -> None:
+        """
+        retry_after - seconds the provider asked to wait, if not given backs off exponentially
+
+        Stops every request through this bucket until the backoff is over
+        """
+        self.failures += 1
+        delay = retry_after if retry_after is not None else min(60, 2 ** (self.failures - 1))
+        self.blocked_until = max(self.blocked_until, self.clock() + delay)
+        self.tokens = 0
+        logger.error(f"Rate limited, backing off for {delay}s")
+
+    def success(self) -> None:
+        self.failures = 0
+
+    async def run(self, request: Callable[[], Awaitable[T]]) -> T:
+        """
+        request - async function that sends one request, raises RateLimited on 429
+
+        returns result of request, sent when the bucket allows it and retried when rate limited
+        """
+        attempts = 0
+        while True:
+            await self.acquire()
+            REQUESTS.inc(provider=self.name)
+            start = time.perf_counter()
+            try:
+                result = await request()
+            except RateLimited as e:
+                ERRORS.inc(provider=self.name, error="rate_limited")
+                attempts += 1
+                if attempts > self.max_retries:
+                    raise
+                self.backoff(e.retry_after)
+                continue
+            except Exception as e:
+                ERRORS.inc(provider=self.name, error=type(e).__name__)
+                raise
+            finally:
+                LATENCY.observe(time.perf_counter() - start, provider=self.name)
+
+            self.success()
+            return result
+
+
+class FakeClock:
+    """
+    Time that only moves when sleep is awaited
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def test_rate(self):
+        # 10 requests per second, with 2 that can be sent instantly
+        clock = FakeClock()
+        bucket = TokenBucket(600, burst=2, clock=clock, sleep=clock.sleep)
+        sent = []
+        for _ in range(6):
+            await bucket.acquire()
+            sent.append(clock.now)
+        self.assertEqual([round(t, 6) for t in sent], [0, 0, 0.1, 0.2, 0.3, 0.4])
+
+        # Idle time refills up to burst only
+        await clock.sleep(10)
+        for _ in range(3):
+            await bucket.acquire()
+        self.assertAlmostEqual(clock.now, 10.5)
+
+    async def test_backoff_on_429(self):
+        bucket = TokenBucket(6000, burst=5)
+        calls = []
+
+        async def request():
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                raise RateLimited(retry_after=0.1)
+            return "ok"
+
+        result = await bucket.run(request)
+        self.assertEqual(result, "ok")
+        self.assertEqual(len(calls), 3)
+        self.assertGreaterEqual(calls[2] - calls[0], 0.2)
+        self.assertEqual(bucket.failures, 0)
+
+    async def test_gives_up(self):
+        bucket = TokenBucket(6000, burst=5, max_retries=1)
+
+        async def request():
+            raise RateLimited(retry_after=0.01)
+
+        with self.assertRaises(RateLimited):
+            await bucket.run(request)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,396 @@
+"""
+Every ticket kept in memory, so the monitor loop never queries the database during a cycle
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from async_sql import AsyncSQL
+from ema import EMA, EMAGroup
+from price import PriceBook, PriceLevels, PriceTicket
+from rules import Rule, validate
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+# Event names passed to listeners
+ADD = "add"
+DELETE = "delete"
+UPDATE = "update"
+
+Listener = Callable[[str, Union[PriceTicket, EMA, Rule]], Awaitable[None]]
+
+
+class TicketRegistry:
+    """
+    Loads the tickets once and writes every change through to the database. Price tickets are indexed
+    per symbol in a PriceBook, EMA tickets per (symbol, timeframe, multiplier) series, rule tickets by id
+    """
+    def __init__(self, db: AsyncSQL):
+        """
+        db - repository the tickets are persisted in
+        """
+        self.db = db
+        self.book = PriceBook()
+        self.series: Dict[Tuple[str, str, int], Dict[str, EMA]] = {}
+        self.emas: Dict[str, EMA] = {}
+        self.rules: Dict[str, Rule] = {}
+        self.listeners: List[Listener] = []
+        # Writes deferred until the end of the cycle, see flush
+        self.pending_timeouts: Dict[str, int] = {}
+        self.pending_deletes: List[str] = []
+        # { _id: (timeout read from the database, new timeout) }, see defer_claim
+        self.pending_claims: Dict[str, Tuple[int, int]] = {}
+
+    async def load(self) -> None:
+        """
+        Reads every ticket from the database, replaces what is in memory
+        """
+        self.book = PriceBook(await self.db.get_all_price())
+        self.series = {}
+        self.emas = {}
+        for t in await self.db.get_all_ema():
+            self._add_ema(t)
+        self.rules = {t._id: t for t in await self.db.get_all_rule()}
+        logger.info(f"Loaded {len(self.book.ids)} price, {len(self.emas)} EMA and {len(self.rules)} rule tickets")
+
+    def subscribe(self, listener: Listener) -> None:
+        """
+        listener - async function called with the event name (add, delete, update) and the ticket
+        """
+        self.listeners.append(listener)
+
+    async def publish(self, event: str, ticket: Union[PriceTicket, EMA, Rule]) -> None:
+        for listener in self.listeners:
+            try:
+                await listener(event, ticket)
+            except Exception:
+                logger.error(f"Listener failed on {event}", exc_info=True)
+
+    def _add_ema(self, ticket: EMA) -> None:
+        self.emas[ticket._id] = ticket
+        self.series.setdefault((ticket.symbol, ticket.timeframe, ticket.multiplier), {})[ticket._id] = ticket
+
+    async def add_price(self, symbol: str, price: float, channelID: int, author: int, margin=1.0) -> str:
+        """
+        returns id of the new price ticket
+        """
+        _id = await self.db.add_price(symbol, price, channelID, author, margin=margin)
+        ticket = PriceTicket(
+            _id=_id,
+            symbol=symbol.upper(),
+            price=price,
+            channelID=channelID,
+            authorID=author,
+            margin=margin,
+            timeout=0
+        )
+        self.book.add(ticket)
+        await self.publish(ADD, ticket)
+        return _id
+
+    async def add_ema(self, symbol: str, timeframe: str, periods: int, channelID: int, author: int, multiplier=1, margin=0.001) -> str:
+        """
+        returns id of the new EMA ticket
+        """
+        _id = await self.db.add_ema(symbol, timeframe, periods, channelID, author, multiplier=multiplier, margin=margin)
+        ticket = EMA(symbol.upper(), timeframe, periods, channelID, author, _id, multiplier=multiplier, margin=margin)
+        self._add_ema(ticket)
+        await self.publish(ADD, ticket)
+        return _id
+
+    async def add_rule(self, symbol: str, expression: str, channelID: int, author: int) -> str:
+        """
+        returns id of the new rule ticket, raises ValueError if expression does not parse
+        """
+        validate(symbol, expression)
+        _id = await self.db.add_rule(symbol, expression, channelID, author)
+        ticket = self.rules[_id] = Rule(symbol.upper(), expression, channelID, author, _id)
+        await self.publish(ADD, ticket)
+        return _id
+
+    def find(self, _id: str) -> Optional[Union[PriceTicket, EMA, Rule]]:
+        """
+        returns the ticket with _id, None if there is none
+        """
+        if _id in self.emas:
+            return self.emas[_id]
+        if _id in self.rules:
+            return self.rules[_id]
+        symbol = self.book.ids.get(_id)
+        if symbol is not None:
+            return self.book.symbols[symbol].tickets[_id]
+        return None
+
+    async def delete(self, _id: str) -> bool:
+        """
+        returns whether a ticket was deleted
+        """
+        await self.db.delete(_id)
+        return await self._remove(_id)
+
+    async def _remove(self, _id: str) -> bool:
+        ticket = self.find(_id)
+        if ticket is None:
+            return False
+
+        if isinstance(ticket, EMA):
+            del self.emas[_id]
+            key = (ticket.symbol, ticket.timeframe, ticket.multiplier)
+            del self.series[key][_id]
+            if len(self.series[key]) == 0:
+                del self.series[key]
+        elif isinstance(ticket, Rule):
+            del self.rules[_id]
+        else:
+            self.book.remove(_id)
+
+        await self.publish(DELETE, ticket)
+        return True
+
+    async def update_timeout(self, _id: str, timeout: int) -> None:
+        """
+        _id - id of ticket that alerted
+        timeout - when to wait until, not duration
+        """
+        await self.db.update_timeout(_id, timeout)
+        await self._set_timeout(_id, timeout)
+
+    async def _set_timeout(self, _id: str, timeout: int) -> None:
+        ticket = self.find(_id)
+        if ticket is None:
+            return
+
+        if isinstance(ticket, (EMA, Rule)):
+            ticket.cooldown = timeout
+        else:
+            self.book.update_timeout(_id, timeout)
+        await self.publish(UPDATE, ticket)
+
+    async def defer_timeout(self, _id: str, timeout: int) -> None:
+        """
+        Same as update_timeout, but the write is held until flush. Memory is updated right away
+        so the ticket cools down in the same cycle
+        """
+        self.pending_timeouts[_id] = timeout
+        await self._set_timeout(_id, timeout)
+
+    async def defer_claim(self, _id: str, timeout: int) -> None:
+        """
+        Same as defer_timeout, but flush_claims writes it with compare-and-set, for when several workers
+        can alert the same ticket
+        """
+        ticket = self.find(_id)
+        if ticket is None:
+            return
+        if _id not in self.pending_claims:
+            expected = ticket['timeout'] if isinstance(ticket, dict) else ticket.cooldown
+            self.pending_claims[_id] = (expected, timeout)
+        else:
+            self.pending_claims[_id] = (self.pending_claims[_id][0], timeout)
+        await self._set_timeout(_id, timeout)
+
+    async def flush_claims(self) -> List[str]:
+        """
+        returns ids of the deferred claims that won, the others were alerted by another worker first
+        """
+        if not self.pending_claims:
+            return []
+
+        claims, self.pending_claims = self.pending_claims, {}
+        try:
+            claimed = await self.db.claim_batch(claims)
+        except Exception:
+            # Kept for the next flush, claims deferred since then keep the timeout they were read with
+            self.pending_claims = {**claims, **self.pending_claims}
+            raise
+        if len(claimed) < len(claims):
+            logger.info(f"{len(claims) - len(claimed)} of {len(claims)} alerts were already claimed by another worker")
+        return claimed
+
+    async def defer_delete(self, _id: str) -> None:
+        """
+        Same as delete, but the write is held until flush
+        """
+        self.pending_timeouts.pop(_id, None)
+        self.pending_deletes.append(_id)
+        await self._remove(_id)
+
+    async def flush(self) -> None:
+        """
+        Writes every deferred timeout and delete in one transaction, the cycle's alerts are durable once it returns
+        since the writer syncs every commit
+        """
+        if not self.pending_timeouts and not self.pending_deletes:
+            return
+
+        timeouts, deletes = self.pending_timeouts, self.pending_deletes
+        self.pending_timeouts, self.pending_deletes = {}, []
+        try:
+            await self.db.write_batch(timeouts, deletes)
+        except Exception:
+            # Kept for the next flush, anything deferred since then is newer
+            self.pending_timeouts = {**timeouts, **self.pending_timeouts}
+            self.pending_deletes = deletes + self.pending_deletes
+            raise
+        logger.debug(f"Flushed {len(timeouts)} timeouts and {len(deletes)} deletes")
+
+    def get(self, symbol: str) -> PriceLevels:
+        """
+        returns the indexed price tickets of symbol
+        """
+        return self.book.get(symbol)
+
+    def price_symbols(self) -> List[str]:
+        return self.book.get_symbols()
+
+    def symbols(self) -> List[str]:
+        """
+        returns every symbol with a price, EMA or rule ticket
+        """
+        return sorted(set(self.book.get_symbols()) | {s for s, _, _ in self.series} | {t.symbol for t in self.rules.values()})
+
+    def active_emas(self, now=None) -> List[EMA]:
+        """
+        now - UNIX time, tickets cooling down until after it are skipped. Defaults to now
+
+        returns every EMA ticket that can alert
+        """
+        if now is None:
+            now = time.time()
+        return [t for t in self.emas.values() if t.cooldown < now]
+
+    def active_rules(self, now=None) -> List[Rule]:
+        """
+        returns every rule ticket that can alert
+        """
+        if now is None:
+            now = time.time()
+        return [t for t in self.rules.values() if t.cooldown < now]
+
+    def ema_groups(self, now=None) -> List[EMAGroup]:
+        """
+        returns the series with at least one EMA ticket that can alert
+        """
+        return EMAGroup.group(self.active_emas(now))
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = AsyncSQL(os.path.join(self.dir, "alerts.db"))
+
+    async def test_write_through(self):
+        registry = TicketRegistry(self.db)
+        events = []
+
+        async def listener(event: str, ticket) -> None:
+            events.append(event)
+
+        registry.subscribe(listener)
+        price_id = await registry.add_price('aapl', 134, channelID=1, author=2)
+        ema_id = await registry.add_ema('AAPL', 'hour', 8, channelID=1, author=2)
+        await registry.add_ema('TSLA', 'day', 50, channelID=1, author=2)
+
+        self.assertEqual(registry.symbols(), ['AAPL', 'TSLA'])
+        self.assertEqual(len(registry.get('AAPL').match(134)), 1)
+
+        await registry.update_timeout(ema_id, int(time.time()) + 1000)
+        await registry.update_timeout(price_id, int(time.time()) + 1000)
+        self.assertEqual([t.symbol for t in registry.active_emas()], ['TSLA'])
+        self.assertEqual(len(registry.get('AAPL').match(134)), 0)
+
+        self.assertTrue(await registry.delete(price_id))
+        self.assertFalse(await registry.delete(price_id))
+        self.assertEqual(events, [ADD, ADD, ADD, UPDATE, UPDATE, DELETE])
+
+        # A fresh registry sees the same state from the database
+        loaded = TicketRegistry(self.db)
+        await loaded.load()
+        self.assertEqual(loaded.price_symbols(), [])
+        self.assertEqual(sorted(loaded.emas), sorted(registry.emas))
+        self.assertEqual([t.symbol for t in loaded.active_emas()], ['TSLA'])
+
+    async def test_rules(self):
+        registry = TicketRegistry(self.db)
+        _id = await registry.add_rule('aapl', 'price crosses 150 and 1H RSI < 30', channelID=1, author=2)
+        with self.assertRaises(ValueError):
+            await registry.add_rule('AAPL', 'price crosses', channelID=1, author=2)
+
+        self.assertEqual(registry.symbols(), ['AAPL'])
+        await registry.defer_timeout(_id, int(time.time()) + 1000)
+        self.assertEqual(registry.active_rules(), [])
+        await registry.flush()
+
+        loaded = TicketRegistry(self.db)
+        await loaded.load()
+        self.assertEqual(loaded.find(_id).expression, 'price crosses 150 and 1H RSI < 30')
+        self.assertEqual(loaded.active_rules(), [])
+        self.assertTrue(await loaded.delete(_id))
+        self.assertEqual(await self.db.get_all_rule(), [])
+
+    async def test_claims(self):
+        _id = await self.db.add_price('AAPL', 134, channelID=1, author=2)
+        first, second = TicketRegistry(self.db), TicketRegistry(self.db)
+        await first.load()
+        await second.load()
+
+        # Both workers see the ticket hit in the same cycle, only one of them wins
+        timeout = int(time.time()) + 1000
+        await first.defer_claim(_id, timeout)
+        await second.defer_claim(_id, timeout + 1)
+        self.assertEqual(await first.flush_claims(), [_id])
+        self.assertEqual(await second.flush_claims(), [])
+        self.assertEqual(await first.flush_claims(), [])
+        self.assertEqual((await self.db.get_all_price())[0]['timeout'], timeout)
+
+    async def test_no_reads_during_cycle(self):
+        registry = TicketRegistry(self.db)
+        await registry.add_price('AAPL', 134, channelID=1, author=2)
+        await registry.add_ema('AAPL', 'hour', 8, channelID=1, author=2)
+
+        async def fail(*args, **kwargs):
+            raise AssertionError("database read during cycle")
+
+        self.db.read = fail
+        self.assertEqual(registry.symbols(), ['AAPL'])
+        self.assertEqual(len(registry.ema_groups()), 1)
+
+    async def test_deferred_writes(self):
+        registry = TicketRegistry(self.db)
+        ids = [await registry.add_price('AAPL', 100 + i, channelID=1, author=2) for i in range(200)]
+        writes = []
+        write = self.db.write
+
+        async def counted(fn):
+            writes.append(fn)
+            return await write(fn)
+
+        self.db.write = counted
+        timeout = int(time.time()) + 1000
+        for _id in ids[:150]:
+            await registry.defer_timeout(_id, timeout)
+        for _id in ids[150:]:
+            await registry.defer_delete(_id)
+
+        # Cooled down in memory before anything is written
+        self.assertEqual(len(registry.get('AAPL').match(120, now=time.time())), 0)
+        self.assertEqual(len(writes), 0)
+
+        await registry.flush()
+        await registry.flush()
+        self.assertEqual(len(writes), 1)
+
+        del self.db.write
+        self.assertEqual(len(await self.db.get_all_price()), 150)
+        self.assertEqual(len(await self.db.get_all_price(active=True)), 0)
+
+    async def asyncTearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
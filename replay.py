@@ -0,0 +1,280 @@
+"""
+Replays stored historical bars through the price and EMA trigger logic, to see when tickets would have alerted
+
+Run with: python replay.py --start 2024-01-01 --end 2024-03-31 --csv alerts.csv
+"""
+import argparse
+import time
+import unittest
+from typing import Dict, List, TypedDict
+import numpy as np
+import pandas as pd
+import api
+from candle_store import CandleStore
+from ema import EMA
+from ema_state import alpha, ema_series
+from price import Price, PriceTicket
+from sql import SQL
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+# Most (ticket, bar) pairs compared at once, bounds memory of the comparison matrix
+CHUNK = 4_000_000
+
+
+class Alert(TypedDict):
+    t: int
+    symbol: str
+    _id: str
+    kind: str
+    price: float
+    level: float
+    until: int
+
+
+def cooldown(times: np.ndarray, duration: int) -> np.ndarray:
+    """
+    times - sorted UNIX timestamps a ticket's condition was true at
+    duration - seconds the ticket is timed out after alerting
+
+    returns indices of times the ticket alerts at. Like the monitor, a ticket alerts again only once
+    its timeout is in the past
+    """
+    alerts = []
+    i = 0
+    while i < len(times):
+        alerts.append(i)
+        i = np.searchsorted(times, times[i] + duration, side='right')
+    return np.array(alerts, dtype=np.int64)
+
+
+def replay_prices(symbol: str, bars: Dict[str, np.ndarray], tickets: List[PriceTicket]) -> List[Alert]:
+    """
+    bars - { t, o, h, l, c, v } arrays of base bars, oldest first
+    tickets - price tickets of symbol
+
+    returns alerts of the tickets. A bar hits a ticket if its low to high range overlaps
+    price - margin to price + margin, the live monitor polls often enough to see most of a bar's range
+    """
+    if len(tickets) == 0 or len(bars['t']) == 0:
+        return []
+
+    t, h, l, c = bars['t'], bars['h'], bars['l'], bars['c']
+    price = np.array([x['price'] for x in tickets])
+    margin = np.array([x['margin'] for x in tickets])
+    duration = Price(symbol).timeout()
+
+    alerts = []
+    step = max(1, CHUNK // len(t))
+    for start in range(0, len(tickets), step):
+        p = price[start:start + step, None]
+        m = margin[start:start + step, None]
+        hit = (l[None, :] < p + m) & (h[None, :] > p - m)
+
+        rows, cols = np.nonzero(hit)
+        # Rows come out in order, so every ticket's hits are one contiguous run
+        bounds = np.searchsorted(rows, np.arange(hit.shape[0] + 1))
+        for j in range(hit.shape[0]):
+            hits = cols[bounds[j]:bounds[j + 1]]
+            if len(hits) == 0:
+                continue
+            ticket = tickets[start + j]
+            for i in hits[cooldown(t[hits], duration)]:
+                alerts.append(Alert(t=int(t[i]), symbol=symbol, _id=ticket['_id'], kind="price",
+                                    price=float(c[i]), level=ticket['price'], until=int(t[i]) + duration))
+    return alerts
+
+
+def replay_emas(symbol: str, bars: Dict[str, np.ndarray], tickets: List[EMA], session=False) -> List[Alert]:
+    """
+    bars - { t, o, h, l, c, v } arrays of base bars, oldest first
+    tickets - EMA tickets of symbol
+    session - align candles to the market open, must match how the provider aggregates
+
+    returns alerts of the tickets. At every base bar the candle in progress has the high and low so far and
+    the EMA is updated with its close so far, same as EMAEngine.compute treats the last bar
+    """
+    if len(tickets) == 0 or len(bars['t']) == 0:
+        return []
+
+    t = bars['t']
+    series: Dict[tuple, List[EMA]] = {}
+    for ticket in tickets:
+        series.setdefault((ticket.timeframe, ticket.multiplier), []).append(ticket)
+
+    candles = api.resample(t, bars['o'], bars['h'], bars['l'], bars['c'], bars['v'], list(series.keys()), session=session)
+
+    alerts = []
+    for (timeframe, multiplier), group in series.items():
+        candle = candles[(timeframe, multiplier)]
+        # Candle in progress at every base bar
+        k = np.searchsorted(candle['t'], t, side='right') - 1
+        high = pd.Series(bars['h']).groupby(k).cummax().to_numpy()
+        low = pd.Series(bars['l']).groupby(k).cummin().to_numpy()
+
+        periods = sorted({x.periods for x in group})
+        closed = ema_series(candle['c'], periods)
+        emas = {}
+        for p in periods:
+            previous = np.concatenate(([np.nan], closed[p]))[k]
+            a = alpha(p)
+            emas[p] = a * bars['c'] + (1 - a) * previous
+
+        for ticket in group:
+            ema = emas[ticket.periods]
+            hits = np.flatnonzero((low * (1 - ticket.margin) < ema) & (ema < high * (1 + ticket.margin)))
+            duration = ticket.timeout()
+            for i in hits[cooldown(t[hits], duration)]:
+                alerts.append(Alert(t=int(t[i]), symbol=symbol, _id=ticket._id, kind="ema",
+                                    price=float(bars['c'][i]), level=float(ema[i]), until=int(t[i]) + duration))
+    return alerts
+
+
+class Replay:
+    def __init__(self, store: CandleStore, timeframe="minute", session=False):
+        """
+        store - stored historical bars
+        timeframe - base bars to replay, the finer the closer to live polling
+        session - align candles to the market open, must match how the provider aggregates
+        """
+        self.store = store
+        self.timeframe = timeframe
+        self.session = session
+
+    def run(self, prices: List[PriceTicket], emas: List[EMA], start: int, end: int) -> pd.DataFrame:
+        """
+        prices, emas - tickets to replay
+        start, end - UNIX timestamps of the period to replay
+
+        returns alert timeline, one row per alert sorted by time, with when its timeout ends
+        """
+        by_symbol: Dict[str, List] = {}
+        for ticket in prices:
+            by_symbol.setdefault(ticket['symbol'], [[], []])[0].append(ticket)
+        for ticket in emas:
+            by_symbol.setdefault(ticket.symbol, [[], []])[1].append(ticket)
+
+        started = time.perf_counter()
+        alerts: List[Alert] = []
+        bars_replayed = 0
+        for symbol, (p, e) in by_symbol.items():
+            bars = self.store.get_range(symbol, self.timeframe, start, end)
+            if len(bars['t']) == 0:
+                logger.error(f"No stored {self.timeframe} bars of {symbol}, download them first")
+                continue
+            bars_replayed += len(bars['t'])
+            alerts += replay_prices(symbol, bars, p)
+            alerts += replay_emas(symbol, bars, e, session=self.session)
+
+        logger.info(f"Replayed {bars_replayed} bars of {len(by_symbol)} symbols in {time.perf_counter() - started:.2f}s, {len(alerts)} alerts")
+        timeline = pd.DataFrame(alerts, columns=list(Alert.__annotations__))
+        return timeline.sort_values(["t", "_id"], kind="stable").reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay stored bars through the tickets' trigger logic")
+    parser.add_argument("--start", required=True, help="First day to replay, such as 2024-01-01")
+    parser.add_argument("--end", required=True, help="Last day to replay")
+    parser.add_argument("--db", default="alerts.db", help="Tickets to replay")
+    parser.add_argument("--store", default="candles.db", help="Stored bars, see CANDLE_STORE")
+    parser.add_argument("--csv", help="Write the alert timeline to this file")
+    parser.add_argument("--session", action="store_true", help="Align hour and day candles to the market open, like TD Ameritrade")
+    args = parser.parse_args()
+
+    start = int(pd.Timestamp(args.start, tz=api.tz).timestamp())
+    end = int((pd.Timestamp(args.end, tz=api.tz) + pd.Timedelta(days=1)).timestamp()) - 1
+
+    db = SQL(args.db)
+    timeline = Replay(CandleStore(args.store), session=args.session).run(db.get_all_price(), db.get_all_ema(), start, end)
+
+    print(timeline.groupby(["symbol", "_id"]).size().rename("alerts").to_string())
+    if args.csv:
+        timeline.to_csv(args.csv, index=False)
+
+
+class Test(unittest.TestCase):
+    def bars(self, n: int, seed=0, start=1704205800) -> Dict[str, np.ndarray]:
+        rng = np.random.default_rng(seed)
+        c = 100 * np.exp(np.cumsum(rng.normal(0, 0.001, n)))
+        o = np.concatenate(([100.0], c[:-1]))
+        spread = np.abs(rng.normal(0, 0.05, n))
+        return {
+            "t": start + np.arange(n, dtype=np.int64) * 60,
+            "o": o,
+            "h": np.maximum(o, c) + spread,
+            "l": np.minimum(o, c) - spread,
+            "c": c,
+            "v": np.full(n, 100.0),
+        }
+
+    def test_cooldown(self):
+        times = np.array([0, 10, 50, 100, 101, 250])
+        self.assertEqual(cooldown(times, 100).tolist(), [0, 4, 5])
+
+    def test_prices_same_as_loop(self):
+        bars = self.bars(5000)
+        rng = np.random.default_rng(1)
+        tickets = [PriceTicket(_id=f"price_{i}", symbol="AAPL", price=float(rng.uniform(90, 110)), margin=0.25,
+                               channelID=1, authorID=2, timeout=0) for i in range(50)]
+        alerts = replay_prices("AAPL", bars, tickets)
+
+        # One bar at a time, the way the monitor sees it
+        expected = []
+        until = {x['_id']: 0 for x in tickets}
+        for i in range(len(bars['t'])):
+            for x in tickets:
+                if until[x['_id']] < bars['t'][i] and bars['l'][i] < x['price'] + x['margin'] and bars['h'][i] > x['price'] - x['margin']:
+                    until[x['_id']] = bars['t'][i] + 24 * 3600
+                    expected.append((int(bars['t'][i]), x['_id']))
+
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(sorted((a['t'], a['_id']) for a in alerts), sorted(expected))
+
+    def test_emas_same_as_engine(self):
+        bars = self.bars(3000)
+        ticket = EMA('AAPL', 'hour', 8, channelID=1, author=2, _id='ema_1', margin=0.0005)
+        alerts = replay_emas("AAPL", bars, [ticket])
+        self.assertGreater(len(alerts), 0)
+
+        # EMA at each alert is what the live monitor would have computed from the bars up to then
+        for alert in alerts[:20]:
+            i = int(np.searchsorted(bars['t'], alert['t']))
+            upto = {k: v[:i + 1] for k, v in bars.items()}
+            candles = api.resample(upto['t'], upto['o'], upto['h'], upto['l'], upto['c'], upto['v'], [('hour', 1)])[('hour', 1)]
+            self.assertAlmostEqual(alert['level'], ema_series(candles['c'], [8])[8][-1])
+            self.assertTrue(candles['l'][-1] * (1 - ticket.margin) < alert['level'] < candles['h'][-1] * (1 + ticket.margin))
+
+        gaps = np.diff([a['t'] for a in alerts])
+        self.assertTrue((gaps > ticket.timeout()).all())
+
+    def test_year_of_minutes(self):
+        store = CandleStore(':memory:')
+        symbols = [f"S{i}" for i in range(5)]
+        prices, emas = [], []
+        for j, symbol in enumerate(symbols):
+            bars = self.bars(390 * 252, seed=j)
+            store.put_arrays(symbol, "minute", bars)
+            prices += [PriceTicket(_id=f"price_{symbol}_{i}", symbol=symbol, price=90.0 + i, margin=0.5,
+                                   channelID=1, authorID=2, timeout=0) for i in range(40)]
+            emas += [EMA(symbol, tf, p, channelID=1, author=2, _id=f"ema_{symbol}_{tf}_{p}")
+                     for tf in ('hour', 'day') for p in (8, 21, 50, 200)]
+
+        timeline = Replay(store).run(prices, emas, 0, 2 ** 31)
+
+        self.assertGreater(len(timeline), 0)
+        self.assertTrue(timeline['t'].is_monotonic_increasing)
+        self.assertEqual(set(timeline['kind']), {"price", "ema"})
+
+    def test_session_candles(self):
+        # From the 9:30 open, session hour candles start at 9:30 instead of 9:00
+        bars = self.bars(390 * 5)
+        ticket = EMA("AAPL", "hour", 8, channelID=1, author=2, _id="ema_1")
+
+        aligned = replay_emas("AAPL", bars, [ticket], session=True)
+        self.assertGreater(len(aligned), 0)
+        self.assertNotEqual([a['level'] for a in aligned], [a['level'] for a in replay_emas("AAPL", bars, [ticket])])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Local stand in for the Alpaca market data stream, replays recorded trades so streaming can be tested offline
+
+Recordings are JSON lines, one trade per line: {"S": "AAPL", "p": 133.61, "t": "2021-04-20T15:00:00Z"}
+Run with: python replay_server.py ticks.jsonl --port 8765 --speed 10
+"""
+import argparse
+import asyncio
+import json
+from typing import List, Set
+import pandas as pd
+from aiohttp import web, WSMsgType
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def tick_time(t) -> float:
+    """
+    t - RFC3339 string or UNIX seconds
+
+    returns fractional UNIX seconds, so sub second spacing is kept when replaying
+    """
+    if isinstance(t, str):
+        return pd.Timestamp(t).value / 1e9
+    return float(t)
+
+
+def load_ticks(path: str) -> List[dict]:
+    """
+    path - JSON lines file of recorded trades
+
+    returns trades sorted by time
+    """
+    with open(path) as f:
+        ticks = [json.loads(line) for line in f if line.strip()]
+    return sorted(ticks, key=lambda m: tick_time(m["t"]))
+
+
+class ReplayServer:
+    def __init__(self, ticks: List[dict], speed=1.0, loop_forever=False):
+        """
+        ticks - recorded trades, each with S (symbol), p (price) and t (timestamp)
+        speed - how many times faster than recorded the trades are replayed
+        loop_forever - start over from the first trade once the recording ends
+        """
+        self.ticks = ticks
+        self.speed = speed
+        self.loop_forever = loop_forever
+        self.runner = None
+
+    async def start(self, host="127.0.0.1", port=8765) -> int:
+        """
+        returns port the server listens on, pass 0 to pick a free one
+        """
+        app = web.Application()
+        app.router.add_get("/stream", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"Replaying {len(self.ticks)} trades on ws://{host}:{port}/stream")
+        return port
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json([{"T": "success", "msg": "connected"}])
+
+        auth = await ws.receive_json()
+        if auth.get("action") != "auth":
+            await ws.send_json([{"T": "error", "code": 401, "msg": "not authenticated"}])
+            await ws.close()
+            return ws
+        await ws.send_json([{"T": "success", "msg": "authenticated"}])
+
+        subscribed: Set[str] = set()
+        replay = asyncio.create_task(self.replay(ws, subscribed))
+
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    break
+                m = msg.json()
+                trades = set(m.get("trades", []))
+                if m.get("action") == "subscribe":
+                    subscribed |= trades
+                elif m.get("action") == "unsubscribe":
+                    subscribed -= trades
+                await ws.send_json([{"T": "subscription", "trades": sorted(subscribed)}])
+        finally:
+            replay.cancel()
+
+        return ws
+
+    async def replay(self, ws: web.WebSocketResponse, subscribed: Set[str]) -> None:
+        while True:
+            previous = None
+            for tick in self.ticks:
+                t = tick_time(tick["t"])
+                if previous is not None and t > previous:
+                    await asyncio.sleep((t - previous) / self.speed)
+                previous = t
+
+                if tick["S"] in subscribed and not ws.closed:
+                    await ws.send_json([{"T": "t", "S": tick["S"], "p": tick["p"], "t": tick["t"]}])
+
+            if not self.loop_forever:
+                return
+            # Keep from spinning when nothing in the recording is subscribed
+            await asyncio.sleep(0.01)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay recorded trades over a local websocket")
+    parser.add_argument("path", help="JSON lines file of recorded trades")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--loop", action="store_true", help="Replay forever")
+    args = parser.parse_args()
+
+    server = ReplayServer(load_ticks(args.path), speed=args.speed, loop_forever=args.loop)
+    await server.start(port=args.port)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,412 @@
+"""
+Indicators over one OHLCV series: EMA, SMA, RSI, ATR and VWAP. Every requested period is computed in one
+vectorized pass over shared arrays, after that each new bar is an O(1) update of the kept state
+"""
+import unittest
+from collections import deque
+from typing import Deque, Dict, List, Tuple, TypedDict
+import numpy as np
+import pandas as pd
+import api
+from ema_state import WARMUP, EMAState, alpha, ema_series, update as ema_update
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+INDICATORS = ("ema", "sma", "rsi", "atr", "vwap")
+# VWAP has no period, it starts over every session. Bars to seed it with, a session of minute bars
+VWAP_HISTORY = 400
+
+# { indicator: [periods] }, such as { "rsi": [14], "ema": [8, 21] }, VWAP uses period 0
+Spec = Dict[str, List[int]]
+Values = Dict[str, Dict[int, float]]
+
+
+class SMAState(TypedDict):
+    window: Deque[float]
+    total: float
+
+
+class RSIState(TypedDict):
+    gain: float
+    loss: float
+    c: float
+
+
+class ATRState(TypedDict):
+    atr: float
+    c: float
+
+
+class VWAPState(TypedDict):
+    pv: float
+    v: float
+    day: int
+
+
+def wilder(x: np.ndarray, periods: int) -> np.ndarray:
+    """
+    x - values to smooth, such as gains or true ranges, the first one is never used
+
+    returns Wilder's moving average, seeded with the mean of x[1:periods + 1] like talib. NaN before that
+    """
+    out = np.full(len(x), np.nan)
+    if len(x) <= periods:
+        return out
+
+    seeded = np.concatenate(([x[1:periods + 1].mean()], x[periods + 1:]))
+    out[periods:] = pd.Series(seeded).ewm(alpha=1 / periods, adjust=False).mean().to_numpy()
+    return out
+
+
+def sma_series(c: np.ndarray, periods: List[int]) -> Dict[int, np.ndarray]:
+    """
+    returns { periods: simple moving average of c }, NaN until there are enough closes
+    """
+    csum = np.concatenate(([0.0], np.cumsum(c)))
+    result = {}
+    for p in periods:
+        out = np.full(len(c), np.nan)
+        if len(c) >= p:
+            out[p - 1:] = (csum[p:] - csum[:-p]) / p
+        result[p] = out
+    return result
+
+
+def rsi_parts(c: np.ndarray, periods: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    returns (average gain, average loss) arrays of Wilder's RSI
+    """
+    change = np.diff(c, prepend=c[0] if len(c) else 0.0)
+    return wilder(np.maximum(change, 0), periods), wilder(np.maximum(-change, 0), periods)
+
+
+def rsi_value(gain: np.ndarray, loss: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total = gain + loss
+        return np.where(total == 0, 0.0, 100 * gain / total)
+
+
+def rsi_series(c: np.ndarray, periods: List[int]) -> Dict[int, np.ndarray]:
+    """
+    returns { periods: RSI of c }, same as talib.RSI
+    """
+    return {p: rsi_value(*rsi_parts(c, p)) for p in periods}
+
+
+def true_range(h: np.ndarray, l: np.ndarray, c: np.ndarray) -> np.ndarray:
+    previous = np.concatenate(([np.nan], c[:-1]))
+    return np.fmax(h - l, np.fmax(np.abs(h - previous), np.abs(l - previous)))
+
+
+def atr_series(h: np.ndarray, l: np.ndarray, c: np.ndarray, periods: List[int]) -> Dict[int, np.ndarray]:
+    """
+    returns { periods: average true range }, same as talib.ATR
+    """
+    tr = true_range(h, l, c)
+    return {p: wilder(tr, p) for p in periods}
+
+
+def sessions(t: np.ndarray) -> np.ndarray:
+    """
+    returns New York day of every timestamp, VWAP starts over when it changes
+    """
+    return (t + api.utc_offsets(t)) // 86400
+
+
+def vwap_series(t: np.ndarray, h: np.ndarray, l: np.ndarray, c: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """
+    returns volume weighted average of the typical price since the start of each bar's session
+    """
+    if len(t) == 0:
+        return np.array([])
+
+    day = sessions(t)
+    starts = np.flatnonzero(np.concatenate(([True], day[1:] != day[:-1])))
+    group = np.repeat(np.arange(len(starts)), np.diff(np.concatenate((starts, [len(t)]))))
+
+    pv = np.cumsum((h + l + c) / 3 * v)
+    vol = np.cumsum(v)
+    # Running sums minus everything before the session
+    pv -= np.concatenate(([0.0], pv))[starts][group]
+    vol -= np.concatenate(([0.0], vol))[starts][group]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(vol > 0, pv / vol, c)
+
+
+def arrays(bars) -> Dict[str, np.ndarray]:
+    """
+    bars - DataFrame or dict of t, o, h, l, c, v
+
+    returns float arrays, t as int
+    """
+    result = {k: np.asarray(bars[k], dtype=np.float64) for k in ('o', 'h', 'l', 'c', 'v')}
+    result['t'] = np.asarray(bars['t'], dtype=np.int64)
+    return result
+
+
+def compute(bars, spec: Spec) -> Dict[str, Dict[int, np.ndarray]]:
+    """
+    bars - t, o, h, l, c, v of the series, oldest first
+    spec - every indicator and period to compute
+
+    returns { indicator: { periods: array } } over every bar
+    """
+    b = arrays(bars)
+    result = {}
+    for kind, periods in spec.items():
+        if kind == "ema":
+            result[kind] = ema_series(b['c'], periods)
+        elif kind == "sma":
+            result[kind] = sma_series(b['c'], periods)
+        elif kind == "rsi":
+            result[kind] = rsi_series(b['c'], periods)
+        elif kind == "atr":
+            result[kind] = atr_series(b['h'], b['l'], b['c'], periods)
+        elif kind == "vwap":
+            result[kind] = {p: vwap_series(b['t'], b['h'], b['l'], b['c'], b['v']) for p in periods}
+        else:
+            raise ValueError(f"Unknown indicator {kind}, use one of {', '.join(INDICATORS)}")
+    return result
+
+
+def seed(bars: Dict[str, np.ndarray], kind: str, periods: int):
+    """
+    bars - closed bars of the series as arrays
+
+    returns state after the last bar, None if there are not enough bars
+    """
+    t, h, l, c, v = bars['t'], bars['h'], bars['l'], bars['c'], bars['v']
+    n = len(c)
+    if n == 0:
+        return None
+
+    if kind == "ema":
+        if n < periods:
+            return None
+        return EMAState(value=float(ema_series(c, [periods])[periods][-1]), t=int(t[-1]))
+    if kind == "sma":
+        if n < periods:
+            return None
+        window = deque(c[-periods:].tolist(), maxlen=periods)
+        return SMAState(window=window, total=float(sum(window)))
+    if kind == "rsi":
+        if n <= periods:
+            return None
+        gain, loss = rsi_parts(c, periods)
+        return RSIState(gain=float(gain[-1]), loss=float(loss[-1]), c=float(c[-1]))
+    if kind == "atr":
+        if n <= periods:
+            return None
+        return ATRState(atr=float(wilder(true_range(h, l, c), periods)[-1]), c=float(c[-1]))
+    if kind == "vwap":
+        day = sessions(t)
+        today = day == day[-1]
+        # Without a bar of an earlier day, the first bar has to be at the open, otherwise the start of the session is missing
+        if today.all() and (t[0] + api.utc_offsets(t[:1])[0]) % 86400 > api.SESSION_OPEN:
+            return None
+        return VWAPState(pv=float(((h + l + c) / 3 * v)[today].sum()), v=float(v[today].sum()), day=int(day[-1]))
+    raise ValueError(f"Unknown indicator {kind}, use one of {', '.join(INDICATORS)}")
+
+
+def advance(kind: str, periods: int, state, bar: api.Candle):
+    """
+    state - state after the previous bar, SMA windows are advanced in place
+    bar - newly closed bar
+
+    returns state including bar, O(1)
+    """
+    c = bar['c']
+    if kind == "ema":
+        return ema_update(state, c, bar['t'], periods)
+    if kind == "sma":
+        # The window is shared with the previous state, it is only ever advanced
+        window = state['window']
+        total = state['total'] + c - window[0]
+        window.append(c)
+        return SMAState(window=window, total=total)
+    if kind == "rsi":
+        change = c - state['c']
+        return RSIState(gain=(state['gain'] * (periods - 1) + max(change, 0)) / periods,
+                        loss=(state['loss'] * (periods - 1) + max(-change, 0)) / periods, c=c)
+    if kind == "atr":
+        tr = max(bar['h'] - bar['l'], abs(bar['h'] - state['c']), abs(bar['l'] - state['c']))
+        return ATRState(atr=(state['atr'] * (periods - 1) + tr) / periods, c=c)
+    if kind == "vwap":
+        day = int(sessions(np.array([bar['t']], dtype=np.int64))[0])
+        pv, v = (state['pv'], state['v']) if day == state['day'] else (0.0, 0.0)
+        return VWAPState(pv=pv + (bar['h'] + bar['l'] + c) / 3 * bar['v'], v=v + bar['v'], day=day)
+    raise ValueError(f"Unknown indicator {kind}, use one of {', '.join(INDICATORS)}")
+
+
+def value(kind: str, periods: int, state, bar: api.Candle) -> float:
+    """
+    bar - bar in progress
+
+    returns indicator including bar, without changing state
+    """
+    if state is None:
+        return float('nan')
+
+    c = bar['c']
+    if kind == "ema":
+        a = alpha(periods)
+        return a * c + (1 - a) * state['value']
+    if kind == "sma":
+        return (state['total'] + c - state['window'][0]) / periods
+    if kind == "rsi":
+        change = c - state['c']
+        gain = (state['gain'] * (periods - 1) + max(change, 0)) / periods
+        loss = (state['loss'] * (periods - 1) + max(-change, 0)) / periods
+        return 0.0 if gain + loss == 0 else 100 * gain / (gain + loss)
+    if kind == "atr":
+        tr = max(bar['h'] - bar['l'], abs(bar['h'] - state['c']), abs(bar['l'] - state['c']))
+        return (state['atr'] * (periods - 1) + tr) / periods
+    if kind == "vwap":
+        s = advance(kind, periods, VWAPState(**state), bar)
+        return s['pv'] / s['v'] if s['v'] > 0 else c
+    raise ValueError(f"Unknown indicator {kind}, use one of {', '.join(INDICATORS)}")
+
+
+class SeriesState(TypedDict):
+    t: int
+    states: Dict[Tuple[str, int], object]
+
+
+class IndicatorEngine:
+    """
+    Keeps indicator states of every (symbol, timeframe, multiplier) series in memory. Like EMAEngine, the last
+    bar passed in is treated as in progress, it is included in the returned values but only stored once a newer
+    bar closes it
+    """
+    def __init__(self):
+        self.series: Dict[Tuple[str, str, int], SeriesState] = {}
+
+    def history_needed(self, symbol: str, timeframe: str, multiplier: int, spec: Spec) -> int:
+        """
+        returns how many bars compute needs, a few when every state is kept, enough to seed otherwise
+        """
+        kept = self.series.get((symbol, timeframe, multiplier))
+        needed = [(k, p) for k, periods in spec.items() for p in periods]
+        if kept is not None and all(kept['states'].get(x) is not None for x in needed):
+            return 3
+        return max([VWAP_HISTORY if k == "vwap" else p * WARMUP for k, p in needed] + [3])
+
+    def compute(self, symbol: str, timeframe: str, multiplier: int, candles, spec: Spec) -> Values:
+        """
+        candles - bars of the series, oldest first, last one in progress
+        spec - every indicator and period to compute
+
+        returns { indicator: { periods: value of the in progress bar } }, NaN if there is not enough history
+        """
+        b = arrays(candles)
+        t = b['t']
+        closed = len(t) - 1
+        key = (symbol, timeframe, multiplier)
+        kept = self.series.get(key)
+
+        # The kept state has to be one of the closed bars, otherwise there is a gap and it is seeded again
+        if kept is None or closed < 1 or kept['t'] < t[0] or kept['t'] > t[closed - 1]:
+            kept = self.series[key] = SeriesState(t=int(t[closed - 1]) if closed >= 1 else -1, states={})
+            new = []
+        else:
+            new = np.flatnonzero(t[:closed] > kept['t'])
+
+        history = {k: a[:closed] for k, a in b.items()}
+        for i in new:
+            bar = api.Candle(t=int(t[i]), o=b['o'][i], h=b['h'][i], l=b['l'][i], c=b['c'][i], v=b['v'][i])
+            for (kind, p), state in kept['states'].items():
+                if state is not None:
+                    kept['states'][(kind, p)] = advance(kind, p, state, bar)
+        if closed >= 1:
+            kept['t'] = int(t[closed - 1])
+
+        current = api.Candle(t=int(t[-1]), o=b['o'][-1], h=b['h'][-1], l=b['l'][-1], c=b['c'][-1], v=b['v'][-1])
+        result: Values = {}
+        for kind, periods in spec.items():
+            result[kind] = {}
+            for p in periods:
+                if kept['states'].get((kind, p)) is None:
+                    kept['states'][(kind, p)] = seed(history, kind, p)
+                result[kind][p] = value(kind, p, kept['states'][(kind, p)], current)
+        return result
+
+    def invalidate(self, symbol: str) -> None:
+        """
+        symbol - stock symbol that had a corporate action, such as a split
+        """
+        self.series = {k: v for k, v in self.series.items() if k[0] != symbol}
+
+
+class Test(unittest.TestCase):
+    def bars(self, n: int, seed=0) -> pd.DataFrame:
+        rng = np.random.default_rng(seed)
+        c = 100 + np.cumsum(rng.normal(0, 1, n))
+        o = np.concatenate(([100.0], c[:-1]))
+        return pd.DataFrame({
+            "t": 1704205800 + np.arange(n) * 3600,
+            "o": o,
+            "h": np.maximum(o, c) + rng.uniform(0, 1, n),
+            "l": np.minimum(o, c) - rng.uniform(0, 1, n),
+            "c": c,
+            "v": rng.integers(100, 1000, n).astype(np.float64),
+        })
+
+    def test_same_as_talib(self):
+        import talib
+        b = arrays(self.bars(500))
+        result = compute(b, {"sma": [5, 20], "rsi": [14, 2], "atr": [14], "ema": [21]})
+        for p in (5, 20):
+            np.testing.assert_allclose(result["sma"][p], talib.SMA(b['c'], p), equal_nan=True)
+        for p in (14, 2):
+            np.testing.assert_allclose(result["rsi"][p], talib.RSI(b['c'], p), equal_nan=True)
+        np.testing.assert_allclose(result["atr"][14], talib.ATR(b['h'], b['l'], b['c'], 14), equal_nan=True)
+        np.testing.assert_allclose(result["ema"][21], talib.EMA(b['c'], 21), equal_nan=True)
+
+    def test_vwap_resets_every_session(self):
+        b = arrays(self.bars(48))
+        vwap = vwap_series(b['t'], b['h'], b['l'], b['c'], b['v'])
+        day = sessions(b['t'])
+        for d in np.unique(day):
+            i = np.flatnonzero(day == d)
+            typical = (b['h'][i] + b['l'][i] + b['c'][i]) / 3
+            np.testing.assert_allclose(vwap[i], np.cumsum(typical * b['v'][i]) / np.cumsum(b['v'][i]))
+
+    def test_incremental_same_as_full(self):
+        candles = self.bars(600)
+        spec = {"ema": [8], "sma": [20], "rsi": [14], "atr": [14], "vwap": [0]}
+        engine = IndicatorEngine()
+
+        self.assertEqual(engine.history_needed("AAPL", "hour", 1, spec), VWAP_HISTORY)
+        engine.compute("AAPL", "hour", 1, candles.iloc[:450], spec)
+        self.assertEqual(engine.history_needed("AAPL", "hour", 1, spec), 3)
+
+        for end in range(451, 600):
+            result = engine.compute("AAPL", "hour", 1, candles.iloc[end - 3:end], spec)
+
+        full = compute(candles.iloc[:599], spec)
+        for kind, periods in spec.items():
+            for p in periods:
+                self.assertAlmostEqual(result[kind][p], full[kind][p][-1], msg=kind)
+
+    def test_vwap_after_gap(self):
+        candles = self.bars(400)
+        spec = {"vwap": [0]}
+        engine = IndicatorEngine()
+        engine.compute("AAPL", "hour", 1, candles.iloc[:100], spec)
+
+        # The few bars fetched after a gap start mid session, VWAP waits for a whole session
+        self.assertTrue(np.isnan(engine.compute("AAPL", "hour", 1, candles.iloc[200:203], spec)["vwap"][0]))
+        self.assertEqual(engine.history_needed("AAPL", "hour", 1, spec), VWAP_HISTORY)
+
+        result = engine.compute("AAPL", "hour", 1, candles.iloc[204 - VWAP_HISTORY // 2:204], spec)
+        self.assertAlmostEqual(result["vwap"][0], compute(candles.iloc[:204], spec)["vwap"][0][-1])
+
+    def test_not_enough_history(self):
+        result = IndicatorEngine().compute("AAPL", "hour", 1, self.bars(10), {"rsi": [14], "sma": [5]})
+        self.assertTrue(np.isnan(result["rsi"][14]))
+        self.assertFalse(np.isnan(result["sma"][5]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,612 @@
+"""
+Rule tickets, several conditions combined with and/or, such as
+"AAPL crosses 150 and 1H RSI < 30 and price within 0.2% of 50EMA"
+
+Every rule is compiled into one shared expression DAG. Identical subexpressions, such as the quote of a symbol
+or the 14 RSI of its hourly series, are a single node, so each is fetched and computed once per cycle no matter
+how many users' rules use it
+"""
+import math
+import re
+import time
+import unittest
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import numpy as np
+import api
+from evaluator import EVALUATED, Evaluator
+from rsi import INDICATORS, IndicatorEngine, Spec
+from ticket import Ticket
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+# Periods used when an indicator is written without one, such as "1H RSI"
+DEFAULT_PERIODS = {"rsi": 14, "atr": 14, "vwap": 0}
+# Timeframe used when an indicator is written without one
+DEFAULT_TIMEFRAME = ("day", 1)
+TIMEFRAMES = {"m": "minute", "h": "hour", "d": "day", "w": "week"}
+COMPARISONS = {"<": "<", ">": ">", "<=": "<=", ">=": ">=", "above": ">", "below": "<"}
+
+TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<series>\d+(?P<sunit>[mhdw])(?![a-z0-9]))
+      | (?P<short>\d+(?P<skind>ema|sma|rsi|atr)(?![a-z0-9]))
+      | (?P<number>\d+(?:\.\d+)?|\.\d+)(?P<percent>%)?
+      | (?P<word>[a-z_][a-z0-9_.]*)
+      | (?P<op><=|>=|<|>|\(|\))
+    )""", re.IGNORECASE | re.VERBOSE)
+
+# Node keys, children are ids of nodes added before them:
+# ("const", value), ("price", symbol), ("indicator", symbol, timeframe, multiplier, kind, periods),
+# ("compare", op, a, b), ("cross", direction, a, b), ("within", distance, percent, a, b),
+# ("and", children), ("or", children)
+Key = tuple
+
+
+def tokenize(expression: str) -> List[Tuple[str, object]]:
+    """
+    returns (kind, value) tokens of expression
+    """
+    tokens = []
+    i = 0
+    expression = expression.strip()
+    while i < len(expression):
+        m = TOKEN.match(expression, i)
+        if m is None or m.end() == i:
+            raise ValueError(f"Could not read '{expression[i:].strip()}'")
+        i = m.end()
+
+        if m.group("series"):
+            tokens.append(("series", (TIMEFRAMES[m.group("sunit").lower()], int(m.group("series")[:-1]))))
+        elif m.group("short"):
+            tokens.append(("short", (m.group("skind").lower(), int(m.group("short")[:-3]))))
+        elif m.group("number"):
+            tokens.append(("number", (float(m.group("number")), m.group("percent") is not None)))
+        elif m.group("word"):
+            tokens.append(("word", m.group("word")))
+        else:
+            tokens.append(("op", m.group("op")))
+    return tokens
+
+
+class Graph:
+    """
+    Interned expression nodes, adding a key that is already there returns the existing node
+    """
+    def __init__(self):
+        self.keys: List[Key] = []
+        self.index: Dict[Key, int] = {}
+
+    def add(self, key: Key) -> int:
+        node = self.index.get(key)
+        if node is None:
+            node = self.index[key] = len(self.keys)
+            self.keys.append(key)
+        return node
+
+    def children(self, node: int) -> List[int]:
+        key = self.keys[node]
+        if key[0] in ("and", "or"):
+            return list(key[1])
+        if key[0] in ("compare", "cross", "within"):
+            return list(key[-2:])
+        return []
+
+    def relabel(self, key: Key, ids: Dict[int, int]) -> Key:
+        """
+        returns key with its children replaced by ids[child]
+        """
+        if key[0] in ("and", "or"):
+            return (key[0], tuple(ids[c] for c in key[1]))
+        if key[0] in ("compare", "cross", "within"):
+            return key[:-2] + (ids[key[-2]], ids[key[-1]])
+        return key
+
+    def reachable(self, roots: List[int]) -> List[int]:
+        """
+        returns every node the roots depend on, children before parents
+        """
+        seen: Set[int] = set()
+        stack = list(roots)
+        while stack:
+            node = stack.pop()
+            if node not in seen:
+                seen.add(node)
+                stack += self.children(node)
+        # Children are always added before their parents, so id order is a topological order
+        return sorted(seen)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class Parser:
+    """
+    Recursive descent over the tokens of one rule, "and" binds tighter than "or":
+
+    expression := conjunction ("or" conjunction)*
+    conjunction := condition ("and" condition)*
+    condition := "(" expression ")" | operand (comparison operand | "crosses" [above|below] operand | "within" number "of" operand)
+    operand := number | [SYMBOL] ["price" | [timeframe] indicator]
+    indicator := 50EMA | rsi | rsi(14) | ema(50) | atr | vwap
+    """
+    def __init__(self, graph: Graph, symbol: str, expression: str):
+        self.graph = graph
+        self.symbol = symbol.upper()
+        self.tokens = tokenize(expression)
+        self.i = 0
+
+    def peek(self) -> Tuple[Optional[str], object]:
+        return self.tokens[self.i] if self.i < len(self.tokens) else (None, None)
+
+    def word(self, *words: str) -> Optional[str]:
+        """
+        returns the next token if it is one of words, and moves past it
+        """
+        kind, value = self.peek()
+        if kind == "word" and value.lower() in words:
+            self.i += 1
+            return value.lower()
+        return None
+
+    def expect(self, kind: str, value=None):
+        k, v = self.peek()
+        if k != kind or (value is not None and v != value):
+            found = "the end" if k is None else f"'{v}'"
+            raise ValueError(f"Expected {value or kind}, found {found}")
+        self.i += 1
+        return v
+
+    def parse(self) -> int:
+        """
+        returns root node of the rule
+        """
+        if len(self.tokens) == 0:
+            raise ValueError("Rule has no conditions")
+        root = self.expression()
+        if self.i < len(self.tokens):
+            raise ValueError(f"Unexpected '{self.tokens[self.i][1]}'")
+        return root
+
+    def combine(self, op: str, nodes: List[int]) -> int:
+        if len(nodes) == 1:
+            return nodes[0]
+        # Sorted and deduplicated, so "a and b" and "b and a" are the same node
+        return self.graph.add((op, tuple(sorted(set(nodes)))))
+
+    def expression(self) -> int:
+        nodes = [self.conjunction()]
+        while self.word("or"):
+            nodes.append(self.conjunction())
+        return self.combine("or", nodes)
+
+    def conjunction(self) -> int:
+        nodes = [self.condition()]
+        while self.word("and"):
+            nodes.append(self.condition())
+        return self.combine("and", nodes)
+
+    def condition(self) -> int:
+        if self.peek() == ("op", "("):
+            self.i += 1
+            node = self.expression()
+            self.expect("op", ")")
+            return node
+
+        a = self.operand()
+        self.word("is")
+        if self.word("crosses", "cross", "crossed"):
+            direction = self.word("above", "below", "over", "under") or "any"
+            direction = {"over": "above", "under": "below"}.get(direction, direction)
+            return self.graph.add(("cross", direction, a, self.operand()))
+
+        if self.word("within"):
+            (distance, percent) = self.expect("number")
+            if not self.word("of"):
+                raise ValueError(f"Expected of after within {distance:g}{'%' if percent else ''}")
+            return self.graph.add(("within", distance, percent, a, self.operand()))
+
+        kind, value = self.peek()
+        op = None
+        if kind == "op" and value in COMPARISONS:
+            op = COMPARISONS[value]
+        elif kind == "word" and value.lower() in COMPARISONS:
+            op = COMPARISONS[value.lower()]
+        if op is None:
+            raise ValueError(f"Expected a comparison, crosses or within after {self.describe(a)}")
+        self.i += 1
+        return self.graph.add(("compare", op, a, self.operand()))
+
+    def operand(self) -> int:
+        kind, value = self.peek()
+        if kind == "number":
+            self.i += 1
+            if value[1]:
+                raise ValueError("Percentages can only be used with within")
+            return self.graph.add(("const", value[0]))
+
+        symbol = self.symbol
+        # Upper case words that are not indicators are symbols, such as SPY in "price > SPY"
+        if kind == "word" and value.isupper() and value.lower() not in INDICATORS + ("price", "and", "or"):
+            symbol = value
+            self.i += 1
+            kind, value = self.peek()
+            if not (kind in ("series", "short") or (kind == "word" and value.lower() in INDICATORS + ("price",))):
+                return self.graph.add(("price", symbol))
+
+        if self.word("price"):
+            return self.graph.add(("price", symbol))
+
+        timeframe, multiplier = DEFAULT_TIMEFRAME
+        if kind == "series":
+            timeframe, multiplier = value
+            self.i += 1
+            kind, value = self.peek()
+
+        if kind == "short":
+            self.i += 1
+            indicator, periods = value
+        elif kind == "word" and value.lower() in INDICATORS:
+            self.i += 1
+            indicator = value.lower()
+            if self.peek() == ("op", "("):
+                self.i += 1
+                periods = self.expect("number")[0]
+                self.expect("op", ")")
+            elif indicator in DEFAULT_PERIODS:
+                periods = DEFAULT_PERIODS[indicator]
+            else:
+                raise ValueError(f"{indicator.upper()} needs a period, such as 50{indicator.upper()} or {indicator}(50)")
+        else:
+            found = "the end" if kind is None else f"'{value}'"
+            raise ValueError(f"Expected a number, price or indicator, found {found}")
+
+        periods = 0 if indicator == "vwap" else int(periods)
+        if indicator != "vwap" and periods < 1:
+            raise ValueError(f"{indicator.upper()} period has to be at least 1")
+        return self.graph.add(("indicator", symbol, timeframe, multiplier, indicator, periods))
+
+    def describe(self, node: int) -> str:
+        key = self.graph.keys[node]
+        if key[0] == "const":
+            return f"{key[1]:g}"
+        if key[0] == "price":
+            return f"{key[1]} price"
+        return f"{key[3]}{key[2]} {key[4].upper()}({key[5]})"
+
+
+class Rule(Ticket):
+    def __init__(self, symbol: str, expression: str, channelID: int, author: int, _id: str, cooldown=0):
+        """
+        symbol - stock the rule is about, "price" and indicators without a symbol refer to it
+        expression - conditions, such as "price crosses 150 and 1H RSI < 30"
+        channelID - which discord channel send the alert
+        author - authorID of the discord command author
+        _id - str ID
+        cooldown - UNIX time the ticket can alert again after it was hit
+        """
+        super().__init__(channelID, author, _id)
+        self.symbol = symbol
+        self.expression = expression
+        self.cooldown = cooldown
+
+    def __str__(self):
+        return f"{self._id}: {self.symbol} when {self.expression}"
+
+    def timeout(self) -> int:
+        """
+        returns 24 hours, same as a price ticket
+        """
+        return 3600 * 24
+
+
+def validate(symbol: str, expression: str) -> None:
+    """
+    Raises ValueError with what is wrong if expression does not parse
+    """
+    Parser(Graph(), symbol, expression).parse()
+
+
+class RuleEngine:
+    """
+    Evaluates every active rule once per cycle over the shared DAG. Leaves are fetched once: quotes in
+    batches of the provider's batch size, bars once per (symbol, timeframe, multiplier) series with every
+    indicator of that series computed in the same pass
+    """
+    def __init__(self, evaluator: Evaluator, indicators: IndicatorEngine = None):
+        """
+        evaluator - fans out the fetches, its provider and concurrency are used
+        indicators - keeps indicator state of every series between cycles
+        """
+        self.evaluator = evaluator
+        self.indicators = indicators or IndicatorEngine()
+        self.graph = Graph()
+        # rule id -> (expression, root node)
+        self.compiled: Dict[str, Tuple[str, int]] = {}
+        # cross node -> (a, b) of the last cycle
+        self.previous: Dict[int, Tuple[float, float]] = {}
+        self.last: Dict[str, int] = {}
+        # Rules forgotten or changed since the graph was last pruned
+        self.dropped = 0
+
+    def compile(self, rule: Rule) -> int:
+        """
+        returns root node of rule, parsed once and again only if its expression changes
+        """
+        compiled = self.compiled.get(rule._id)
+        if compiled is None or compiled[0] != rule.expression:
+            if compiled is not None:
+                self.dropped += 1
+            compiled = self.compiled[rule._id] = (rule.expression, Parser(self.graph, rule.symbol, rule.expression).parse())
+        return compiled[1]
+
+    def forget(self, _id: str) -> None:
+        """
+        _id - rule that was deleted, its nodes are pruned at the start of the next cycle
+        """
+        if self.compiled.pop(_id, None) is not None:
+            self.dropped += 1
+
+    def prune(self) -> None:
+        """
+        Drops the nodes no compiled rule depends on anymore, with their cross state. Nodes are renumbered,
+        so this only runs between cycles
+        """
+        graph = Graph()
+        ids: Dict[int, int] = {}
+        for node in self.graph.reachable([root for _, root in self.compiled.values()]):
+            ids[node] = graph.add(self.graph.relabel(self.graph.keys[node], ids))
+
+        logger.debug(f"Pruned {len(self.graph) - len(graph)} of {len(self.graph)} rule nodes")
+        self.graph = graph
+        self.compiled = {_id: (expression, ids[root]) for _id, (expression, root) in self.compiled.items()}
+        self.previous = {ids[node]: v for node, v in self.previous.items() if node in ids}
+        self.dropped = 0
+
+    async def fetch(self, nodes: List[int], now: float) -> Dict[int, float]:
+        """
+        returns value of every leaf in nodes
+        """
+        values: Dict[int, float] = {}
+        quotes: Dict[str, List[int]] = {}
+        series: Dict[Tuple[str, str, int], Dict[Tuple[str, int], int]] = {}
+        for node in nodes:
+            key = self.graph.keys[node]
+            if key[0] == "const":
+                values[node] = key[1]
+            elif key[0] == "price":
+                quotes.setdefault(key[1], []).append(node)
+            elif key[0] == "indicator":
+                series.setdefault(key[1:4], {})[key[4:6]] = node
+
+        async def fetch_quotes(batch: List[str]) -> None:
+            prices = await self.evaluator.api.get_prices(batch, t=now)
+            for symbol in batch:
+                if symbol not in prices:
+                    logger.error(f"No price returned for {symbol}")
+                for node in quotes[symbol]:
+                    values[node] = prices[symbol]['p'] if symbol in prices else math.nan
+
+        async def fetch_series(key: Tuple[str, str, int]) -> None:
+            symbol, timeframe, multiplier = key
+            spec: Spec = {}
+            for kind, periods in series[key]:
+                spec.setdefault(kind, []).append(periods)
+            limit = self.indicators.history_needed(symbol, timeframe, multiplier, spec)
+            candles = await self.evaluator.api.get_bars(symbol, timeframe, multiplier, limit=limit, t=now)
+            result = self.indicators.compute(symbol, timeframe, multiplier, candles, spec)
+            for (kind, periods), node in series[key].items():
+                values[node] = result[kind][periods]
+
+        for node in [n for s in series.values() for n in s.values()]:
+            values[node] = math.nan
+        await self.evaluator.fan_out(api.chunk(list(quotes), self.evaluator.api.batch_size), fetch_quotes)
+        await self.evaluator.fan_out(list(series), fetch_series)
+        self.last.update(quotes=len(quotes), series=len(series))
+        return values
+
+    def evaluate(self, nodes: List[int], values: Dict[int, float]) -> Dict[int, float]:
+        """
+        nodes - children before parents
+        values - value of every leaf
+
+        returns values with every inner node added, conditions are 1.0 or 0.0, NaN inputs make them 0.0
+        """
+        for node in nodes:
+            key = self.graph.keys[node]
+            op = key[0]
+            if op in ("const", "price", "indicator"):
+                continue
+            if op == "and":
+                values[node] = float(all(values[c] == 1.0 for c in key[1]))
+            elif op == "or":
+                values[node] = float(any(values[c] == 1.0 for c in key[1]))
+            else:
+                a, b = values[key[-2]], values[key[-1]]
+                if op == "compare":
+                    values[node] = float({"<": a < b, ">": a > b, "<=": a <= b, ">=": a >= b}[key[1]])
+                elif op == "within":
+                    limit = key[1] / 100 * abs(b) if key[2] else key[1]
+                    values[node] = float(abs(a - b) <= limit)
+                elif op == "cross":
+                    values[node] = float(self.crossed(node, key[1], a, b))
+        return values
+
+    def crossed(self, node: int, direction: str, a: float, b: float) -> bool:
+        """
+        returns whether a crossed b since the last cycle, in direction. Nodes not evaluated last cycle have no state
+        """
+        if math.isnan(a) or math.isnan(b):
+            return False
+        previous = self.previous.get(node)
+        self.previous[node] = (a, b)
+        if previous is None:
+            return False
+
+        pa, pb = previous
+        above = pa <= pb and a > b
+        below = pa >= pb and a < b
+        return {"above": above, "below": below}.get(direction, above or below)
+
+    async def monitor(self, rules: List[Rule], callback: Callable[[str, int, int, str, int], Awaitable[None]]) -> None:
+        """
+        rules - every active rule ticket
+        callback - function to call for every rule whose conditions are all met
+        """
+        if len(rules) == 0:
+            return
+
+        now = time.time()
+        roots = {}
+        for rule in rules:
+            try:
+                roots[rule._id] = self.compile(rule)
+            except ValueError as e:
+                logger.error(f"Skipping {rule._id}, it does not parse: {e}")
+        if self.dropped:
+            self.prune()
+            roots = {_id: self.compiled[_id][1] for _id in roots}
+
+        nodes = self.graph.reachable(list(roots.values()))
+        values = self.evaluate(nodes, await self.fetch(nodes, now))
+        # Crosses are against the last cycle, the state of nodes skipped while their rules cooled down is stale
+        if len(self.previous) > 0:
+            reached = set(nodes)
+            self.previous = {node: v for node, v in self.previous.items() if node in reached}
+        EVALUATED.inc(len(roots), kind="rule")
+        self.last.update(rules=len(roots), nodes=len(nodes))
+
+        for rule in rules:
+            if rule._id in roots and values[roots[rule._id]] == 1.0:
+                logger.info(f"{rule} hit. Sys: {now}")
+                await callback(f"{rule.symbol} rule hit: {rule.expression}. Sys: {now}",
+                               rule.channelID, rule.author, rule._id, rule.timeout())
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    def rule(self, expression: str, symbol="AAPL", _id=None) -> Rule:
+        return Rule(symbol, expression, channelID=1, author=2, _id=_id or f"rule_{abs(hash(expression)) % 10 ** 8}")
+
+    def test_parse(self):
+        graph = Graph()
+        root = Parser(graph, "aapl", "AAPL crosses 150 and 1H RSI < 30 and price within 0.2% of 50EMA").parse()
+        op, children = graph.keys[root]
+        self.assertEqual(op, "and")
+        self.assertEqual(sorted(graph.keys[c][0] for c in children), ["compare", "cross", "within"])
+        self.assertIn(("indicator", "AAPL", "hour", 1, "rsi", 14), graph.index)
+        self.assertIn(("indicator", "AAPL", "day", 1, "ema", 50), graph.index)
+        self.assertIn(("within", 0.2, True, graph.index[("price", "AAPL")], graph.index[("indicator", "AAPL", "day", 1, "ema", 50)]), graph.index)
+
+        root = Parser(graph, "AAPL", "price > 1 and (4h ema(21) crosses above sma(8) or SPY < 400)").parse()
+        self.assertEqual(graph.keys[root][0], "and")
+        self.assertIn(("indicator", "AAPL", "hour", 4, "ema", 21), graph.index)
+        self.assertIn(("price", "SPY"), graph.index)
+
+        for bad in ["", "price >", "price 150", "ema < 3", "price > 5%", "(price > 1", "price > 1 and"]:
+            with self.assertRaises(ValueError, msg=bad):
+                validate("AAPL", bad)
+
+    def test_shared_subexpressions(self):
+        graph = Graph()
+        a = Parser(graph, "AAPL", "price > 100 and 1H RSI < 30").parse()
+        b = Parser(graph, "AAPL", "1h rsi(14) < 30 and AAPL > 100").parse()
+        c = Parser(graph, "AAPL", "1H RSI < 30 or price within 1% of 50EMA").parse()
+        self.assertEqual(a, b)
+        # price, 100, >, RSI, 30, <, and, plus c's 50EMA, within and or
+        self.assertEqual(len(graph), 10)
+        self.assertIn(graph.keys[a][1][1], graph.children(c))
+
+    async def test_monitor_fetches_once(self):
+        from sim_api import SimulatedAPI
+        sim = SimulatedAPI(latency=0, jitter=0, volatility=0)
+        engine = RuleEngine(Evaluator(sim))
+        price = sim.start_price("AAPL")
+        rules = [self.rule(f"price > {price * (1 - (i + 1) / 200):.2f} and 1H RSI < 101 and 1D RSI > 0", _id=f"rule_{i}") for i in range(100)]
+        rules.append(self.rule(f"price < {price - 1}", _id="rule_miss"))
+        alerts = []
+
+        async def callback(message: str, channelID: int, authorID: int, _id: str, timeout: int) -> None:
+            alerts.append(_id)
+
+        await engine.monitor(rules, callback)
+        self.assertEqual(sorted(alerts), sorted(f"rule_{i}" for i in range(100)))
+        # One quote request and one bar request per series, for 101 rules
+        self.assertEqual(sim.requests, 3)
+        self.assertEqual((engine.last["quotes"], engine.last["series"]), (1, 2))
+
+    async def test_crosses(self):
+        from sim_api import SimulatedAPI
+        sim = SimulatedAPI(latency=0, jitter=0, volatility=0)
+        engine = RuleEngine(Evaluator(sim))
+        up = self.rule("price crosses above 150", _id="rule_up")
+        down = self.rule("price crosses below 150", _id="rule_down")
+        alerts = []
+
+        async def callback(message: str, channelID: int, authorID: int, _id: str, timeout: int) -> None:
+            alerts.append(_id)
+
+        for p, expected in [(149.0, []), (151.0, ["rule_up"]), (152.0, []), (148.0, ["rule_down"])]:
+            sim.prices["AAPL"] = [p, time.time() + 10]
+            alerts.clear()
+            await engine.monitor([up, down], callback)
+            self.assertEqual(alerts, expected, p)
+
+    async def test_no_cross_after_cooldown(self):
+        from sim_api import SimulatedAPI
+        sim = SimulatedAPI(latency=0, jitter=0, volatility=0)
+        engine = RuleEngine(Evaluator(sim))
+        up = self.rule("price crosses above 150", _id="rule_up")
+        other = self.rule("price > 1", _id="rule_other")
+        alerts = []
+
+        async def callback(message: str, channelID: int, authorID: int, _id: str, timeout: int) -> None:
+            alerts.append(_id)
+
+        # rule_up cools down while the price crosses, it must not fire on the cross it missed once it is back
+        for p, rules in [(149.0, [up, other]), (151.0, [other]), (152.0, [up, other]), (149.0, [up, other]), (151.0, [up, other])]:
+            sim.prices["AAPL"] = [p, time.time() + 10]
+            await engine.monitor(rules, callback)
+        self.assertEqual([a for a in alerts if a == "rule_up"], ["rule_up"])
+        self.assertEqual(len(engine.previous), 1)
+
+    async def test_prune(self):
+        from sim_api import SimulatedAPI
+        sim = SimulatedAPI(latency=0, jitter=0, volatility=0)
+        engine = RuleEngine(Evaluator(sim))
+        kept = self.rule("price crosses above 150", _id="rule_kept")
+        edited = self.rule("price crosses below 140 and 1H RSI < 30", _id="rule_edited")
+        alerts = []
+
+        async def callback(message: str, channelID: int, authorID: int, _id: str, timeout: int) -> None:
+            alerts.append(_id)
+
+        sim.prices["AAPL"] = [149.0, time.time() + 10]
+        await engine.monitor([kept, edited, self.rule("price > 1 and price < 2", _id="rule_deleted")], callback)
+        engine.forget("rule_deleted")
+        edited.expression = "price < 1"
+        before = len(engine.graph)
+
+        # The cross state of the kept rule carries over to the renumbered nodes
+        sim.prices["AAPL"] = [151.0, time.time() + 10]
+        await engine.monitor([kept, edited], callback)
+        self.assertEqual(alerts, ["rule_kept"])
+        self.assertLess(len(engine.graph), before)
+        # price, 150, cross, 1, <
+        self.assertEqual(len(engine.graph), 5)
+        self.assertEqual(len(engine.previous), 1)
+
+    def test_evaluate(self):
+        from sim_api import SimulatedAPI
+        engine = RuleEngine(Evaluator(SimulatedAPI(latency=0, jitter=0)))
+        root = engine.compile(self.rule("price within 2 of 100 and (price < 99.5 or price > 100.5)"))
+        nodes = engine.graph.reachable([root])
+        price = engine.graph.index[("price", "AAPL")]
+
+        for p, expected in [(101.0, 1.0), (100.0, 0.0), (98.0, 1.0), (97.0, 0.0), (np.nan, 0.0)]:
+            values = {n: engine.graph.keys[n][1] for n in nodes if engine.graph.keys[n][0] == "const"}
+            values[price] = p
+            self.assertEqual(engine.evaluate(nodes, values)[root], expected, p)
+
+
+if __name__ == "__main__":
+    unittest.main()
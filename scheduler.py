@@ -0,0 +1,205 @@
+"""
+Decides when each symbol is polled next, symbols close to a price ticket are checked often and far away ones rarely
+"""
+import heapq
+import math
+import time
+import unittest
+from typing import Dict, List, Tuple
+import api
+from price import PriceLevels, PriceTicket
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class Volatility:
+    """
+    Exponentially weighted variance of log returns per second, from the quotes seen so far
+    """
+    def __init__(self, price: float, t: float):
+        self.price = price
+        self.t = t
+        self.variance = None
+
+    def update(self, price: float, t: float, halflife: float) -> None:
+        dt = t - self.t
+        if dt <= 0 or price <= 0 or self.price <= 0:
+            return
+
+        rate = math.log(price / self.price) ** 2 / dt
+        if self.variance is None:
+            self.variance = rate
+        else:
+            w = 1 - 0.5 ** (dt / halflife)
+            self.variance += w * (rate - self.variance)
+        self.price = price
+        self.t = t
+
+    def sigma(self) -> float:
+        """
+        returns standard deviation of the price over one second, in dollars, None before two quotes
+        """
+        if self.variance is None:
+            return None
+        return self.price * math.sqrt(self.variance)
+
+
+class Scheduler:
+    def __init__(self, min_interval=5.0, max_interval=300.0, z=3.0, halflife=600.0):
+        """
+        min_interval - seconds, a symbol is never polled more often than this
+        max_interval - seconds, a symbol is never left longer than this
+        z - how many standard deviations of movement the next poll has to come before
+        halflife - seconds of quotes the volatility estimate mostly remembers
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.z = z
+        self.halflife = halflife
+        # (due time, symbol), entries that do not match self.next are stale and skipped
+        self.heap: List[Tuple[float, str]] = []
+        self.next: Dict[str, float] = {}
+        self.volatility: Dict[str, Volatility] = {}
+        self.shed = 0
+
+    def __len__(self):
+        return len(self.next)
+
+    def add(self, symbol: str, now=None) -> None:
+        """
+        symbol - symbol with a new or changed ticket, it is polled right away
+        """
+        self.schedule(symbol, now if now is not None else time.time())
+
+    def remove(self, symbol: str) -> None:
+        self.next.pop(symbol, None)
+        self.volatility.pop(symbol, None)
+
+    def schedule(self, symbol: str, due: float) -> None:
+        self.next[symbol] = due
+        heapq.heappush(self.heap, (due, symbol))
+
+    def interval(self, symbol: str, distance: float) -> float:
+        """
+        distance - dollars the price has to move to hit the nearest ticket
+
+        returns seconds until the next poll. A random walk needs (distance / sigma)^2 seconds to move distance
+        by one standard deviation, so that is divided by z^2 and clamped to [min_interval, max_interval]
+        """
+        if distance <= 0:
+            return self.min_interval
+
+        vol = self.volatility.get(symbol)
+        sigma = vol.sigma() if vol is not None else None
+        if not sigma:
+            return self.min_interval
+
+        t = (distance / (self.z * sigma)) ** 2
+        return min(self.max_interval, max(self.min_interval, t))
+
+    def observe(self, symbol: str, quote: api.Price, levels: PriceLevels, now=None) -> float:
+        """
+        symbol - symbol that was just polled
+        quote - its current price
+        levels - its price tickets
+
+        returns seconds until the symbol is polled again
+        """
+        if now is None:
+            now = time.time()
+        if symbol not in self.next:
+            return None
+
+        vol = self.volatility.get(symbol)
+        if vol is None:
+            self.volatility[symbol] = Volatility(quote['p'], now)
+        else:
+            vol.update(quote['p'], now, self.halflife)
+
+        interval = self.interval(symbol, levels.distance(quote['p']))
+        self.schedule(symbol, now + interval)
+        return interval
+
+    def due(self, limit: int, now=None) -> List[str]:
+        """
+        limit - most symbols that can be polled this cycle, such as the API quota for one cycle
+
+        returns the most overdue symbols, at most limit. The rest stay queued in the same order so an
+        overrun cycle sheds the least urgent polls instead of piling up
+        """
+        if now is None:
+            now = time.time()
+
+        symbols = []
+        while self.heap and self.heap[0][0] <= now and len(symbols) < limit:
+            due, symbol = heapq.heappop(self.heap)
+            if self.next.get(symbol) != due:
+                continue
+            symbols.append(symbol)
+            # Not polled again until observed, or retried once min_interval passes if the poll fails
+            self.schedule(symbol, now + self.min_interval)
+
+        late = self.overdue(now)
+        if late > 0:
+            self.shed += late
+            logger.info(f"Polling {len(symbols)} symbols, {late} overdue symbols deferred to the next cycle")
+
+        # Stale entries would otherwise grow the heap by one per poll
+        if len(self.heap) > 4 * len(self.next) + 64:
+            self.heap = [(due, s) for s, due in self.next.items()]
+            heapq.heapify(self.heap)
+
+        return symbols
+
+    def overdue(self, now: float) -> int:
+        return sum(1 for due in self.next.values() if due <= now)
+
+
+class Test(unittest.TestCase):
+    def levels(self, symbol: str, price: float, margin=1.0) -> PriceLevels:
+        return PriceLevels([PriceTicket(_id=f"price_{symbol}", symbol=symbol, price=price, margin=margin, channelID=1, authorID=2, timeout=0)])
+
+    def test_near_polled_more_often(self):
+        scheduler = Scheduler(min_interval=5, max_interval=300)
+        levels = {"NEAR": self.levels("NEAR", 101), "FAR": self.levels("FAR", 160)}
+        for s in levels:
+            scheduler.add(s, now=0)
+
+        now = 0
+        polls = {s: 0 for s in levels}
+        # Both trade around 100 moving 0.05% a second
+        prices = {s: 100.0 for s in levels}
+        while now < 3600:
+            for s in scheduler.due(limit=10, now=now):
+                polls[s] += 1
+                prices[s] *= 1.0005 if polls[s] % 2 else 1 / 1.0005
+                scheduler.observe(s, api.Price(t=now, p=prices[s]), levels[s], now=now)
+            now += 5
+
+        self.assertGreater(polls["NEAR"], 10 * polls["FAR"])
+        self.assertGreaterEqual(polls["FAR"], 3600 // 300)
+
+    def test_sheds_load(self):
+        scheduler = Scheduler(min_interval=5)
+        for i in range(100):
+            scheduler.add(f"S{i}", now=i)
+
+        first = scheduler.due(limit=30, now=1000)
+        self.assertEqual(first, [f"S{i}" for i in range(30)])
+        self.assertEqual(scheduler.shed, 70)
+
+        # Deferred symbols come before the ones just polled
+        second = scheduler.due(limit=30, now=1001)
+        self.assertEqual(second, [f"S{i}" for i in range(30, 60)])
+
+    def test_remove(self):
+        scheduler = Scheduler()
+        scheduler.add("AAPL", now=0)
+        scheduler.remove("AAPL")
+        self.assertEqual(scheduler.due(limit=10, now=10), [])
+        self.assertEqual(len(scheduler), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
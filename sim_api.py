@@ -0,0 +1,128 @@
+"""
+Simulated market data provider, random walk quotes and bars with network like latency, so the monitor can be
+measured without Alpaca, TD Ameritrade or Discord credentials
+"""
+import asyncio
+import time
+import unittest
+import zlib
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+import api
+from ema import candles_to_seconds
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class SimulatedAPI(api.API):
+    def __init__(self, latency=0.05, jitter=0.02, volatility=0.0005, batch_size=200, requests_per_minute=6000, seed=0):
+        """
+        latency - seconds every request takes
+        jitter - standard deviation of the latency, in seconds
+        volatility - standard deviation of a quote's log return over one second
+        batch_size - symbols per quote request
+        requests_per_minute - quota the scheduler sizes its polls with
+        seed - same seed, same quotes
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.volatility = volatility
+        self.batch_size = batch_size
+        self.requests_per_minute = requests_per_minute
+        self.rng = np.random.default_rng(seed)
+        self.seed = seed
+        # symbol -> (price, time of price)
+        self.prices: Dict[str, List[float]] = {}
+        self.requests = 0
+
+    def start_price(self, symbol: str) -> float:
+        """
+        returns first price of symbol, between 10 and 500, the same for every run with the same seed
+        """
+        return 10 + (zlib.crc32(f"{self.seed}{symbol}".encode()) % 49000) / 100
+
+    async def wait(self) -> None:
+        self.requests += 1
+        delay = self.latency + self.rng.normal(0, self.jitter) if self.jitter > 0 else self.latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def quote(self, symbol: str, t: float) -> api.Price:
+        """
+        returns price of symbol at t, a step of the random walk since the last quote
+        """
+        state = self.prices.get(symbol)
+        if state is None:
+            state = self.prices[symbol] = [self.start_price(symbol), t]
+
+        dt = max(0.0, t - state[1])
+        if dt > 0:
+            state[0] *= float(np.exp(self.rng.normal(0, self.volatility * np.sqrt(dt))))
+            state[1] = t
+        return api.Price(t=int(t), p=round(state[0], 2))
+
+    async def get_price(self, symbol: str, t=None) -> api.Price:
+        await self.wait()
+        return self.quote(symbol, time.time() if t is None else t)
+
+    async def get_prices(self, symbols: List[str], t=None) -> Dict[str, api.Price]:
+        await self.wait()
+        if t is None:
+            t = time.time()
+        return {s: self.quote(s, t) for s in symbols}
+
+    async def get_bars(self, symbol: str, timeframe: str, multiplier: int, limit: int, t=None) -> pd.DataFrame:
+        """
+        Bars are a function of their timestamp, so a bar has the same values on every call like a real provider's
+        """
+        await self.wait()
+        if t is None:
+            t = time.time()
+
+        seconds = candles_to_seconds(timeframe, multiplier)
+        end = int(t // seconds)
+        k = np.arange(end - limit + 1, end + 1)
+        phase = zlib.crc32(symbol.encode()) % 1000
+        base = self.start_price(symbol)
+
+        c = base * (1 + 0.03 * np.sin(k / 7.3 + phase) + 0.01 * np.sin(k / 1.7 + phase / 3))
+        o = base * (1 + 0.03 * np.sin((k - 1) / 7.3 + phase) + 0.01 * np.sin((k - 1) / 1.7 + phase / 3))
+        spread = base * 0.004 * (1 + np.sin(k / 3.1))
+        return pd.DataFrame({
+            "t": k * seconds,
+            "o": o,
+            "h": np.maximum(o, c) + spread,
+            "l": np.minimum(o, c) - spread,
+            "c": c,
+            "v": (1000 + (k % 97) * 10).astype(np.int64),
+        })
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def test_quotes(self):
+        sim = SimulatedAPI(latency=0.01, jitter=0, seed=1)
+        start = time.perf_counter()
+        prices = await sim.get_prices(["AAPL", "TSLA"], t=1000)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.01)
+        self.assertEqual(set(prices), {"AAPL", "TSLA"})
+        self.assertEqual(sim.requests, 1)
+
+        later = await sim.get_price("AAPL", t=1060)
+        self.assertNotEqual(later['p'], prices["AAPL"]['p'])
+        self.assertLess(abs(np.log(later['p'] / prices["AAPL"]['p'])), 0.05)
+
+    async def test_bars_stable(self):
+        sim = SimulatedAPI(latency=0, jitter=0)
+        first = await sim.get_bars("AAPL", "hour", 1, limit=50, t=360000)
+        second = await sim.get_bars("AAPL", "hour", 1, limit=10, t=360000 + 3600)
+        self.assertEqual(len(first), 50)
+        self.assertTrue((np.diff(first['t']) == 3600).all())
+        # Bars that overlap have the same values
+        pd.testing.assert_frame_equal(first.iloc[-9:].reset_index(drop=True), second.iloc[:9].reset_index(drop=True))
+        self.assertTrue((first['h'] >= first[['o', 'c']].max(axis=1)).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,78 @@
 from db import DB
 from ema import EMA
 from price import Price, PriceTicket
+from rules import Rule
 import sqlite3
-from typing import List
+from typing import Dict, List, Tuple
 from uuid import uuid4
 import unittest
 import time
+import os
+import shutil
+import tempfile
+
+# Schema changes, MIGRATIONS[n] upgrades a database from user_version n to n + 1
+MIGRATIONS = [
+    """
+    CREATE TABLE price_new (
+        id TEXT PRIMARY KEY,
+        symbol TEXT NOT NULL,
+        price FLOAT,
+        margin FLOAT,
+        timestamp INTEGER,
+        timeout INTEGER NOT NULL DEFAULT 0,
+        channelID INTEGER,
+        author INTEGER
+    );
+    INSERT OR IGNORE INTO price_new
+        SELECT id, UPPER(symbol), price, margin, timestamp, IFNULL(timeout, 0), channelID, author FROM price;
+    DROP TABLE price;
+    ALTER TABLE price_new RENAME TO price;
+    CREATE INDEX price_symbol_timeout ON price (symbol, timeout);
+    CREATE INDEX price_author_symbol ON price (author, symbol);
+
+    CREATE TABLE ema_new (
+        id TEXT PRIMARY KEY,
+        symbol TEXT NOT NULL,
+        timeframe TEXT,
+        multiplier INTEGER,
+        periods INTEGER,
+        margin FLOAT,
+        timestamp INTEGER,
+        timeout INTEGER NOT NULL DEFAULT 0,
+        channelID INTEGER,
+        author INTEGER
+    );
+    INSERT OR IGNORE INTO ema_new
+        SELECT id, UPPER(symbol), timeframe, multiplier, periods, margin, timestamp, IFNULL(timeout, 0), channelID, author FROM ema;
+    DROP TABLE ema;
+    ALTER TABLE ema_new RENAME TO ema;
+    CREATE INDEX ema_symbol_timeout ON ema (symbol, timeout);
+    CREATE INDEX ema_author_symbol ON ema (author, symbol);
+    """,
+    """
+    CREATE TABLE rule (
+        id TEXT PRIMARY KEY,
+        symbol TEXT NOT NULL,
+        expression TEXT NOT NULL,
+        timestamp INTEGER,
+        timeout INTEGER NOT NULL DEFAULT 0,
+        channelID INTEGER,
+        author INTEGER
+    );
+    CREATE INDEX rule_author_symbol ON rule (author, symbol);
+    """,
+    """
+    CREATE TABLE worker (
+        id TEXT PRIMARY KEY,
+        host TEXT,
+        pid INTEGER,
+        started INTEGER,
+        heartbeat INTEGER NOT NULL
+    );
+    """,
+]
+
 
 class SQL(DB):
     conn = None
@@ -46,6 +113,16 @@ class SQL(DB):
                 """
             )
             c.close()
+            self.conn.commit()
+            self.migrate()
+
+    def migrate(self) -> None:
+        """
+        Applies every migration newer than the database's user_version
+        """
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            self.conn.executescript(f"BEGIN; {MIGRATIONS[i]} PRAGMA user_version = {i + 1}; COMMIT;")
 
     def add_price(self, symbol: str, price: float, channelID: int, author: int, margin=1.0) -> str:
         """
@@ -60,6 +137,7 @@ class SQL(DB):
         """
         c = self.conn.cursor()
         _id = f"price_{str(uuid4())[:8]}"
+        symbol = symbol.upper()
         timestamp = int(time.time())
 
         c.execute(
@@ -98,6 +176,7 @@ class SQL(DB):
         """
         c = self.conn.cursor()
         _id = f"ema_{str(uuid4())[:8]}"
+        symbol = symbol.upper()
         timestamp = int(time.time())
 
         c.execute(
@@ -123,6 +202,24 @@ class SQL(DB):
         self.conn.commit()
         return _id
 
+    def add_rule(self, symbol: str, expression: str, channelID: int, author: int) -> str:
+        """
+        symbol - stock symbol, price and indicators in expression without a symbol refer to it
+        expression - conditions, such as "price crosses 150 and 1H RSI < 30"
+        channelID - discord channel ID to send alert to
+        author - discordID of who created the command
+
+        returns ticketID
+        Adds rule ticket to database
+        """
+        _id = f"rule_{str(uuid4())[:8]}"
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO rule VALUES (?, ?, ?, ?, 0, ?, ?)",
+                (_id, symbol.upper(), expression, int(time.time()), channelID, author)
+            )
+        return _id
+
     def get_all_ema(self, authorID=0, symbol="*", active=False) -> List[EMA]:
         """
         authorID -  of ticket author
@@ -149,7 +246,7 @@ class SQL(DB):
             else:
                 query += "AND symbol = ?\n"
 
-            values = values + (symbol,)
+            values = values + (symbol.upper(),)
 
         if active == True:
             if (len(values) == 0):
@@ -170,10 +267,11 @@ class SQL(DB):
             symbol=d[1],
             timeframe=d[2],
             periods=d[4],
-            channelID=d[7],
-            author=d[8],
+            channelID=d[8],
+            author=d[9],
             multiplier=d[3],
-            margin=d[5]
+            margin=d[5],
+            cooldown=d[7] or 0,
         ) for d in rows]
 
         c.close()
@@ -207,7 +305,7 @@ class SQL(DB):
             else:
                 query += "AND symbol = ?\n"
 
-            values = values + (symbol,)
+            values = values + (symbol.upper(),)
 
         if active == True:
             if (len(values) == 0):
@@ -229,12 +327,45 @@ class SQL(DB):
             price=d[2],
             channelID=d[6],
             authorID=d[7],
-            margin=d[3]
+            margin=d[3],
+            timeout=d[5]
         ) for d in rows]
 
         c.close()
         return tickets
 
+    def get_all_rule(self, authorID=0, symbol="*", active=False) -> List[Rule]:
+        """
+        authorID - of ticket author
+        symbol - optional, only get tickets with this symbol
+        active - if true, will only get tickets where now > timeout
+
+        Gets all the rule alerts made by author
+        """
+        query = "SELECT id, symbol, expression, timeout, channelID, author FROM rule"
+        conditions, values = [], ()
+        if authorID != 0:
+            conditions.append("author = ?")
+            values += (authorID,)
+        if symbol != "*":
+            conditions.append("symbol = ?")
+            values += (symbol.upper(),)
+        if active == True:
+            conditions.append("timeout < ?")
+            values += (int(time.time()),)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY symbol"
+
+        return [Rule(
+            _id=d[0],
+            symbol=d[1],
+            expression=d[2],
+            cooldown=d[3],
+            channelID=d[4],
+            author=d[5],
+        ) for d in self.conn.execute(query, values)]
+
     def delete(self, _id: str) -> bool:
         """
         _id - id of ticket to delete
@@ -246,7 +377,7 @@ class SQL(DB):
         t = _id.split("_")
         table = t[0]
 
-        if table not in ['price', 'ema']:
+        if table not in ['price', 'ema', 'rule']:
             return False
 
         c.execute(
@@ -260,6 +391,7 @@ class SQL(DB):
         )
 
         c.close()
+        self.conn.commit()
         return True
 
     def update_timeout(self, _id: str, timeout: int) -> None:
@@ -274,7 +406,7 @@ class SQL(DB):
         t = _id.split("_")
         table = t[0]
 
-        if table not in ['price', 'ema']:
+        if table not in ['price', 'ema', 'rule']:
             return False
 
         c.execute(
@@ -292,6 +424,72 @@ class SQL(DB):
         c.close()
         self.conn.commit()
 
+    def write_batch(self, timeouts: Dict[str, int], deletes: List[str]) -> None:
+        """
+        timeouts - { _id: when to wait until } of tickets that alerted
+        deletes - ids of tickets to delete
+
+        Applies every update and delete in one transaction, so a cycle costs a single commit
+        """
+        tables = ('price', 'ema', 'rule')
+        with self.conn:
+            for table in tables:
+                updates = [(timeout, _id) for _id, timeout in timeouts.items() if _id.split("_")[0] == table]
+                if updates:
+                    self.conn.executemany(f"UPDATE {table} SET timeout = ? WHERE id = ?", updates)
+
+                ids = [(_id,) for _id in deletes if _id.split("_")[0] == table]
+                if ids:
+                    self.conn.executemany(f"DELETE FROM {table} WHERE id = ?", ids)
+
+    def claim_batch(self, claims: Dict[str, Tuple[int, int]]) -> List[str]:
+        """
+        claims - { _id: (timeout the ticket was read with, when to wait until) } of tickets that alerted
+
+        returns ids whose timeout was still the one read, only those are updated. A ticket another worker
+        alerted on in the meantime has a newer timeout and is left as it is, so it is alerted once
+        """
+        claimed = []
+        with self.conn:
+            for _id, (expected, timeout) in claims.items():
+                table = _id.split("_")[0]
+                if table not in ('price', 'ema', 'rule'):
+                    continue
+                c = self.conn.execute(f"UPDATE {table} SET timeout = ? WHERE id = ? AND timeout = ?", (timeout, _id, expected))
+                if c.rowcount == 1:
+                    claimed.append(_id)
+        return claimed
+
+    def heartbeat(self, worker_id: str, host: str, pid: int) -> None:
+        """
+        worker_id - id of a monitor worker
+        host, pid - where the worker runs, for debugging
+
+        Marks the worker as alive now, adds it if it is new
+        """
+        now = int(time.time())
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO worker VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET heartbeat = excluded.heartbeat
+                """,
+                (worker_id, host, pid, now, now)
+            )
+
+    def get_workers(self, ttl: int) -> List[str]:
+        """
+        ttl - seconds since the last heartbeat a worker is still alive for
+
+        returns ids of the live workers, sorted
+        """
+        rows = self.conn.execute("SELECT id FROM worker WHERE heartbeat >= ? ORDER BY id", (int(time.time()) - ttl,))
+        return [d[0] for d in rows]
+
+    def remove_worker(self, worker_id: str) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM worker WHERE id = ?", (worker_id,))
+
     def get_price_symbols(self) -> List[str]:
         c = self.conn.cursor()
         rows = c.execute("""
@@ -305,6 +503,19 @@ class SQL(DB):
 
         return symbols
 
+    def get_ema_symbols(self) -> List[str]:
+        c = self.conn.cursor()
+        rows = c.execute("""
+            SELECT DISTINCT symbol
+            FROM
+                ema
+        """)
+
+        symbols = [d[0] for d in rows]
+        c.close()
+
+        return symbols
+
     def get_prices(self, symbol: str) -> List[PriceTicket]:
         c = self.conn.cursor()
         rows = c.execute("""
@@ -315,7 +526,7 @@ class SQL(DB):
                 symbol=?
             AND
                 timeout < ?
-        """, (symbol, int(time.time())))
+        """, (symbol.upper(), int(time.time())))
 
         prices = [PriceTicket(
             price=d[0],
@@ -324,21 +535,51 @@ class SQL(DB):
             _id=d[3],
             timeout=d[4],
             margin=d[5],
-            symbol=symbol,
+            symbol=symbol.upper(),
         ) for d in rows]
         c.close()
         return prices
 
+    def get_active_prices(self) -> Dict[str, List[PriceTicket]]:
+        """
+        returns every price ticket that is not timed out, grouped by symbol, in one query
+        """
+        c = self.conn.cursor()
+        rows = c.execute("""
+            SELECT symbol, price, channelID, author, id, timeout, margin
+            FROM
+                price
+            WHERE
+                timeout < ?
+            ORDER BY symbol
+        """, (int(time.time()),))
+
+        prices: Dict[str, List[PriceTicket]] = {}
+        for d in rows:
+            prices.setdefault(d[0], []).append(PriceTicket(
+                symbol=d[0],
+                price=d[1],
+                channelID=d[2],
+                authorID=d[3],
+                _id=d[4],
+                timeout=d[5],
+                margin=d[6],
+            ))
+        c.close()
+        return prices
+
 
 class Test(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
-        self.db = SQL('./test_alerts.db')
+        self.dir = tempfile.mkdtemp()
+        self.db = SQL(os.path.join(self.dir, 'alerts.db'))
     
     async def test_ema(self):
         _id = self.db.add_ema('AAPL', 'hour', 50, channelID=12345, author=12345)
         tickets = self.db.get_all_ema(12345)
         t = tickets[0]
         self.assertEqual(t._id, _id)
+        self.assertEqual((t.channelID, t.author, t.cooldown), (12345, 12345, 0))
 
     async def test_ema_no_author(self):
         _id = self.db.add_ema('AAPL', 'hour', 50, channelID=12345, author=12345)
@@ -349,7 +590,7 @@ class Test(unittest.IsolatedAsyncioTestCase):
         _id = self.db.add_price('AAPL', 134, channelID=123, author=456, margin=0.01)
         tickets = self.db.get_all_price(456)
         t = tickets[0]
-        self.assertEqual(_id, t._id)
+        self.assertEqual(_id, t['_id'])
 
     async def test_price_no_author(self):
         _id = self.db.add_price('AAPL', 134, channelID=123, author=456, margin=0.01)
@@ -369,22 +610,138 @@ class Test(unittest.IsolatedAsyncioTestCase):
         inactive_tickets = self.db.get_all_price(456)
         self.assertGreater(len(inactive_tickets), len(active_tickets))
 
+    async def test_write_batch(self):
+        price_id = self.db.add_price('AAPL', 134, channelID=123, author=456)
+        ema_id = self.db.add_ema('AAPL', 'hour', 50, channelID=123, author=456)
+        deleted = self.db.add_price('TSLA', 700, channelID=123, author=456)
+        timeout = int(time.time()) + 1000
+
+        self.db.write_batch({price_id: timeout, ema_id: timeout}, [deleted])
+        self.assertEqual([t['timeout'] for t in self.db.get_all_price(456)], [timeout])
+        self.assertEqual(self.db.get_all_ema(456)[0].cooldown, timeout)
+
+    async def test_rule(self):
+        _id = self.db.add_rule('aapl', 'price crosses 150 and 1H RSI < 30', channelID=123, author=456)
+        self.db.add_rule('TSLA', 'price > 700', channelID=123, author=789)
+        tickets = self.db.get_all_rule(456)
+        self.assertEqual([(t._id, t.symbol, t.expression) for t in tickets], [(_id, 'AAPL', 'price crosses 150 and 1H RSI < 30')])
+
+        timeout = int(time.time()) + 1000
+        self.db.write_batch({_id: timeout}, [])
+        self.assertEqual(self.db.get_all_rule(456)[0].cooldown, timeout)
+        self.assertEqual(len(self.db.get_all_rule(active=True)), 1)
+
+        self.assertTrue(self.db.delete(_id))
+        self.assertEqual(len(self.db.get_all_rule(456)), 0)
+
+    async def test_claim_batch(self):
+        first = self.db.add_price('AAPL', 134, channelID=123, author=456)
+        second = self.db.add_ema('AAPL', 'hour', 50, channelID=123, author=456)
+        timeout = int(time.time()) + 1000
+
+        self.assertEqual(sorted(self.db.claim_batch({first: (0, timeout), second: (0, timeout)})), sorted([first, second]))
+        # Another worker that read the tickets before the claim loses
+        self.assertEqual(self.db.claim_batch({first: (0, timeout + 5), second: (0, timeout + 5)}), [])
+        self.assertEqual(self.db.get_all_price(456)[0]['timeout'], timeout)
+        self.assertEqual(self.db.claim_batch({second: (timeout, timeout + 5)}), [second])
+
+    async def test_workers(self):
+        self.db.heartbeat('b', 'host', 2)
+        self.db.heartbeat('a', 'host', 1)
+        self.db.conn.execute("UPDATE worker SET heartbeat = 0 WHERE id = 'b'")
+        self.assertEqual(self.db.get_workers(ttl=15), ['a'])
+        self.db.heartbeat('b', 'host', 2)
+        self.assertEqual(self.db.get_workers(ttl=15), ['a', 'b'])
+        self.db.remove_worker('a')
+        self.assertEqual(self.db.get_workers(ttl=15), ['b'])
+
     async def test_get_symbols(self):
-        db = SQL('./alerts.db')
-        symbols = db.get_price_symbols()
+        symbols = self.db.get_price_symbols()
         print(symbols)
         
     async def test_get_prices(self):
-        db = SQL('./alerts.db')
         symbol = 'AAPL'
-        prices = db.get_prices(symbol)
+        prices = self.db.get_prices(symbol)
         print(prices)
         
+    async def test_symbols_upper_case(self):
+        self.db.add_price('aapl', 134, channelID=123, author=456)
+        self.assertEqual(self.db.get_price_symbols(), ['AAPL'])
+        self.assertEqual(len(self.db.get_all_price(456, symbol='Aapl')), 1)
+
+    async def test_get_active_prices(self):
+        self.db.add_price('AAPL', 134, channelID=123, author=456)
+        self.db.add_price('AAPL', 140, channelID=123, author=456)
+        _id = self.db.add_price('TSLA', 700, channelID=123, author=456)
+        self.db.update_timeout(_id, int(time.time()) + 1000)
+        active = self.db.get_active_prices()
+        self.assertEqual({s: len(t) for s, t in active.items()}, {'AAPL': 2})
+
     async def asyncTearDown(self):
         self.db.conn.execute("DELETE FROM ema")
         self.db.conn.execute("DELETE FROM price")
+        self.db.conn.execute("DELETE FROM rule")
+        self.db.conn.execute("DELETE FROM worker")
         self.db.conn.commit()
-
+        self.db.conn.close()
+        shutil.rmtree(self.dir)
+
+
+class TestSchema(unittest.TestCase):
+    def plan(self, db: SQL, query: str, values: tuple) -> str:
+        rows = db.conn.execute("EXPLAIN QUERY PLAN " + query, values).fetchall()
+        return " ".join(r[-1] for r in rows)
+
+    def test_migrates_old_schema(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE price (id TEXT, symbol TEXT, price FLOAT, margin FLOAT, timestamp INTEGER, timeout INTEGER, channelID INTEGER, author INTEGER)")
+        conn.execute("CREATE TABLE ema (id TEXT, symbol TEXT, timeframe TEXT, multiplier INTEGER, periods INTEGER, margin FLOAT, timestamp INTEGER, timeout INTEGER, channelID INTEGER, author INTEGER)")
+        conn.execute("INSERT INTO price VALUES ('price_1', 'aapl', 134, 1, 0, 0, 1, 2)")
+        conn.execute("INSERT INTO price VALUES ('price_1', 'aapl', 134, 1, 0, 0, 1, 2)")
+        conn.commit()
+
+        db = SQL.__new__(SQL)
+        db.conn = conn
+        db.migrate()
+
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(db.get_prices('AAPL')[0]['_id'], 'price_1')
+        self.assertEqual(len(db.get_all_price()), 1)
+        # Running again is a no-op
+        db.migrate()
+
+    def test_hot_queries_use_indexes(self):
+        db = SQL(':memory:')
+        now = int(time.time())
+        calls = {
+            "get_prices": lambda: db.get_prices('AAPL'),
+            "get_active_prices": lambda: db.get_active_prices(),
+            "get_all_price": lambda: db.get_all_price(1, symbol='AAPL'),
+            "get_all_ema": lambda: db.get_all_ema(1),
+            "get_all_ema active": lambda: db.get_all_ema(active=True),
+            "delete": lambda: db.delete('price_1'),
+            "update_timeout": lambda: db.update_timeout('ema_1', now),
+            "get_all_rule": lambda: db.get_all_rule(1),
+        }
+
+        # The statements the methods run, with their values filled in
+        plans = {}
+        for name, call in calls.items():
+            statements = []
+            db.conn.set_trace_callback(statements.append)
+            call()
+            db.conn.set_trace_callback(None)
+
+            queries = [q for q in statements if q.split()[0].upper() in ("SELECT", "UPDATE", "DELETE")]
+            self.assertEqual(len(queries), 1, name)
+            plans[name] = self.plan(db, queries[0], ())
+
+        for name, plan in plans.items():
+            self.assertRegex(plan, "USING (COVERING )?INDEX", name)
+            self.assertNotIn("TEMP B-TREE", plan, name)
+
+        self.assertIn("SEARCH price USING INDEX price_symbol_timeout (symbol=? AND timeout<?)", plans["get_prices"])
+        self.assertIn("SEARCH price USING INDEX price_author_symbol (author=? AND symbol=?)", plans["get_all_price"])
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
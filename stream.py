@@ -0,0 +1,216 @@
+"""
+Streaming market data, following the API spec. Speaks the Alpaca market data stream protocol
+"""
+import aiohttp
+import asyncio
+import os
+import time
+import unittest
+from typing import Awaitable, Callable, Dict, List, Set
+import pandas as pd
+import api
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+ALPACA_STREAM_URL = "wss://stream.data.alpaca.markets/v2/iex"
+
+
+def parse_timestamp(t) -> int:
+    """
+    t - RFC3339 string as sent by Alpaca, or UNIX seconds
+
+    returns UNIX timestamp in seconds
+    """
+    if isinstance(t, str):
+        return int(pd.Timestamp(t).timestamp())
+    return int(t)
+
+
+class StreamingAPI(api.API):
+    batch_size = 200
+
+    def __init__(self, fallback: api.API, url=ALPACA_STREAM_URL, key=None, secret=None):
+        """
+        fallback - API used for bars, and for quotes of symbols that have not traded since subscribing
+        url - websocket url of the stream
+        key - API key, defaults to APCA_API_KEY_ID
+        secret - API secret, defaults to APCA_API_SECRET_KEY
+        """
+        self.fallback = fallback
+        self.url = url
+        self.key = key if key is not None else os.getenv("APCA_API_KEY_ID", "")
+        self.secret = secret if secret is not None else os.getenv("APCA_API_SECRET_KEY", "")
+        self.session = None
+        self.ws = None
+        self.symbols: Set[str] = set()
+        self.subscribed: Set[str] = set()
+        self.last: Dict[str, api.Price] = {}
+        self.callbacks: List[Callable[[str, api.Price], Awaitable[None]]] = []
+        self.connected = asyncio.Event()
+
+    def on_tick(self, callback: Callable[[str, api.Price], Awaitable[None]]) -> None:
+        """
+        callback - async function called with (symbol, price) for every trade received
+        """
+        self.callbacks.append(callback)
+
+    async def set_symbols(self, symbols: List[str]) -> None:
+        """
+        symbols - every symbol that should be streamed
+
+        Subscribes to new symbols and unsubscribes from ones that are no longer needed
+        """
+        self.symbols = set(symbols)
+        if self.ws is None or self.ws.closed:
+            return
+
+        add = sorted(self.symbols - self.subscribed)
+        remove = sorted(self.subscribed - self.symbols)
+
+        if add:
+            await self.ws.send_json({"action": "subscribe", "trades": add})
+        if remove:
+            await self.ws.send_json({"action": "unsubscribe", "trades": remove})
+            for symbol in remove:
+                self.last.pop(symbol, None)
+
+        self.subscribed = set(self.symbols)
+
+    async def run(self, reconnect_delay=5) -> None:
+        """
+        reconnect_delay - seconds to wait before reconnecting after the stream drops
+
+        Keeps the stream connected, should be started as a task
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+
+        while True:
+            try:
+                await self._connect()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("Stream disconnected", exc_info=True)
+
+            self.connected.clear()
+            self.subscribed = set()
+            await asyncio.sleep(reconnect_delay)
+
+    async def _connect(self) -> None:
+        async with self.session.ws_connect(self.url) as ws:
+            self.ws = ws
+            await ws.receive_json()
+            await ws.send_json({"action": "auth", "key": self.key, "secret": self.secret})
+            auth = await ws.receive_json()
+            if auth[0].get("T") != "success":
+                raise Exception(f"Stream authentication failed: {auth}")
+
+            self.subscribed = set()
+            await self.set_symbols(list(self.symbols))
+            self.connected.set()
+            logger.info(f"Streaming {len(self.subscribed)} symbols")
+
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                for m in msg.json():
+                    if m.get("T") == "t":
+                        await self._tick(m)
+                    elif m.get("T") == "error":
+                        logger.error(f"Stream error: {m}")
+
+    async def _tick(self, m: dict) -> None:
+        symbol = m["S"]
+        if symbol not in self.subscribed:
+            return
+
+        price = api.Price(t=parse_timestamp(m["t"]), p=m["p"])
+        self.last[symbol] = price
+
+        for callback in self.callbacks:
+            try:
+                await callback(symbol, price)
+            except Exception:
+                logger.error(f"Tick callback failed for {symbol}", exc_info=True)
+
+    async def get_price(self, symbol: str, t=None) -> api.Price:
+        """
+        symbol - Symbol to fetch price for
+        t - unused, the latest trade is returned
+
+        returns the latest streamed trade, falls back to polling if none has arrived yet
+        """
+        if symbol in self.last:
+            return self.last[symbol]
+        return await self.fallback.get_price(symbol, t=t if t is not None else time.time())
+
+    async def get_prices(self, symbols: List[str], t=None) -> Dict[str, api.Price]:
+        prices = {s: self.last[s] for s in symbols if s in self.last}
+        missing = [s for s in symbols if s not in prices]
+        for batch in api.chunk(missing, self.fallback.batch_size):
+            prices.update(await self.fallback.get_prices(batch, t=t))
+        return prices
+
+    async def get_bars(self, symbol: str, timeframe: str, multiplier: int, limit: int, t=None) -> pd.DataFrame:
+        if t is None:
+            return await self.fallback.get_bars(symbol, timeframe, multiplier, limit)
+        return await self.fallback.get_bars(symbol, timeframe, multiplier, limit, t=t)
+
+    async def close(self) -> None:
+        if self.ws is not None:
+            await self.ws.close()
+        if self.session is not None:
+            await self.session.close()
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        from replay_server import ReplayServer
+        ticks = [
+            {"S": "AAPL", "p": 130.0, "t": "2021-04-20T15:00:00Z"},
+            {"S": "TSLA", "p": 700.0, "t": "2021-04-20T15:00:00.5Z"},
+            {"S": "AAPL", "p": 130.5, "t": "2021-04-20T15:00:01Z"},
+            {"S": "MSFT", "p": 250.0, "t": "2021-04-20T15:00:01.5Z"},
+        ]
+        self.server = ReplayServer(ticks, speed=100, loop_forever=True)
+        port = await self.server.start(port=0)
+        self.stream = StreamingAPI(fallback=api.API.__new__(api.API), url=f"http://127.0.0.1:{port}/stream", key="k", secret="s")
+        self.task = asyncio.create_task(self.stream.run(reconnect_delay=0.1))
+
+    async def test_ticks_only_for_subscribed(self):
+        received = []
+
+        async def tick(symbol: str, price: api.Price) -> None:
+            received.append(symbol)
+
+        async def wait_for(n: int) -> None:
+            while len(received) < n:
+                await asyncio.sleep(0.01)
+
+        self.stream.on_tick(tick)
+        await self.stream.set_symbols(["AAPL", "TSLA"])
+        await asyncio.wait_for(self.stream.connected.wait(), 2)
+
+        await asyncio.wait_for(wait_for(6), 5)
+
+        self.assertEqual(set(received), {"AAPL", "TSLA"})
+        price = await self.stream.get_price("AAPL")
+        self.assertIn(price['p'], [130.0, 130.5])
+        self.assertEqual(price['t'] // 10, 1618930800 // 10)
+
+        await self.stream.set_symbols(["MSFT"])
+        self.assertNotIn("AAPL", self.stream.last)
+        received.clear()
+        await asyncio.wait_for(wait_for(3), 5)
+        self.assertEqual(set(received), {"MSFT"})
+
+    async def asyncTearDown(self):
+        self.task.cancel()
+        await self.stream.close()
+        await self.server.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,77 +1,139 @@
 import tdameritrade as td
 import api
+from rate_limiter import TokenBucket, RateLimited
+import asyncio
+import functools
+import math
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 import unittest
 import pandas as pd
+from typing import Dict, List
 from custom_logger import get_logger
+from ema_state import candles_to_seconds
+from loop_monitor import LoopLag
 
 
 logger = get_logger(__name__)
 
+# Price history query of every timeframe: (frequencyType, frequency, periodType). Hours are aggregated from
+# 30 minute bars, the longest TD has, the other timeframes from bars of the same timeframe
+HISTORY = {
+    "minute": ("minute", 1, "day"),
+    "hour": ("minute", 30, "day"),
+    "day": ("daily", 1, "year"),
+    "week": ("weekly", 1, "year"),
+    "month": ("monthly", 1, "year"),
+}
+
 
 class TdAmeritradeAPI(api.API):
-    def __init__(self):
+    # The quotes endpoint takes a list of symbols in one request
+    batch_size = 200
+    # TD Ameritrade allows 120 requests per minute per application
+    requests_per_minute = 120
+
+    def __init__(self, workers=4):
+        """
+        workers - threads the synchronous TDClient calls run on, 0 runs them on the event loop
+        """
         client_id = os.getenv("TDAMERITRADE_CLIENT_ID")
         account_id = os.getenv("TDAMERITRADE_ACCOUNT_ID")
         refresh_token = os.getenv("TDAMERITRADE_REFRESH_TOKEN")
         self.client = td.TDClient(client_id=client_id, refresh_token=refresh_token, account_ids=[account_id])
+        self.limiter = TokenBucket(self.requests_per_minute, name="tdameritrade")
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tdameritrade") if workers > 0 else None
+
+    async def _call(self, fn, *args, **kwargs):
+        """
+        fn - TDClient method to call
+
+        returns result of fn, the call waits on the rate limiter and is retried if TD answers 429.
+        TDClient blocks for the whole HTTP round trip, so it runs on the executor to keep the event loop free
+        """
+        async def request():
+            try:
+                if self.executor is None:
+                    return fn(*args, **kwargs)
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+            except td.exceptions.TooManyRequestsError:
+                raise RateLimited()
+
+        return await self.limiter.run(request)
 
     async def get_price(self, symbol: str, t=time.time()) -> api.Price:
-        quote = self.client.quote(symbol)
+        quote = await self._call(self.client.quote, symbol)
 
         logger.info(quote)
 
         return api.Price(t=quote[symbol]['quoteTimeInLong'], p=quote[symbol]['askPrice'])
+
+    async def get_prices(self, symbols: List[str], t=None) -> Dict[str, api.Price]:
+        """
+        symbols - Symbols to fetch prices for, at most {batch_size} of them
+        t - unused, TD only returns the latest quote
+
+        returns { symbol: Price } for every symbol TD returned a quote for
+        """
+        quotes = await self._call(self.client.quote, symbols)
+
+        prices = {}
+        for symbol in symbols:
+            quote = quotes.get(symbol.upper())
+            if quote is None:
+                logger.error(f"No quote returned for {symbol}")
+                continue
+            prices[symbol] = api.Price(t=quote['quoteTimeInLong'], p=quote['askPrice'])
+
+        return prices
     
-    async def get_bars(self, symbol: str, timeframe: str, multiplier=1, limit=1000) -> pd.DataFrame:
-        frequency_type = ''  # Timeframe to contact api with
-        num = 0  # number of frequency_type to use, such as if its hour it uses 4 15Min
-        period_type = ''
-        periods = 0
-
-        if timeframe == 'minute':
-            frequency_type = 'minute'
-            num = 1
-            period_type = 'day'
-
-        elif timeframe == 'hour':
-            frequency_type = 'minute'
-            num = 60
-            period_type = 'day'
-
-        elif timeframe == 'day':
-            frequency_type = 'daily'
-            num = 1
-            period_type = 'day'
-
-        elif timeframe == 'week':
-            frequency_type = 'weekly'
-            num = 1
-            period_type = 'week'
-
-        elif timeframe == 'month':
-            tf = 'monthly'
-            num = 1
-            period_type = 'month'
-
-        required = multiplier * num * limit
-
-        bars = []
-
-        while len(bars) < required:
-            candles = self.client.history(
-                symbol=symbol,
-                frequencyType='minute',
-                frequency=15,
-                periodType='day',
-                period=1
-            )
-            bars = candles['candles'] + bars
-
-        # print(len(bars))
-        df = pd.DataFrame(bars)
-        return df
+    async def get_bars(self, symbol: str, timeframe: str, multiplier=1, limit=1000, t=None) -> pd.DataFrame:
+        """
+        symbol - Symbol of stock to get bars for
+        timeframe - type of candle to get, minute, hour, day, week, month
+        multiplier - how many timeframes per candle
+        limit - number of candles to get
+        t - UNIX timestamp of when to end, default is the current timestamp
+
+        returns last {limit} candles with t, o, h, l, c, v columns, aggregated from one price history request
+        """
+        frequency_type, frequency, period_type = HISTORY[timeframe]
+        end = int(t if t is not None else time.time())
+
+        span = candles_to_seconds(timeframe, multiplier) * limit
+        if timeframe in ("minute", "hour"):
+            # Only the regular session has bars, count how many trading days that is
+            span = math.ceil(span / (api.SESSION_CLOSE - api.SESSION_OPEN)) * 86400
+        if timeframe in ("minute", "hour", "day"):
+            # Weekends and a few holidays
+            span = span * 7 // 5 + 4 * 86400
+
+        history = await self._call(
+            self.client.history,
+            symbol=symbol,
+            frequencyType=frequency_type,
+            frequency=frequency,
+            periodType=period_type,
+            startDate=(end - span) * 1000,
+            endDate=end * 1000
+        )
+
+        bars = history.get('candles', [])
+        df = pd.DataFrame({
+            "t": [b['datetime'] // 1000 for b in bars],
+            "o": [b['open'] for b in bars],
+            "h": [b['high'] for b in bars],
+            "l": [b['low'] for b in bars],
+            "c": [b['close'] for b in bars],
+            "v": [b['volume'] for b in bars],
+        }, columns=["t", "o", "h", "l", "c", "v"])
+        df["Datetime"] = pd.to_datetime(df["t"], unit="s")
+        df = df.set_index("Datetime")
+
+        sampled = api.aggregate_candles(df, timeframe, multiplier)
+        return sampled.iloc[-limit:]
 
 
 class Test(unittest.IsolatedAsyncioTestCase):
@@ -89,5 +151,58 @@ class Test(unittest.IsolatedAsyncioTestCase):
     #     bars = await self.client.get_bars("AAPL", timeframe="hour", multiplier=4, limit=1000)
 
 
+class TestExecutor(unittest.IsolatedAsyncioTestCase):
+    def api(self, workers: int) -> TdAmeritradeAPI:
+        class Client:
+            def quote(self, symbols):
+                # Stands in for the HTTP round trip
+                time.sleep(0.1)
+                return {s: {'quoteTimeInLong': 1, 'askPrice': 1.0} for s in symbols}
+
+        client = TdAmeritradeAPI.__new__(TdAmeritradeAPI)
+        client.client = Client()
+        client.limiter = TokenBucket(6000, burst=10)
+        client.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        return client
+
+    async def lag(self, workers: int) -> float:
+        lag = LoopLag(interval=0.01)
+        lag.start()
+        client = self.api(workers)
+        await asyncio.gather(*[client.get_prices(["AAPL"]) for _ in range(4)])
+        await asyncio.sleep(0.05)
+        lag.stop()
+        return lag.stats()["max"]
+
+    async def test_bars_one_request(self):
+        requests = []
+
+        class Client:
+            def history(self, **kwargs):
+                requests.append(kwargs)
+                start = 1704205800
+                return {'candles': [{'datetime': (start + i * 1800) * 1000, 'open': 100.0 + i, 'high': 101.0 + i, 'low': 99.0 + i,
+                                     'close': 100.5 + i, 'volume': 10} for i in range(13)]}
+
+        client = self.api(0)
+        client.client = Client()
+        bars = await client.get_bars("AAPL", "hour", 1, limit=5, t=1704205800 + 13 * 1800)
+
+        self.assertEqual(len(requests), 1)
+        self.assertEqual((requests[0]['frequencyType'], requests[0]['frequency']), ("minute", 30))
+        self.assertEqual(list(bars.columns), ["t", "o", "h", "l", "c", "v"])
+        self.assertEqual(len(bars), 5)
+        # Two 30 minute bars per hour
+        self.assertEqual(bars['v'].iloc[-2], 20)
+        self.assertEqual(bars['h'].iloc[-1], 113.0)
+
+        client.client.history = lambda **kwargs: {'candles': [], 'empty': True}
+        self.assertEqual(len(await client.get_bars("AAPL", "day", 1, limit=5)), 0)
+
+    async def test_executor_does_not_block_loop(self):
+        self.assertGreater(await self.lag(0), 0.08)
+        self.assertLess(await self.lag(4), 0.05)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
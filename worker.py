@@ -0,0 +1,436 @@
+"""
+Monitor workers that split the symbols between them, so fetching and evaluation run on several cores
+
+Run 4 local workers with: python worker.py --workers 4
+Every worker uses the same SQLite file. Tickets are read from it, workers announce themselves with a heartbeat
+in its worker table, and alerts are claimed in it with compare-and-set, so a ticket is alerted by one worker only
+even while the symbols are being rebalanced.
+The file is in WAL mode, whose shared memory index only works between processes of one host. The bot and every
+worker must run on the host that has the file, never open it over a network filesystem
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import unittest
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import aiohttp
+import api
+import compute
+from cache import cached
+from async_sql import AsyncSQL
+from dispatch import AlertDispatcher
+from ema_state import EMAEngine, EMAStateStore
+from evaluator import Evaluator
+from market_calendar import MarketCalendar
+from rate_limiter import RateLimited
+from registry import TicketRegistry
+from rules import RuleEngine
+from scheduler import Scheduler
+from sql import SQL
+from custom_logger import get_logger
+
+logger = get_logger(__name__)
+
+DISCORD_API = "https://discord.com/api/v10"
+
+
+def position(key: str) -> int:
+    """
+    returns where key is on the ring, stable across processes unlike hash()
+    """
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of symbols to workers. When a worker joins or leaves only the symbols next to its
+    points move, about 1/N of them, every other symbol stays with the worker that has its state
+    """
+    def __init__(self, nodes: List[str], replicas=100):
+        """
+        nodes - worker ids
+        replicas - points per worker, more points spread the symbols more evenly
+        """
+        points = sorted((position(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self.positions = [p for p, _ in points]
+        self.nodes = [n for _, n in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        """
+        returns the worker key belongs to, None if there are no workers
+        """
+        if len(self.nodes) == 0:
+            return None
+        i = bisect.bisect(self.positions, position(key)) % len(self.positions)
+        return self.nodes[i]
+
+
+class DiscordChannels:
+    """
+    Sends alerts through Discord's HTTP API with the bot's token, workers do not need a gateway connection
+    """
+    def __init__(self, token: str):
+        self.token = token
+        self.session = None
+
+    async def deliver(self, channelID: int, message: str) -> None:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(headers={"Authorization": f"Bot {self.token}"})
+
+        async with self.session.post(f"{DISCORD_API}/channels/{channelID}/messages", json={"content": message}) as r:
+            if r.status == 429:
+                body = await r.json()
+                raise RateLimited(retry_after=body.get("retry_after"))
+            if r.status == 404:
+                logger.error(f"Channel {channelID} went away before alert was delivered")
+                return
+            r.raise_for_status()
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+
+class Worker:
+    def __init__(self, path: str, api: api.API, deliver: Callable[[int, str], Awaitable[None]], worker_id=None,
+                 interval=5, heartbeat=5, reload=60):
+        """
+        path - sqlite file of the tickets, shared by every worker
+        api - provider to fetch quotes and bars from
+        deliver - async function that sends a message to a channel, raises RateLimited on 429
+        worker_id - unique id, defaults to host and pid
+        interval - seconds between cycles
+        heartbeat - seconds between heartbeats, a worker missing 3 of them is left out of the ring
+        reload - seconds between reloads of the tickets, to see tickets added through the bot
+        """
+        self.id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.db = AsyncSQL(path)
+        self.api = api
+        self.registry = TicketRegistry(self.db)
+        self.evaluator = Evaluator(api)
+        self.ema_engine = EMAEngine(EMAStateStore(':memory:'))
+        self.rule_engine = RuleEngine(self.evaluator)
+        self.compute = compute.backend()
+        self.scheduler = Scheduler(min_interval=interval)
+        self.dispatcher = AlertDispatcher(deliver, self.undeliverable)
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.reload = reload
+
+        self.members: List[str] = []
+        self.ring = HashRing([])
+        self.owned: Set[str] = set()
+        # { _id: (channelID, message) } of the cycle's alerts, delivered once claimed
+        self.alerts: Dict[str, Tuple[int, str]] = {}
+        self.stopped = None
+
+    def owns(self, symbol: str) -> bool:
+        return self.ring.owner(symbol) == self.id
+
+    async def beat(self) -> None:
+        """
+        Marks this worker alive and rebalances if a worker joined or left
+        """
+        await self.db.heartbeat(self.id, socket.gethostname(), os.getpid())
+        members = await self.db.get_workers(ttl=3 * self.heartbeat)
+        if self.id not in members:
+            members = sorted(members + [self.id])
+
+        if members != self.members:
+            logger.info(f"{self.id}: workers changed from {self.members} to {members}")
+            self.members = members
+            self.ring = HashRing(members)
+            self.rebalance()
+
+    def rebalance(self) -> None:
+        """
+        Takes the symbols the ring gives this worker, newly owned ones are polled right away
+        """
+        owned = {s for s in self.registry.symbols() if self.owns(s)}
+        polled = owned & set(self.registry.price_symbols())
+        for symbol in polled - set(self.scheduler.next):
+            self.scheduler.add(symbol)
+        for symbol in set(self.scheduler.next) - polled:
+            self.scheduler.remove(symbol)
+        if owned != self.owned:
+            logger.info(f"{self.id}: owns {len(owned)} symbols, {len(owned - self.owned)} gained, {len(self.owned - owned)} given up")
+        self.owned = owned
+
+    async def load(self) -> None:
+        """
+        Reads the tickets again, to pick up the ones added or deleted through the bot
+        """
+        await self.registry.load()
+        for _id in list(self.rule_engine.compiled):
+            if _id not in self.registry.rules:
+                self.rule_engine.forget(_id)
+        self.rebalance()
+
+    def poll_budget(self) -> int:
+        """
+        returns how many symbols this worker can poll in one cycle, the provider's quota is split between the workers
+        """
+        requests = self.api.requests_per_minute / 60 * self.interval / max(1, len(self.members))
+        return max(1, int(requests * self.api.batch_size))
+
+    async def send(self, message: str, channelID: int, authorID: int, _id: str, calculated_timeout: int) -> None:
+        """
+        Same as the bot's send, the alert is held until its claim is written at the end of the cycle
+        """
+        self.alerts[_id] = (channelID, message)
+        await self.registry.defer_claim(_id, int(time.time()) + calculated_timeout)
+
+    async def cycle(self) -> int:
+        """
+        returns how many alerts were claimed and queued for delivery
+        """
+        try:
+            symbols = self.scheduler.due(self.poll_budget())
+            await self.evaluator.monitor_prices(symbols, self.registry.get, self.send,
+                                                lambda s, q: self.scheduler.observe(s, q, self.registry.get(s)))
+            await self.evaluator.monitor_emas([t for t in self.registry.active_emas() if t.symbol in self.owned],
+                                              self.send, self.ema_engine, self.compute)
+            await self.rule_engine.monitor([t for t in self.registry.active_rules() if t.symbol in self.owned], self.send)
+        finally:
+            claimed = await self.registry.flush_claims()
+            for _id in claimed:
+                self.dispatcher.put(*self.alerts[_id], _id)
+            # Claims that failed to write are retried next cycle
+            self.alerts = {k: v for k, v in self.alerts.items() if k in self.registry.pending_claims}
+        return len(claimed)
+
+    async def undeliverable(self, ids: List[str]) -> None:
+        """
+        ids - claimed tickets whose alert could not be delivered
+
+        Writes their timeout back right away, so they can be claimed and alerted again
+        """
+        for _id in ids:
+            await self.registry.update_timeout(_id, 0)
+
+    async def heartbeats(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await self.beat()
+            except Exception:
+                logger.error(f"{self.id}: heartbeat failed", exc_info=True)
+
+    async def run(self, calendar: MarketCalendar = None) -> None:
+        """
+        calendar - cycles only run while the market is open, None to always run
+
+        Runs cycles until stop is called, then leaves the ring
+        """
+        self.stopped = asyncio.Event()
+        await self.registry.load()
+        await self.beat()
+        beats = asyncio.create_task(self.heartbeats())
+        loaded = time.time()
+
+        try:
+            while not self.stopped.is_set():
+                start = time.time()
+                if start - loaded >= self.reload:
+                    await self.load()
+                    loaded = start
+
+                if calendar is None or calendar.is_open(start):
+                    try:
+                        alerts = await self.cycle()
+                        logger.info(f"{self.id}: cycle took {time.time() - start:.3f}s, {alerts} alerts")
+                    except Exception:
+                        logger.error(f"{self.id}: cycle failed", exc_info=True)
+
+                try:
+                    await asyncio.wait_for(self.stopped.wait(), timeout=max(0.0, self.interval - (time.time() - start)))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            beats.cancel()
+            await self.leave()
+
+    def stop(self) -> None:
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def leave(self) -> None:
+        """
+        Removes this worker from the ring right away, the others take over its symbols on their next heartbeat
+        """
+        await self.db.remove_worker(self.id)
+        await self.dispatcher.drain()
+        self.dispatcher.close()
+        self.compute.close()
+        self.db.close()
+
+
+async def serve(path: str, worker_id: str, interval: int, simulated: bool) -> None:
+    if simulated:
+        from sim_api import SimulatedAPI
+        provider = SimulatedAPI()
+        channels = None
+
+        async def deliver(channelID: int, message: str) -> None:
+            logger.info(f"{worker_id} -> {channelID}: {message}")
+    else:
+        from dotenv import load_dotenv
+        from tdameritrade_api import TdAmeritradeAPI
+        load_dotenv()
+        provider = TdAmeritradeAPI()
+        channels = DiscordChannels(os.environ["CLIENT_SECRET"])
+        deliver = channels.deliver
+
+    worker = Worker(path, cached(provider), deliver, worker_id=worker_id, interval=interval)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+
+    try:
+        await worker.run(calendar=None if simulated else MarketCalendar())
+    finally:
+        if channels is not None:
+            await channels.close()
+
+
+def run(path: str, worker_id: str, interval: int, simulated: bool) -> None:
+    asyncio.run(serve(path, worker_id, interval, simulated))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run monitor workers that split the symbols between them")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes to start on this host")
+    parser.add_argument("--db", default="alerts.db", help="Tickets, shared with the bot and every other worker")
+    parser.add_argument("--interval", type=int, default=5, help="Seconds between cycles")
+    parser.add_argument("--simulated", action="store_true", help="Use SimulatedAPI and log alerts instead of sending them")
+    args = parser.parse_args()
+
+    # Migrated once here, so the workers do not race to do it
+    SQL(args.db).conn.close()
+
+    host = socket.gethostname()
+    processes = [multiprocessing.Process(target=run, args=(args.db, f"{host}-{i}", args.interval, args.simulated), name=f"worker-{i}")
+                 for i in range(args.workers)]
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        # Every worker got the SIGINT too and is leaving the ring
+        for p in processes:
+            p.join()
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    def test_ring(self):
+        symbols = [f"S{i:04d}" for i in range(3000)]
+        ring = HashRing(["a", "b", "c"])
+        owners = {s: ring.owner(s) for s in symbols}
+        for node in "abc":
+            self.assertGreater(list(owners.values()).count(node), 600)
+
+        grown = HashRing(["a", "b", "c", "d"])
+        moved = [s for s in symbols if grown.owner(s) != owners[s]]
+        # Only symbols taken by the new worker move
+        self.assertTrue(all(grown.owner(s) == "d" for s in moved))
+        self.assertTrue(500 < len(moved) < 1100)
+        self.assertIsNone(HashRing([]).owner("AAPL"))
+
+    async def test_workers_split_and_rebalance(self):
+        from benchmark import fill
+        from sim_api import SimulatedAPI
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "alerts.db")
+        fill(path, tickets=600, symbols=60, ema_share=0.1)
+        delivered: List[str] = []
+
+        async def deliver(channelID: int, message: str) -> None:
+            delivered.extend(message.split("\n"))
+
+        # No random walk, both workers see the same quotes
+        a = Worker(path, SimulatedAPI(latency=0, jitter=0, volatility=0), deliver, worker_id="a")
+        b = Worker(path, SimulatedAPI(latency=0, jitter=0, volatility=0), deliver, worker_id="b")
+        try:
+            for w in (a, b):
+                await w.registry.load()
+            await a.beat()
+            await b.beat()
+            await a.beat()
+
+            self.assertEqual(a.members, ["a", "b"])
+            self.assertEqual(a.owned & b.owned, set())
+            self.assertEqual(a.owned | b.owned, set(a.registry.symbols()))
+            self.assertEqual(a.poll_budget(), b.poll_budget())
+            self.assertGreater(await a.cycle() + await b.cycle(), 0)
+
+            # b leaves, a takes over every symbol on its next heartbeat
+            await b.db.remove_worker("b")
+            await a.beat()
+            self.assertEqual(a.owned, set(a.registry.symbols()))
+
+            # b has not noticed yet and evaluates its old symbols too, its claims lose to a's
+            def reset(db: SQL) -> None:
+                with db.conn:
+                    db.conn.execute("UPDATE price SET timeout = 0")
+                    db.conn.execute("UPDATE ema SET timeout = 0")
+
+            await a.db.write(reset)
+            for w in (a, b):
+                await w.registry.load()
+                w.scheduler = Scheduler()
+                for symbol in w.owned & set(w.registry.price_symbols()):
+                    w.scheduler.add(symbol)
+
+            self.assertGreater(await a.cycle(), 0)
+            self.assertEqual(await b.cycle(), 0)
+            self.assertEqual(b.alerts, {})
+        finally:
+            a.db.close()
+            b.db.close()
+            shutil.rmtree(directory)
+
+    async def test_undelivered_alerts_reclaimed(self):
+        from benchmark import fill
+        from sim_api import SimulatedAPI
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "alerts.db")
+        fill(path, tickets=100, symbols=10, ema_share=0)
+
+        async def deliver(channelID: int, message: str) -> None:
+            raise aiohttp.ClientError("discord is down")
+
+        w = Worker(path, SimulatedAPI(latency=0, jitter=0, volatility=0), deliver, worker_id="a")
+        w.dispatcher.retry_delay = 0.01
+        try:
+            await w.registry.load()
+            await w.beat()
+            claimed = await w.cycle()
+            self.assertGreater(claimed, 0)
+            await w.dispatcher.drain()
+            self.assertEqual(w.dispatcher.stats()["failed"], claimed)
+
+            # Their timeouts were written back, so the next cycle claims them again
+            await w.registry.load()
+            w.scheduler = Scheduler()
+            for symbol in w.owned:
+                w.scheduler.add(symbol)
+            self.assertEqual(await w.cycle(), claimed)
+        finally:
+            w.dispatcher.close()
+            w.db.close()
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()